@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the broadcast of a Redis message to many local websockets.
+
+Run with `python benchmarks/bench_broadcast.py` from the root of the repository.
+Sockets are replaced by objects that discard data, so only the CPU cost of the encoding is measured.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# messages are encoded according to the Django settings
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'easydjango.conf.settings')
+os.environ.setdefault('EASYDJANGO_CONF_NAME', 'easydjango:django')
+
+# noinspection PyPep8
+from easydjango.websockets.compression import PerMessageDeflate
+# noinspection PyPep8
+from easydjango.websockets.outbound import OutboundQueue
+# noinspection PyPep8
+from easydjango.websockets.prepared import PreparedMessage
+# noinspection PyPep8
+from easydjango.websockets.websocket import WebSocket
+
+__author__ = 'Matthieu Gallet'
+
+
+class NullSocket(object):
+    def recv_into(self, buffer):
+        return 0
+
+    def sendall(self, data):
+        pass
+
+    # noinspection PyMethodMayBeStatic
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        return sum(len(x) for x in buffers)
+
+
+class NullInput(object):
+    def __init__(self):
+        self._sock = NullSocket()
+        self.raw = self
+
+    # noinspection PyMethodMayBeStatic
+    def fileno(self):
+        return -1
+
+
+def bench(name, function, count):
+    start = time.time()
+    function()
+    duration = time.time() - start
+    print('%-46s %6d websockets: %8.2f ms (%6.2f us per websocket)' % (name, count, duration * 1e3,
+                                                                      duration * 1e6 / count))
+
+
+def main():
+    message = ('{"signal": "notify", "opts": {"content": "%s"}, "signal_id": "1234"}' % ('x' * 1000)).encode('utf-8')
+    for count in (100, 1000, 10000):
+        for label, compression in (('uncompressed', None),
+                                   ('deflate, no context takeover', lambda: PerMessageDeflate(
+                                       server_context_takeover=False, threshold=256))):
+            websockets = [WebSocket(NullInput(), compression=compression and compression()) for __ in range(count)]
+            bench('send (%s)' % label, lambda: [x.send(message) for x in websockets], count)
+            for websocket in websockets:
+                websocket.outbound = OutboundQueue()
+
+            def broadcast():
+                # path of the messages received from Redis: queued, then written when the socket is writable
+                prepared = PreparedMessage(message)
+                for websocket in websockets:
+                    websocket.outbound.push(prepared)
+                    websocket.write_outbound()
+            bench('write_outbound (%s)' % label, broadcast, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of websocket payload unmasking.
+
+Run with `python benchmarks/bench_masking.py` from the root of the repository.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# noinspection PyPep8
+from easydjango.websockets import masking
+
+__author__ = 'Matthieu Gallet'
+
+
+def bytewise_mask_payload(mask, payload):
+    """Previous implementation, for comparison"""
+    payload = bytearray(payload)
+    mask = bytearray(mask)
+    for i in range(len(payload)):
+        payload[i] ^= mask[i % 4]
+    return bytes(payload)
+
+
+def bench(name, function, mask, payload, number):
+    duration = min(timeit.repeat(lambda: function(mask, payload), number=number, repeat=5)) / number
+    print('%-28s %8d bytes: %10.1f us' % (name, len(payload), duration * 1e6))
+
+
+def main():
+    mask = os.urandom(4)
+    for size in (125, 4096, 64 * 1024, 1024 * 1024):
+        payload = os.urandom(size)
+        expected = bytewise_mask_payload(mask, payload)
+        assert masking.mask_payload(mask, payload) == expected
+        number = max(1, 2000000 // size)
+        bench('byte by byte', bytewise_mask_payload, mask, payload, max(1, number // 100))
+        bench('integer', lambda m, p: masking._xor(m, p, len(p)), mask, payload, number)
+        if masking.numpy is not None:
+            bench('numpy', lambda m, p: masking._numpy_xor(m, p, len(p)), mask, payload, number)
+        bench('mask_payload', masking.mask_payload, mask, payload, number)
+
+
+if __name__ == '__main__':
+    main()
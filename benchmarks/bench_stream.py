@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Count the system calls required to read a burst of small websocket messages.
+
+Run with `python benchmarks/bench_stream.py` from the root of the repository.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# noinspection PyPep8
+from easydjango.websockets.masking import mask_payload
+# noinspection PyPep8
+from easydjango.websockets.websocket import WebSocket, Header
+
+__author__ = 'Matthieu Gallet'
+
+
+class CountingSocket(object):
+    """Socket wrapper that counts `recv` and `recv_into` calls"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer, size=0):
+        self.calls += 1
+        return self.sock.recv_into(buffer, size)
+
+    def sendall(self, data):
+        return self.sock.sendall(data)
+
+
+class FakeInput(object):
+    """Mimic the `wsgi.input` object of the Django development server"""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.raw = self
+
+    def fileno(self):
+        return self._sock.sock.fileno()
+
+
+class UnbufferedStream(object):
+    """Previous implementation: one `recv` for each header field and payload
+    (plus the extra calls required when `recv` returns a partial payload)"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.write = sock.sendall
+        self.fileno = sock.sock.fileno()
+
+    def read(self, size):
+        data = self.sock.recv(size)
+        while data and len(data) < size:
+            received = self.sock.recv(size - len(data))
+            if not received:
+                break
+            data += received
+        return data
+
+    # noinspection PyMethodMayBeStatic
+    def has_buffered_data(self):
+        return False
+
+
+def encode_frame(message):
+    mask = os.urandom(4)
+    return Header.encode_header(True, WebSocket.OPCODE_TEXT, mask, len(message), 0) + mask_payload(mask, message)
+
+
+def bench(name, count, size, unbuffered=False):
+    client, server = socket.socketpair()
+    counting = CountingSocket(server)
+    websocket = WebSocket(FakeInput(counting))
+    if unbuffered:
+        websocket.stream = UnbufferedStream(counting)
+    data = b''.join(encode_frame(b'x' * size) for __ in range(count))
+    sender = threading.Thread(target=client.sendall, args=(data, ))
+    sender.daemon = True
+    sender.start()
+    start = time.time()
+    for __ in range(count):
+        assert len(websocket.read_message()) == size
+    duration = time.time() - start
+    sender.join()
+    print('%-12s %6d messages of %5d bytes: %7d system calls, %8.1f ms' %
+          (name, count, size, counting.calls, duration * 1000.))
+    client.close()
+    server.close()
+
+
+def main():
+    for count, size in ((10000, 20), (10000, 200), (1000, 4000)):
+        bench('unbuffered', count, size, unbuffered=True)
+        bench('buffered', count, size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of UTF-8 validation of websocket text frames.
+
+Run with `python benchmarks/bench_utf8.py` from the root of the repository.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# noinspection PyPep8
+from easydjango.websockets.utf8validator import DfaUtf8Validator, Utf8Validator
+
+__author__ = 'Matthieu Gallet'
+
+
+def bench(name, validator_cls, payload, number):
+    def validate():
+        validator = validator_cls()
+        assert validator.validate(payload)[0]
+    duration = min(timeit.repeat(validate, number=number, repeat=5)) / number
+    print('%-28s %8d bytes: %10.1f us' % (name, len(payload), duration * 1e6))
+
+
+def main():
+    text = '{"signal": "demo", "opts": {"content": "élève à l\'école ✓ 😀"}}'
+    for size in (125, 4096, 64 * 1024):
+        payload = (text * (size // len(text) + 1)).encode('utf-8')[:size]
+        payload = payload.decode('utf-8', 'ignore').encode('utf-8')
+        number = max(1, 2000000 // size)
+        bench('DFA', DfaUtf8Validator, payload, max(1, number // 100))
+        bench(Utf8Validator.__name__, Utf8Validator, payload, number)
+
+
+if __name__ == '__main__':
+    main()
@@ -222,6 +222,7 @@ COMMON_COMMANDS = {
     'server-dev': ('django', 'runserver'),
     'sendtestemail': ('django', 'sendtestemail'),
     'shell': ('django', 'shell'),
+    'server-asyncio': ('django', 'runserver_asyncio'),
     'server-gunicorn': ('gunicorn', ''),
     'server-uwsgi': ('uwsgi', ''),
 }
@@ -234,10 +235,60 @@ WS4REDIS_CONNECTION = {'host': '{WS4REDIS_SERVER}', 'port': SettingReference('WS
                        'db': SettingReference('WS4REDIS_DB'), 'password': '{WS4REDIS_PASSWORD}'}
 WS4REDIS_TOPIC_SERIALIZER = 'easydjango.websockets.topics.serialize_topic'
 WS4REDIS_HEARTBEAT = '--HEARTBEAT--'
+# maximum time (in seconds) a websocket waits for its sockets before checking its keepalive
+WS4REDIS_HEARTBEAT_INTERVAL = 10
+# send a ping frame to clients that sent nothing for this number of seconds (0 to use WS4REDIS_HEARTBEAT instead)
+WS4REDIS_PING_INTERVAL = 15
+# close the websocket after this number of consecutive unanswered pings
+WS4REDIS_PING_MAX_MISSED = 3
+# JSONDecoder and JSONEncoder subclasses, or functions like 'orjson.loads' and 'orjson.dumps'
 WS4REDIS_SIGNAL_DECODER = 'json.JSONDecoder'
 WS4REDIS_SIGNAL_ENCODER = 'django.core.serializers.json.DjangoJSONEncoder'
 WS4REDIS_PREFIX = 'ws'
 WS4REDIS_THREAD_COUNT = 2
+# maximum number of new websockets accepted per second by each process (0 for no limit), with bursts up to
+# WS4REDIS_ACCEPT_BURST connections; excess websockets are closed with code 1013 (try again later) and asked to wait
+# WS4REDIS_ACCEPT_RETRY_AFTER seconds before reconnecting
+WS4REDIS_ACCEPT_RATE = 0
+WS4REDIS_ACCEPT_BURST = 100
+WS4REDIS_ACCEPT_RETRY_AFTER = 5
+# keep the last signals of each topic in a Redis stream of about this size (0 to disable), so they can be sent again
+# to reconnecting windows, and remove these streams WS4REDIS_BACKLOG_TTL seconds after their last signal
+WS4REDIS_BACKLOG_SIZE = 0
+WS4REDIS_BACKLOG_TTL = 300
+# maximum difference (in seconds) between the clocks of the publishers and of Redis: a reconnecting window only reads
+# the backlog entries added since this delay before the publication of its last signal
+WS4REDIS_BACKLOG_CLOCK_SKEW = 5
+# identical calls of functions registered with `coalesce` wait for the running one during at most this number of
+# seconds (after that, a new call is sent to Celery)
+WS4REDIS_COALESCE_TIMEOUT = 60
+# signals sent by websocket clients within this delay (in seconds) are sent to Celery as a single task per queue
+# (0 to send one task per signal)
+WS4REDIS_DISPATCH_DELAY = 0
+# give the topics of a window in its (signed) websocket token instead of storing them in Redis, unless this token is
+# longer than WS4REDIS_TOKEN_MAX_LENGTH characters; these tokens expire after WS4REDIS_TOKEN_MAX_AGE seconds (None for
+# no expiry)
+WS4REDIS_TOPICS_IN_TOKEN = False
+WS4REDIS_TOKEN_MAX_LENGTH = 1024
+WS4REDIS_TOKEN_MAX_AGE = None
+# publish messages to Redis from a background thread, without waiting for the reply
+WS4REDIS_PUBLISH_ASYNC = False
+# maximum size (in bytes) of a message received from a websocket client (0 for no limit)
+WS4REDIS_MAX_MESSAGE_SIZE = 4194304
+# use the permessage-deflate extension when the client supports it
+WS4REDIS_COMPRESSION = True
+# messages smaller than this size (in bytes) are sent uncompressed
+WS4REDIS_COMPRESSION_THRESHOLD = 256
+# keep the compression contexts between messages (better ratio for similar messages, but each websocket keeps a zlib
+# compressor and a decompressor, about 300 KiB); when False, they only exist while a message is (de)compressed and
+# compressed broadcast messages are shared by all websockets
+WS4REDIS_COMPRESSION_CONTEXT_TAKEOVER = False
+# limits of the queue of messages waiting to be sent to a slow websocket client (0 for no limit)
+WS4REDIS_OUTBOUND_MAX_BYTES = 1048576
+WS4REDIS_OUTBOUND_MAX_MESSAGES = 1000
+# applied when these limits are reached: 'drop-oldest', 'coalesce' (older messages of the same signal are dropped
+# first) or 'disconnect'
+WS4REDIS_OUTBOUND_POLICY = 'drop-oldest'
 
 # django-pipeline
 PIPELINE = {
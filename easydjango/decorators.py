@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, print_function, absolute_import
 
+import json
 import re
 
 from django import forms
@@ -9,6 +10,8 @@ from django.http import QueryDict
 from django.utils.six import text_type
 from django.utils.translation import ugettext_lazy as _
 
+from easydjango.utils import TTLCache
+
 try:
     from inspect import signature
 except ImportError:
@@ -87,12 +90,14 @@ class has_perm(object):
 
 
 class Connection(object):
-    def __init__(self, fn, path=None, is_allowed_to=server_side, queue=None):
+    def __init__(self, fn, path=None, is_allowed_to=server_side, queue=None, inline=False):
         self.function = fn
         # noinspection PyTypeChecker
         self.path = path or (hasattr(fn, '__name__') and fn.__name__)
         self.is_allowed_to = is_allowed_to
         self.queue = queue or settings.CELERY_DEFAULT_QUEUE
+        # called by websocket clients: directly run by the websocket server process, without Celery
+        self.inline = inline
         self.accept_kwargs = False
         self.argument_types = {}
         self.required_arguments_names = []
@@ -148,13 +153,28 @@ class SignalConnection(Connection):
 
 
 class FunctionConnection(Connection):
+    def __init__(self, fn, path=None, is_allowed_to=server_side, queue=None, inline=False, coalesce=None,
+                 cache_ttl=0):
+        if coalesce not in (None, 'user', 'all'):
+            raise ValueError('coalesce must be None, "user" or "all"')
+        super(FunctionConnection, self).__init__(fn, path=path, is_allowed_to=is_allowed_to, queue=queue,
+                                                 inline=inline)
+        self.coalesce = coalesce
+        self.result_cache = TTLCache(ttl=cache_ttl) if coalesce and cache_ttl else None
+
+    def coalescing_key(self, window_info, kwargs):
+        """Identical calls share this key: same path, arguments and language (and same user for `'user'`)"""
+        language_code = getattr(window_info, 'language_code', None)
+        user_pk = getattr(window_info, 'user_pk', None) if self.coalesce == 'user' else None
+        return self.path, json.dumps(kwargs, sort_keys=True), language_code, user_pk
+
     def register(self):
         REGISTERED_FUNCTIONS[self.path] = self
 
 
-def signal(fn=None, path=None, is_allowed_to=server_side, queue=None):
+def signal(fn=None, path=None, is_allowed_to=server_side, queue=None, inline=False):
     def wrapped(fn_):
-        wrapper = SignalConnection(fn=fn_, path=path, is_allowed_to=is_allowed_to, queue=queue)
+        wrapper = SignalConnection(fn=fn_, path=path, is_allowed_to=is_allowed_to, queue=queue, inline=inline)
         wrapper.register()
         return fn_
 
@@ -163,16 +183,24 @@ def signal(fn=None, path=None, is_allowed_to=server_side, queue=None):
     return wrapped
 
 
-def function(fn=None, path=None, is_allowed_to=server_side, queue=None):
+def function(fn=None, path=None, is_allowed_to=server_side, queue=None, inline=False, coalesce=None, cache_ttl=0):
     """
 
     .. code-block:: javascript
 
     $.edws.path({}).then(function(x) { alert(x); });
 
+    With `inline=True`, calls from websocket clients are not sent to Celery: the function is run by the websocket
+    server process and its result is directly written to the websocket. Only use it for fast functions.
+
+    With `coalesce='user'` (or `coalesce='all'`), identical calls (same arguments and language) of the same user
+    (or of all users) that are running at the same time are only computed once, and the result is sent to each caller:
+    the websocket server only sends the first call to Celery (see :func:`easydjango.tasks._dispatch_function_call`).
+    The result can also be kept for `cache_ttl` seconds by the process that computes it.
      """
     def wrapped(fn_):
-        wrapper = FunctionConnection(fn=fn_, path=path, is_allowed_to=is_allowed_to, queue=queue)
+        wrapper = FunctionConnection(fn=fn_, path=path, is_allowed_to=is_allowed_to, queue=queue, inline=inline,
+                                     coalesce=coalesce, cache_ttl=cache_ttl)
         wrapper.register()
         return fn_
 
@@ -195,7 +223,7 @@ class FormValidator(FunctionConnection):
                 'help_texts': {f: e.help_text for (f, e) in form.fields.items() if e.help_text}}
 
 
-def validate_form(form_cls=None, path=None, is_allowed_to=server_side):
+def validate_form(form_cls=None, path=None, is_allowed_to=server_side, inline=False):
     if path is None or is_allowed_to == server_side:
         # @validate_form
         # class MyForm(forms.Form):
@@ -203,7 +231,7 @@ def validate_form(form_cls=None, path=None, is_allowed_to=server_side):
         raise ValueError('is_allowed_to and path are not configured for the validate_form decorator')
 
     def wrapped(form_cls_):
-        wrapper = FormValidator(form_cls_, path=path, is_allowed_to=is_allowed_to)
+        wrapper = FormValidator(form_cls_, path=path, is_allowed_to=is_allowed_to, inline=inline)
         wrapper.register()
         return form_cls_
 
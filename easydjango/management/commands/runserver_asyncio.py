@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+import sys
+from argparse import ArgumentParser
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+__author__ = 'Matthieu Gallet'
+
+
+class Command(BaseCommand):
+    help = 'Run a websocket-only server, based on asyncio (requires Python 3.5+). ' \
+           'Each process handles all its websockets with a single event loop and a single Redis connection.'
+
+    def add_arguments(self, parser):
+        assert isinstance(parser, ArgumentParser)
+        parser.add_argument('addrport', nargs='?', default=settings.LISTEN_ADDRESS,
+                            help='Optional port number, or ipaddr:port')
+        parser.add_argument('--workers', default=1, type=int,
+                            help='number of processes, each of them running its own event loop')
+
+    def handle(self, *args, **options):
+        if sys.version_info < (3, 5):
+            raise CommandError('The asyncio websocket server requires Python 3.5+')
+        from easydjango.websockets.asyncio_runserver import run
+        host, sep, port = options['addrport'].rpartition(':')
+        if not port.isdigit():
+            raise CommandError('"%s" is not a valid port number.' % port)
+        run(host.strip('[]') or 'localhost', int(port), workers=max(options['workers'], 1))
@@ -10,6 +10,14 @@
     $.ed._functionCallPromises = {};
     $.ed._registered_signals = {};
     $.ed._wsBuffer = [];
+    $.ed._wsReconnectDelay = 3000;
+    $.ed._wsReconnectMaxDelay = 60000;
+    $.ed._wsReconnectAttempts = 0;
+    $.ed._wsLastSignalId = null;
+    // messages sent by the current script are grouped in a single frame, sent when it ends (0, without any delay),
+    // after this delay (in milliseconds) or immediately and separately (a negative delay)
+    $.ed._wsBatchDelay = 0;
+    $.ed._wsBatch = [];
     $.ed._closeHTMLNotification = function (id) {
         $("#" + id).fadeOut(400, "swing", function () { $("#" + id).remove()});
         delete $.ed._notificationClosers[id];
@@ -39,13 +47,22 @@
     $.ed._wsConnect = function (edWsUrl) {
         "use strict";
         var url = edWsUrl;
+        if ($.ed._wsLastSignalId) {
+            // signals published during the reconnection are sent again by the server
+            edWsUrl += (edWsUrl.indexOf("?") < 0 ? "?" : "&") + "last_signal_id=" +
+                encodeURIComponent($.ed._wsLastSignalId);
+        }
         var connection = new WebSocket(edWsUrl);
+        var opened = false;
+        var flushed = [];
         connection.onopen = function() {
             $.ed._wsConnection = connection;
+            opened = true;
             console.log("websocket connected");
             for(var i=0; i < $.ed._wsBuffer.length; i++) {
                 connection.send($.ed._wsBuffer[i]);
             }
+            flushed = $.ed._wsBuffer;
             $.ed._wsBuffer = [];
         };
         connection.onmessage = function(e) {
@@ -55,6 +72,9 @@
             } else {
                 var msg = JSON.parse(e.data);
                 if (msg.signal && msg.signal_id) {
+                    if ($.ed._signalIds[msg.signal_id] === undefined) {
+                        $.ed._wsLastSignalId = msg.signal_id;
+                    }
                     $.ed.call(msg.signal, msg.opts, msg.signal_id);
                 }
                 else if((msg.result_id) && (msg.exception)) {
@@ -73,21 +93,65 @@
         connection.onclose = function(e) {
             console.log("connection closed");
             $.ed._wsConnection = null;
-            setTimeout(function () {$.ed._wsConnect(url);}, 3000);
+            if (e.code === 1013) {
+                // rejected by an overloaded server: messages sent on open have not been processed
+                $.ed._wsBuffer = flushed.concat($.ed._wsBuffer);
+            } else if (opened) {
+                $.ed._wsReconnectAttempts = 0;
+            }
+            // exponential backoff with full jitter, to spread the reconnections of all clients
+            var maxDelay = Math.min($.ed._wsReconnectMaxDelay,
+                $.ed._wsReconnectDelay * Math.pow(2, $.ed._wsReconnectAttempts));
+            var delay = Math.random() * maxDelay;
+            var retryAfter = /retry-after=(\d+)/.exec(e.reason || "");
+            if (retryAfter) {
+                delay += parseInt(retryAfter[1], 10) * 1000;
+            }
+            $.ed._wsReconnectAttempts++;
+            setTimeout(function () {$.ed._wsConnect(url);}, delay);
         }
     }
+    $.ed._wsSendNow = function (msg) {
+        "use strict";
+        if ($.ed._wsConnection) {
+            $.ed._wsConnection.send(msg);
+        } else {
+            $.ed._wsBuffer.push(msg);
+        }
+    };
+    $.ed._wsFlushBatch = function () {
+        "use strict";
+        var batch = $.ed._wsBatch;
+        $.ed._wsBatch = [];
+        if (batch.length === 1) {
+            $.ed._wsSendNow(JSON.stringify(batch[0]));
+        } else if (batch.length > 1) {
+            $.ed._wsSendNow(JSON.stringify(batch));
+        }
+    };
+    $.ed._wsSend = function (msg) {
+        "use strict";
+        if ($.ed._wsBatchDelay < 0) {
+            $.ed._wsSendNow(JSON.stringify(msg));
+            return;
+        }
+        $.ed._wsBatch.push(msg);
+        if ($.ed._wsBatch.length === 1) {
+            if ($.ed._wsBatchDelay > 0) {
+                setTimeout($.ed._wsFlushBatch, $.ed._wsBatchDelay);
+            } else {
+                // microtask: run as soon as the current script ends, before any timer or rendering
+                Promise.resolve().then($.ed._wsFlushBatch);
+            }
+        }
+    };
     $.ed._wsSignalConnect = function (signal) {
         "use strict";
         var wrapper = function (opts, id) {
             if (id) {
                 return;
             }
-            var msg = JSON.stringify({signal: signal, opts: opts});
-            if ($.ed._wsConnection) {
-                $.ed._wsConnection.send(msg);
-            } else {
-                $.ed._wsBuffer.push(msg);
-            }
+            $.ed._wsSend({signal: signal, opts: opts});
         };
         $.ed.connect(signal, wrapper);
     };
@@ -97,7 +161,7 @@
         if (opts === undefined) {
             opts = {};
         }
-        $.ed._wsConnection.send(JSON.stringify({func: func, opts: opts, result_id: callId}));
+        $.ed._wsSend({func: func, opts: opts, result_id: callId});
         var promise = new Promise(function(resolve, reject) {
             $.ed._functionCallPromises[callId] = [resolve, reject];
             });
@@ -1,21 +1,30 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, print_function, absolute_import
 
+import atexit
+import hashlib
 import json
 import logging
-import uuid
+import os
+import threading
 
 from celery import shared_task
 from django.conf import settings
+from django.db.models import QuerySet
 from django.utils.lru_cache import lru_cache
 from django.utils.module_loading import import_string
 from django.utils.six import text_type
-from redis import StrictRedis
+from redis import StrictRedis, ConnectionPool
 
 from easydjango.decorators import REGISTERED_SIGNALS, SignalConnection, REGISTERED_FUNCTIONS, FunctionConnection
 from easydjango.request import WindowInfo
-from easydjango.utils import import_module
+from easydjango.utils import import_module, CallCoalescer
+from easydjango.websockets.backlog import new_signal_id
+from easydjango.websockets.dispatcher import BatchDispatcher
+from easydjango.websockets.publisher import send_messages, BackgroundPublisher
 from easydjango.websockets.exceptions import NoWindowKeyException
+from easydjango.websockets.serialization import encode_signal, encode_message
+from easydjango.websockets.tokens import embedded_topics_token
 
 __author__ = 'Matthieu Gallet'
 
@@ -24,15 +33,76 @@ WINDOW = [[]]
 USER = [[]]
 BROADCAST = [[]]
 
-_signal_encoder = import_string(settings.WS4REDIS_SIGNAL_ENCODER)
 _topic_serializer = import_string(settings.WS4REDIS_TOPIC_SERIALIZER)
 logger = logging.getLogger('easydjango.websockets')
 
 
-# noinspection PyCallingNonCallable
-@lru_cache()
+_redis_connections = {}
+_publishers = {}
+_dispatchers = {}
+_coalescer = CallCoalescer()
+_process_lock = threading.Lock()
+
+
 def _get_redis_connection():
-    return StrictRedis(**settings.WS4REDIS_CONNECTION)
+    """Return the Redis connection of the current process.
+
+    Its connection pool is thread-safe and a new pool is created after a fork (e.g. in Celery workers),
+    so two processes never share a socket.
+    """
+    pid = os.getpid()
+    connection = _redis_connections.get(pid)
+    if connection is None:
+        with _process_lock:
+            connection = _redis_connections.get(pid)
+            if connection is None:
+                _redis_connections.clear()
+                connection = StrictRedis(connection_pool=ConnectionPool(**settings.WS4REDIS_CONNECTION))
+                _redis_connections[pid] = connection
+    return connection
+
+
+def _get_batcher(batchers, factory):
+    """Return the background batcher of the current process stored in `batchers`, built by `factory()`.
+
+    A new one is built after a fork (its thread is not copied) and its pending items are flushed at exit.
+    """
+    pid = os.getpid()
+    batcher = batchers.get(pid)
+    if batcher is None:
+        with _process_lock:
+            batcher = batchers.get(pid)
+            if batcher is None:
+                batchers.clear()
+                batcher = factory()
+                batchers[pid] = batcher
+                atexit.register(batcher.flush)
+    return batcher
+
+
+def _get_publisher():
+    return _get_batcher(_publishers, lambda: BackgroundPublisher(_get_redis_connection))
+
+
+def _send_signal_calls(queue, calls):
+    if len(calls) == 1:
+        _server_signal_call.apply_async(calls[0] + [queue], queue=queue)
+    else:
+        _server_signal_call_many.apply_async([calls, queue], queue=queue)
+
+
+def _get_dispatcher():
+    return _get_batcher(_dispatchers, lambda: BatchDispatcher(_send_signal_calls,
+                                                              delay=settings.WS4REDIS_DISPATCH_DELAY))
+
+
+def _publish_messages(messages):
+    """Publish a list of `(topic, message)` in a single round trip, or in the background if
+    `settings.WS4REDIS_PUBLISH_ASYNC` is `True`."""
+    if settings.WS4REDIS_PUBLISH_ASYNC:
+        _get_publisher().publish(messages)
+    else:
+        send_messages(_get_redis_connection(), messages)
 
 
 def set_websocket_topics(request, *topics):
@@ -42,26 +112,66 @@ def set_websocket_topics(request, *topics):
     token = request.window_key
     request.has_websocket_topics = True
     prefix = settings.WS4REDIS_PREFIX
-    request = WindowInfo.from_request(request)
-    topic_strings = {_topic_serializer(request, x) for x in topics if x is not SERVER}
-    # noinspection PyUnresolvedReferences,PyTypeChecker
-    if getattr(request, 'user', None) and request.user.is_authenticated():
-        topic_strings.add(_topic_serializer(request, USER))
-    topic_strings.add(_topic_serializer(request, WINDOW))
-    topic_strings.add(_topic_serializer(request, BROADCAST))
-    connection = _get_redis_connection()
+    topics = [x for x in topics if not any(x is y for y in (SERVER, WINDOW, USER, BROADCAST))]
+    # only built when required: never for pages without extra topics when they are given by the token
+    window_info = WindowInfo.from_request(request) if topics else None
+    topic_strings = {_topic_serializer(window_info, x) for x in topics}
+    topic_strings.discard(None)
+    if settings.WS4REDIS_TOPICS_IN_TOKEN:
+        # the websocket server directly subscribes to the topics given by the token, without Redis
+        signed_token = embedded_topics_token(token, sorted(topic_strings))
+        if signed_token is not None:
+            request.websocket_token = signed_token
+            return
+    if window_info is None:
+        window_info = WindowInfo.from_request(request)
+    topic_strings.update(_get_default_topics(window_info))
+    topic_strings.discard(None)
     redis_key = '%s%s' % (prefix, token)
-    connection.delete(redis_key)
-    for topic in topic_strings:
-        if topic is not None:
-            connection.rpush(redis_key, prefix + topic)
-    connection.expire(redis_key, settings.WS4REDIS_EXPIRE)
+    pipe = _get_redis_connection().pipeline(transaction=True)
+    pipe.delete(redis_key)
+    if topic_strings:
+        pipe.rpush(redis_key, *[prefix + x for x in topic_strings])
+    pipe.expire(redis_key, settings.WS4REDIS_EXPIRE)
+    pipe.execute()
+
+
+def _get_default_topics(window_info):
+    """Serialized topics of all windows: `WINDOW`, `BROADCAST` and `USER` (for authenticated users)"""
+    topics = [_topic_serializer(window_info, WINDOW), _topic_serializer(window_info, BROADCAST)]
+    if getattr(window_info, 'user_pk', None) is not None:
+        topics.append(_topic_serializer(window_info, USER))
+    return [x for x in topics if x is not None]
 
 
 def scall(window_info, signal_name, to=None, **kwargs):
     return _call_signal(window_info, signal_name, to=to, kwargs=kwargs, from_client=False)
 
 
+def scall_many(window_info, signal_name, targets, **kwargs):
+    """Send a signal to many topics at once, for example `scall_many(window_info, 'notify', User.objects.all())`.
+
+    Topics are serialized in a single pass (a single query for querysets, see
+    :func:`easydjango.websockets.topics.serialize_topics`), the message is encoded once and all topics are published in a
+    single pipelined round trip.
+
+    :param targets: a queryset, or an iterable of topics (that may include `SERVER`)
+    """
+    # easydjango.websockets.topics imports this module
+    from easydjango.websockets.topics import serialize_topic, serialize_topics
+    if not isinstance(targets, QuerySet):
+        targets = list(targets)
+        if any(x is SERVER for x in targets):
+            targets = [x for x in targets if x is not SERVER]
+            _call_signal(window_info, signal_name, to=[SERVER], kwargs=kwargs, from_client=False)
+    if _topic_serializer is serialize_topic:
+        serialized_topics = serialize_topics(window_info, targets)
+    else:
+        serialized_topics = [x for x in (_topic_serializer(window_info, y) for y in targets) if x is not None]
+    if serialized_topics:
+        _call_ws_signals(signal_name, new_signal_id(), serialized_topics, kwargs)
+
+
 def call(window_info, signal_name, to=None, kwargs=None, countdown=None, expires=None, eta=None):
     return _call_signal(window_info, signal_name, to=to, kwargs=kwargs, countdown=countdown, expires=expires,
                         eta=eta, from_client=False)
@@ -93,7 +203,12 @@ def _call_signal(window_info, signal_name, to=None, kwargs=None, countdown=None,
     if countdown:
         celery_kwargs['countdown'] = countdown
     import_signals_and_functions()
-    queues = {x.queue for x in REGISTERED_SIGNALS.get(signal_name, [])}
+    connections = REGISTERED_SIGNALS.get(signal_name, [])
+    inline = from_client and to_server and any(x.inline for x in connections)
+    if from_client:
+        # inline signals are run by the websocket server process, never by Celery
+        connections = [x for x in connections if not x.inline]
+    queues = {x.queue for x in connections}
     window_info_as_dict = None
     if window_info:
         window_info_as_dict = window_info.to_dict()
@@ -107,22 +222,54 @@ def _call_signal(window_info, signal_name, to=None, kwargs=None, countdown=None,
     else:
         if to_server:
             for queue in queues:
-                _server_signal_call.apply_async([signal_name, window_info_as_dict, kwargs, from_client, [],
-                                                 to_server, queue], queue=queue)
+                call_args = [signal_name, window_info_as_dict, kwargs, from_client, [], to_server]
+                if from_client and settings.WS4REDIS_DISPATCH_DELAY:
+                    _get_dispatcher().dispatch(queue, call_args)
+                else:
+                    _server_signal_call.apply_async(call_args + [queue], queue=queue)
         if serialized_client_topics:
-            signal_id = str(uuid.uuid4())
-            for topic in serialized_client_topics:
-                _call_ws_signal(signal_name, signal_id, topic, kwargs)
+            signal_id = new_signal_id()
+            _call_ws_signals(signal_name, signal_id, serialized_client_topics, kwargs)
+    if inline:
+        _call_inline_signal(window_info, signal_name, kwargs)
+
+
+def _call_inline_signal(window_info, signal_name, kwargs):
+    """Run the connections of a signal registered with `inline=True`, in the current process."""
+    for connection in REGISTERED_SIGNALS.get(signal_name, []):
+        if not connection.inline or not connection.is_allowed_to(window_info):
+            continue
+        # noinspection PyBroadException
+        try:
+            connection_kwargs = connection.check(dict(kwargs))
+            if connection_kwargs is not None:
+                connection(window_info, **connection_kwargs)
+        except Exception as e:
+            logger.exception('Error in inline signal %r: %s' % (signal_name, e))
 
 
 def _call_ws_signal(signal_name, signal_id, serialized_topic, kwargs):
-    # connection = _get_redis_connection()
-    connection = StrictRedis(**settings.WS4REDIS_CONNECTION)
-    serialized_message = json.dumps({'signal': signal_name, 'opts': kwargs, 'signal_id': signal_id},
-                                    cls=_signal_encoder)
-    topic = settings.WS4REDIS_PREFIX + serialized_topic
-    logger.debug("send message to topic %r" % topic)
-    connection.publish(topic, serialized_message.encode('utf-8'))
+    _call_ws_signals(signal_name, signal_id, [serialized_topic], kwargs)
+
+
+def _call_ws_signals(signal_name, signal_id, serialized_topics, kwargs):
+    """Send the same signal to several topics; the message is serialized once and all topics are
+    published in a single round trip."""
+    serialized_message = encode_signal(signal_name, signal_id, kwargs)
+    messages = []
+    for serialized_topic in serialized_topics:
+        topic = settings.WS4REDIS_PREFIX + serialized_topic
+        logger.debug("send message to topic %r" % topic)
+        if settings.WS4REDIS_BACKLOG_SIZE:
+            messages.append((topic, serialized_message, signal_id))
+        else:
+            messages.append((topic, serialized_message))
+    _publish_messages(messages)
+
+
+def _function_result_message(result_id, result, exception=None):
+    json_msg = {'result_id': result_id, 'result': result, 'exception': text_type(exception) if exception else None}
+    return encode_message(json_msg)
 
 
 def _return_ws_function_result(window_info, result_id, result, exception=None):
@@ -133,15 +280,12 @@ def _return_ws_function_result(window_info, result_id, result, exception=None):
     :param exception:
     :return:
     """
-    # connection = _get_redis_connection()
-    connection = StrictRedis(**settings.WS4REDIS_CONNECTION)
-    json_msg = {'result_id': result_id, 'result': result, 'exception': text_type(exception) if exception else None}
-    serialized_message = json.dumps(json_msg, cls=_signal_encoder)
+    serialized_message = _function_result_message(result_id, result, exception=exception)
     serialized_topic = _topic_serializer(window_info, WINDOW)
     if serialized_topic:
         topic = settings.WS4REDIS_PREFIX + serialized_topic
         logger.debug("send function result to topic %r" % topic)
-        connection.publish(topic, serialized_message.encode('utf-8'))
+        _publish_messages([(topic, serialized_message)])
 
 
 @lru_cache()
@@ -165,16 +309,16 @@ def _server_signal_call(signal_name, window_info_dict, kwargs=None, from_client=
     if kwargs is None:
         kwargs = {}
     if serialized_client_topics:
-        signal_id = str(uuid.uuid4())
-        for topic in serialized_client_topics:
-            _call_ws_signal(signal_name, signal_id, topic, kwargs)
+        signal_id = new_signal_id()
+        _call_ws_signals(signal_name, signal_id, serialized_client_topics, kwargs)
     window_info = WindowInfo.from_dict(window_info_dict)
     import_signals_and_functions()
     if not to_server or signal_name not in REGISTERED_SIGNALS:
         return
     for connection in REGISTERED_SIGNALS[signal_name]:
         assert isinstance(connection, SignalConnection)
-        if connection.queue != queue or (from_client and not connection.is_allowed_to(window_info)):
+        if connection.queue != queue or (from_client and (connection.inline or
+                                                          not connection.is_allowed_to(window_info))):
             continue
         kwargs = connection.check(kwargs)
         if kwargs is None:
@@ -183,17 +327,89 @@ def _server_signal_call(signal_name, window_info_dict, kwargs=None, from_client=
 
 
 @shared_task(serializer='json')
-def _server_function_call(function_name, window_info_dict, result_id, kwargs=None):
+def _server_signal_call_many(calls, queue=None):
+    """Process a batch of signals sent by websocket clients.
+
+    :param calls: list of the positional arguments of :func:`_server_signal_call` (except `queue`)
+    """
+    for call_args in calls:
+        # noinspection PyBroadException
+        try:
+            _server_signal_call(*call_args, queue=queue)
+        except Exception as e:
+            logger.exception('Error in signal %r: %s' % (call_args[0], e))
+
+
+@shared_task(serializer='json')
+def _server_function_call(function_name, window_info_dict, result_id, kwargs=None, coalescing_key=None):
     if kwargs is None:
         kwargs = {}
     window_info = WindowInfo.from_dict(window_info_dict)
     import_signals_and_functions()
     connection = REGISTERED_FUNCTIONS[function_name]
+    result, exception = _run_function(connection, window_info, kwargs)
+    if coalescing_key:
+        _return_coalesced_function_result(coalescing_key, result, exception=exception)
+    else:
+        _return_ws_function_result(window_info, result_id, result, exception=exception)
+
+
+def _dispatch_function_call(window_info, connection, result_id, kwargs):
+    """Send a function call made by a websocket client to Celery.
+
+    Identical calls of functions registered with `coalesce` are deduplicated before Celery: the first one stores an
+    in-flight key in Redis (`SET NX`) and is sent to Celery, the next ones are only added to the waiters of this key,
+    and the worker sends its result to all waiters. The in-flight key expires after
+    `settings.WS4REDIS_COALESCE_TIMEOUT` seconds, in case of a lost task.
+    """
+    coalescing_key = None
+    if connection.coalesce:
+        key = json.dumps(list(connection.coalescing_key(window_info, kwargs)), default=text_type)
+        coalescing_key = '%sfunction-%s' % (settings.WS4REDIS_PREFIX, hashlib.sha1(key.encode('utf-8')).hexdigest())
+        waiter = json.dumps([_topic_serializer(window_info, WINDOW), result_id])
+        timeout = settings.WS4REDIS_COALESCE_TIMEOUT
+        # a single transaction: the worker either reads this waiter, or has already removed the in-flight key
+        pipe = _get_redis_connection().pipeline(transaction=True)
+        pipe.set(coalescing_key, result_id, nx=True, ex=timeout)
+        pipe.rpush('%s:waiters' % coalescing_key, waiter)
+        pipe.expire('%s:waiters' % coalescing_key, timeout)
+        if not pipe.execute()[0]:
+            return
+    _server_function_call.apply_async([connection.path, window_info.to_dict(), result_id, kwargs, coalescing_key],
+                                      queue=connection.queue or settings.CELERY_DEFAULT_QUEUE)
+
+
+def _return_coalesced_function_result(coalescing_key, result, exception=None):
+    """Send the result of a coalesced call to all its waiters, and remove its in-flight key"""
+    pipe = _get_redis_connection().pipeline(transaction=True)
+    pipe.lrange('%s:waiters' % coalescing_key, 0, -1)
+    pipe.delete('%s:waiters' % coalescing_key, coalescing_key)
+    messages = []
+    for waiter in pipe.execute()[0]:
+        serialized_topic, result_id = json.loads(waiter.decode('utf-8'))
+        if serialized_topic:
+            message = _function_result_message(result_id, result, exception=exception)
+            messages.append((settings.WS4REDIS_PREFIX + serialized_topic, message))
+    _publish_messages(messages)
+
+
+def _run_function(connection, window_info, kwargs):
+    """Call a function and return a `(result, exception)` tuple"""
     assert isinstance(connection, FunctionConnection)
     # noinspection PyBroadException
     try:
-        result = connection(window_info, **kwargs)
-        e = None
+        if connection.coalesce:
+            key = connection.coalescing_key(window_info, kwargs)
+            return _coalescer.call(key, lambda: connection(window_info, **kwargs), cache=connection.result_cache), None
+        return connection(window_info, **kwargs), None
     except Exception as e:
-        result = None
-    _return_ws_function_result(window_info, result_id, result, exception=e)
+        return None, e
+
+
+def _inline_function_call(window_info, function_name, result_id, kwargs):
+    """Call a function registered with `inline=True` in the current process.
+
+    :return: the serialized message holding the result, to be sent to the calling websocket
+    """
+    result, exception = _run_function(REGISTERED_FUNCTIONS[function_name], window_info, kwargs)
+    return _function_result_message(result_id, result, exception=exception)
@@ -12,7 +12,7 @@ from django.utils.html import _js_escapes
 from django.utils.safestring import mark_safe
 # noinspection PyUnresolvedReferences
 from django.utils.six.moves.urllib.parse import urljoin
-from easydjango.websockets.wsgi_server import signer
+from easydjango.websockets.tokens import signer
 
 __author__ = 'Matthieu Gallet'
 register = template.Library()
@@ -22,8 +22,7 @@ register = template.Library()
 def init_websocket(context):
     if not context.get('ed_has_ws_topics'):
         return ''
-    ws_token = context['ed_ws_token']
-    signed_token = signer.sign(ws_token)
+    signed_token = context.get('ed_ws_signed_token') or signer.sign(context['ed_ws_token'])
     protocol = 'wss' if settings.USE_SSL else 'ws'
     site_name = '%s:%s' % (settings.SERVER_NAME, settings.SERVER_PORT)
     script = '$(document).ready(function() { $.ed._wsConnect("%s://%s%s?token=%s"); });' % \
@@ -0,0 +1,755 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+import errno
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from unittest import skipIf
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth import get_user_model
+from django.test import TestCase, RequestFactory, override_settings
+
+from easydjango import tasks
+from easydjango.decorators import function, everyone, REGISTERED_FUNCTIONS
+from easydjango.request import WindowInfo
+from easydjango.tasks import set_websocket_topics, USER
+from easydjango.utils import CallCoalescer, TTLCache
+from easydjango.websockets.backlog import get_missed_messages
+from easydjango.websockets.buffers import MessageAssembler, send_buffers
+from easydjango.websockets.compression import PerMessageDeflate
+from easydjango.websockets.dispatcher import BatchDispatcher
+from easydjango.websockets.gunicorn_runserver import WebSocket
+from easydjango.websockets.exceptions import FrameTooLargeException, SlowConsumerError
+from easydjango.websockets.keepalive import KeepaliveState
+from easydjango.websockets.masking import mask_payload
+from easydjango.websockets.outbound import OutboundQueue, COALESCE, DISCONNECT
+from easydjango.websockets.poller import Poller, selectors
+from easydjango.websockets.prepared import PreparedMessage
+from easydjango.websockets.publisher import send_messages
+from easydjango.websockets.pubsub import TopicRegistry, LocalSubscriber
+from easydjango.websockets.utf8validator import Utf8Validator, DfaUtf8Validator
+from easydjango.websockets.websocket import Stream
+from easydjango.websockets import serialization, wsgi_server
+from easydjango.websockets.serialization import encode_signal, decode_message
+from easydjango.websockets.tokens import signer, parse_websocket_token
+from easydjango.websockets.topics import serialize_topic, serialize_topics, register_topic_serializer
+from easydjango.websockets.wsgi_server import WebsocketWSGIServer, get_websocket_topics
+
+try:
+    import asyncio
+    from easydjango.websockets import asyncio_runserver
+except (ImportError, SyntaxError):  # Python 2
+    asyncio, asyncio_runserver = None, None
+
+__author__ = 'Matthieu Gallet'
+
+
+class TestTopicRegistry(TestCase):
+
+    def test_reference_count(self):
+        registry = TopicRegistry()
+        self.assertEqual(['a', 'b'], registry.add('ws1', ['a', 'b']))
+        self.assertEqual(['c'], registry.add('ws2', ['b', 'c']))
+        self.assertEqual({'ws1', 'ws2'}, set(registry.get('b')))
+        self.assertEqual(['a'], registry.remove('ws1', ['a', 'b']))
+        self.assertEqual(('ws2', ), registry.get('b'))
+        self.assertEqual(['b', 'c'], registry.remove('ws2', ['b', 'c']))
+        self.assertEqual([], registry.topics())
+
+    def test_local_subscriber(self):
+        subscriber = LocalSubscriber()
+        try:
+            subscriber.deliver('a', b'1')
+            subscriber.deliver('a', b'2')
+            self.assertEqual([b'1', b'2'], list(subscriber.pop_messages()))
+            self.assertEqual([], list(subscriber.pop_messages()))
+        finally:
+            subscriber.close()
+
+
+class TestSerializeTopic(TestCase):
+
+    def test_serialize(self):
+        class Room(object):
+            pass
+        user = get_user_model()(pk=42)
+        window_info = WindowInfo()
+        window_info.user_pk = 42
+        self.assertEqual('-s.room', serialize_topic(None, 'room'))
+        self.assertEqual('-i.3', serialize_topic(None, 3))
+        self.assertEqual(serialize_topic(None, user), serialize_topic(window_info, USER))
+        self.assertRaises(ValueError, serialize_topic, None, Room())
+        register_topic_serializer(Room)(lambda window_info_, obj: '-room')
+        self.assertEqual('-room', serialize_topic(None, Room()))
+
+    def test_serialize_many(self):
+        users = [get_user_model().objects.create(username='user%d' % i) for i in range(2)]
+        expected = [serialize_topic(None, user) for user in users]
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, serialize_topics(None, get_user_model().objects.order_by('pk')))
+        self.assertEqual(expected + ['-s.a'], serialize_topics(None, users + ['a', users[0], 'a']))
+
+
+class TestSerialization(TestCase):
+
+    def test_encode_signal(self):
+        message = encode_signal('signal.name', 'id1', {'value': 1})
+        self.assertIsInstance(message, bytes)
+        self.assertEqual({'signal': 'signal.name', 'opts': {'value': 1}, 'signal_id': 'id1'}, decode_message(message))
+
+    def test_encode_once(self):
+        encoded, published = [], []
+        encode, publish_messages = serialization._encode, tasks._publish_messages
+        serialization._encode = lambda obj: encoded.append(obj) or encode(obj)
+        tasks._publish_messages = published.extend
+        try:
+            tasks._call_ws_signals('signal.name', 'id1', ['-s.a', '-s.b', '-i.1'], {'value': 1})
+        finally:
+            serialization._encode, tasks._publish_messages = encode, publish_messages
+        self.assertEqual(1, len(encoded))
+        self.assertEqual(['ws-s.a', 'ws-s.b', 'ws-i.1'], [x[0] for x in published])
+        self.assertEqual({encode_signal('signal.name', 'id1', {'value': 1})}, {x[1] for x in published})
+
+
+class TestSendMessages(TestCase):
+
+    class FakeRedis(object):
+        def __init__(self):
+            self.calls = []
+
+        def publish(self, topic, message):
+            self.calls.append((topic, message))
+
+        def pipeline(self, transaction=True):
+            assert not transaction
+            return self
+
+        def execute(self):
+            self.calls.append('execute')
+
+    def test_single_message(self):
+        connection = self.FakeRedis()
+        send_messages(connection, [('a', b'1')])
+        self.assertEqual([('a', b'1')], connection.calls)
+
+    def test_pipeline(self):
+        connection = self.FakeRedis()
+        send_messages(connection, [('a', b'1'), ('b', b'1')])
+        self.assertEqual([('a', b'1'), ('b', b'1'), 'execute'], connection.calls)
+
+
+class TestBacklog(TestCase):
+
+    class FakeRedis(object):
+        streams = {'wsa:backlog': [[b'10-0', [b'signal_id', b'10-a', b'message', b'm1']],
+                                   [b'12-0', [b'signal_id', b'12-b', b'message', b'm2']],
+                                   [b'14-0', [b'signal_id', b'14-d', b'message', b'm4']]],
+                   'wsb:backlog': [[b'11-0', [b'signal_id', b'10-a', b'message', b'm1']],
+                                   [b'13-0', [b'signal_id', b'13-c', b'message', b'm3']],
+                                   [b'14-1', [b'signal_id', b'14-d', b'message', b'm4']]]}
+
+        def __init__(self):
+            self.results = []
+            self.starts = []
+
+        def pipeline(self, transaction=True):
+            return self
+
+        def execute_command(self, command, key, start, end):
+            self.starts.append(start)
+            entries = self.streams.get(key)
+            if entries is not None and start != '-':
+                entries = [x for x in entries if int(x[0].partition(b'-')[0]) >= int(start)]
+            self.results.append(entries)
+
+        def execute(self):
+            return self.results
+
+    def test_missed_messages(self):
+        self.assertEqual([b'm2', b'm3', b'm4'], get_missed_messages(self.FakeRedis(), ['wsa', 'wsb'], '10-a'))
+        self.assertEqual([b'm4'], get_missed_messages(self.FakeRedis(), ['wsa', 'wsb', 'wsc'], '13-c'))
+        self.assertEqual([], get_missed_messages(self.FakeRedis(), ['wsa', 'wsb'], 's0'))
+        connection = self.FakeRedis()
+        with self.settings(WS4REDIS_BACKLOG_CLOCK_SKEW=0.001):
+            self.assertEqual([b'm4'], get_missed_messages(connection, ['wsa', 'wsb'], '13-c'))
+            self.assertEqual(['12', '12'], connection.starts)
+            # signal IDs without publication time
+            connection = self.FakeRedis()
+            self.assertEqual([], get_missed_messages(connection, ['wsa'], 'e4e2a8a6-5c1f-4a41-9c6c-0b9b2f4e3b71'))
+            self.assertEqual(['-'], connection.starts)
+
+
+class TestBatchDispatcher(TestCase):
+
+    def test_dispatch(self):
+        batches = []
+        dispatcher = BatchDispatcher(lambda queue, calls: batches.append((queue, calls)), delay=0.05)
+        dispatcher.max_batch_size = 2
+        for queue, call in (('q1', 1), ('q2', 2), ('q1', 3), ('q1', 4)):
+            dispatcher.dispatch(queue, call)
+        self.assertTrue(dispatcher.flush())
+        self.assertEqual([('q1', [1, 3]), ('q1', [4]), ('q2', [2])], batches)
+
+
+class TestTTLCache(TestCase):
+
+    def test_eviction(self):
+        cache = TTLCache(ttl=60., max_size=3)
+        for key in 'abcad':
+            cache.set(key, key)
+        self.assertEqual(['c', 'a', 'd'], list(cache._values))  # 'b' is the oldest one once 'a' is set again
+        cache = TTLCache(ttl=-1.)
+        cache.set('a', 'a')
+        self.assertIsNone(cache.get('a'))
+        cache.ttl = 60.
+        cache.set('b', 'b')  # 'a' has expired
+        self.assertEqual(['b'], list(cache._values))
+
+
+class TestCallCoalescer(TestCase):
+
+    def test_concurrent_calls(self):
+        coalescer, cache = CallCoalescer(), TTLCache(ttl=60.)
+        started, release, calls, results = threading.Event(), threading.Event(), [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return len(calls)
+
+        threads = [threading.Thread(target=lambda: results.append(coalescer.call('key', compute, cache=cache)))
+                   for __ in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([1, 1, 1], results)
+        self.assertEqual(1, coalescer.call('key', compute, cache=cache))  # cached result
+        self.assertEqual(2, coalescer.call('other key', compute))
+
+    def test_dispatch_coalesced_calls(self):
+        def double(window_info, value=0):
+            return value * 2
+        function(path='test_coalesced_function', is_allowed_to=everyone, coalesce='all')(double)
+        server = WebsocketWSGIServer(redis_connection=object())
+        task_calls, published = [], []
+        apply_async, publish_messages = tasks._server_function_call.apply_async, tasks._publish_messages
+        tasks._server_function_call.apply_async = lambda args, queue=None: task_calls.append(args)
+        tasks._publish_messages = published.extend
+        try:
+            for window_key, result_id in (('w1', 'f1'), ('w2', 'f2')):
+                window_info = WindowInfo()
+                window_info.window_key = window_key
+                server.publish_message(window_info, '{"func": "test_coalesced_function", "opts": {"value": 21}, '
+                                                    '"result_id": "%s"}' % result_id)
+            self.assertEqual(1, len(task_calls))  # the second call waits for the first one
+            tasks._server_function_call(*task_calls[0])
+        finally:
+            tasks._server_function_call.apply_async, tasks._publish_messages = apply_async, publish_messages
+            del REGISTERED_FUNCTIONS['test_coalesced_function']
+        self.assertEqual([('ws-window.w1', {'result_id': 'f1', 'result': 42, 'exception': None}),
+                          ('ws-window.w2', {'result_id': 'f2', 'result': 42, 'exception': None})],
+                         [(topic, decode_message(message)) for (topic, message) in published])
+
+
+class TestMasking(TestCase):
+
+    def test_mask_payload(self):
+        mask = b'\x01\x80\xff\x00'
+        for length in (0, 1, 5, 125, 4099):
+            payload = bytes(bytearray(x % 256 for x in range(length)))
+            expected = bytes(bytearray(x ^ bytearray(mask)[i % 4] for (i, x) in enumerate(bytearray(payload))))
+            self.assertEqual(expected, mask_payload(mask, payload))
+            self.assertEqual(payload, mask_payload(mask, expected))
+
+
+class TestUtf8Validator(TestCase):
+
+    def test_fragments(self):
+        payload = 'élève ✓'.encode('utf-8')
+        for data in (payload, payload + b'\xed\xa0\x80', b'ab\xc0\xaf', b'\xf4\x90\x80\x80'):
+            for cut in range(len(data) + 1):
+                results = []
+                for validator in (DfaUtf8Validator(), Utf8Validator()):
+                    result = [validator.validate(data[:cut])]
+                    if result[0][0]:
+                        result.append(validator.validate(data[cut:]))
+                    results.append(result)
+                self.assertEqual(results[0], results[1])
+                if data == payload and hasattr(validator, 'text'):
+                    self.assertEqual('élève ✓', validator.text())
+
+
+class TestPerMessageDeflate(TestCase):
+
+    def test_negotiate(self):
+        self.assertEqual((None, None), PerMessageDeflate.negotiate('x-webkit-deflate-frame'))
+        extension, response = PerMessageDeflate.negotiate('permessage-deflate; foo=1, permessage-deflate; '
+                                                          'client_max_window_bits', server_context_takeover=False)
+        self.assertEqual('permessage-deflate; server_no_context_takeover', response)
+        self.assertFalse(extension.server_context_takeover)
+        self.assertTrue(extension.client_context_takeover)
+        extension, response = PerMessageDeflate.negotiate('permessage-deflate', server_context_takeover=False,
+                                                          client_context_takeover=False)
+        self.assertEqual('permessage-deflate; server_no_context_takeover; client_no_context_takeover', response)
+        extension.decompress(extension.compress(b'payload'))
+        self.assertIsNone(extension._compressor)
+        self.assertIsNone(extension._decompressor)
+
+    def test_round_trip(self):
+        sender = PerMessageDeflate(threshold=16)
+        receiver = PerMessageDeflate(max_size=1000)
+        self.assertFalse(sender.should_compress(b'short'))
+        for message in (b'{"signal": "hello"}' * 10, b'{"signal": "hello"}' * 20):
+            compressed = sender.compress(message)
+            self.assertFalse(compressed.endswith(b'\x00\x00\xff\xff'))
+            self.assertEqual(message, receiver.decompress(compressed))
+        self.assertRaises(FrameTooLargeException, receiver.decompress, sender.compress(b'a' * 1001))
+
+
+class TestPreparedMessage(TestCase):
+
+    def test_frame(self):
+        message = PreparedMessage('é' * 200)
+        self.assertEqual((b'\x81\x7e\x01\x90', 'é'.encode('utf-8') * 200), message.frame())
+        shared = PerMessageDeflate(server_context_takeover=False, threshold=100)
+        header, payload = message.frame(shared)
+        self.assertEqual(0xc1, bytearray(header)[0])
+        self.assertIs(payload, message.frame(PerMessageDeflate(server_context_takeover=False))[1])
+        self.assertEqual(message.header, message.frame(PerMessageDeflate(threshold=1000))[0])
+
+    def test_send_buffers(self):
+        class PartialSocket(object):
+            data = b''
+
+            def sendmsg(self, buffers):
+                self.data += buffers[0][:3].tobytes()
+                return min(3, len(buffers[0]))
+
+        sock = PartialSocket()
+        send_buffers(sock, [b'\x81\x05', b'', b'hello'])
+        self.assertEqual(b'\x81\x05hello', sock.data)
+
+
+class TestOutboundQueue(TestCase):
+
+    @staticmethod
+    def signal(name, value):
+        return PreparedMessage('{"signal": "%s", "opts": {"value": %d}}' % (name, value))
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(max_messages=2)
+        for value in range(3):
+            queue.push(self.signal('a', value))
+        self.assertEqual([1, 2], [int(x.payload[-3:-2]) for x in queue.messages])
+        written = []
+
+        def send(buffers):  # two bytes at a time
+            written.append(buffers[0][:2].tobytes())
+            return min(2, len(buffers[0]))
+
+        self.assertTrue(queue.write(send))
+        self.assertEqual(b''.join(x.header + x.payload for x in (self.signal('a', 1), self.signal('a', 2))),
+                         b''.join(written))
+        queue.push(self.signal('a', 3))
+        self.assertFalse(queue.write(lambda buffers: 0))
+        self.assertEqual(1, len(queue))
+
+    def test_coalesce(self):
+        queue = OutboundQueue(max_messages=2, policy=COALESCE)
+        for name, value in (('a', 1), ('b', 2), ('a', 3)):
+            queue.push(self.signal(name, value))
+        self.assertEqual([b'b', b'a'], [x.signal.encode('utf-8') for x in queue.messages])
+
+    def test_disconnect(self):
+        queue = OutboundQueue(max_bytes=100, policy=DISCONNECT)
+        queue.push(self.signal('a', 1))
+        self.assertRaises(SlowConsumerError, queue.push, PreparedMessage('x' * 100))
+        self.assertRaises(ValueError, OutboundQueue, policy='unknown')
+
+
+@skipIf(selectors is None, 'selectors is not available')
+class TestPoller(TestCase):
+
+    def test_select(self):
+        for max_poll_fds in (Poller.max_poll_fds, 0):  # select.poll, then selectors
+            client, server = socket.socketpair()
+            poller = Poller()
+            poller.max_poll_fds = max_poll_fds
+            try:
+                fd = server.fileno()
+                self.assertEqual(([], [fd], []), poller.select([fd], [fd], [], 0))
+                self.assertEqual(([], [], []), poller.select([fd], [], [], 0))
+                client.send(b'x')
+                self.assertEqual(([fd], [], []), poller.select([fd], [], [], 0))
+                self.assertEqual(max_poll_fds == 0, poller.selector is not None)
+                self.assertEqual(([], [], []), poller.select([], [], [], 0))
+            finally:
+                poller.close()
+                client.close()
+                server.close()
+
+
+class TestProcessRequest(TestCase):
+
+    def test_connect_pipeline(self):
+        class FakeRedis(object):
+            def __init__(self):
+                self.commands = []
+
+            def pipeline(self, transaction=True):
+                return self
+
+            def lrange(self, key, start, end):
+                self.commands.append(key)
+
+            def execute(self):
+                return [[b'ws-topic'] for __ in self.commands]
+
+        connection = FakeRedis()
+        server = WebsocketWSGIServer(redis_connection=connection)
+        user = get_user_model().objects.create(username='connected')
+        self.client.force_login(user, backend='django.contrib.auth.backends.ModelBackend')
+        factory = RequestFactory()
+        factory.cookies[settings.SESSION_COOKIE_NAME] = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        request = factory.get('/ws/', {'token': signer.sign('abc')})
+        window_info = server.process_request(request)
+        self.assertEqual(user.pk, window_info.user_pk)
+        self.assertEqual(['wsabc'], connection.commands)
+        self.assertEqual(['ws-topic'], get_websocket_topics(request, window_info))
+        self.assertEqual(['wsabc'], connection.commands)  # topics are only fetched once
+        self.client.logout()
+        self.assertIsNone(server.process_request(factory.get('/ws/', {'token': signer.sign('abc')})).user_pk)
+
+    @override_settings(WS4REDIS_TOPICS_IN_TOKEN=True)
+    def test_topics_in_token(self):
+        request = RequestFactory().get('/')
+        request.window_key = 'abc'
+        request.user = None
+        set_websocket_topics(request, 'extra')
+        ws_request = RequestFactory().get('/ws/', {'token': request.websocket_token})
+        window_info = WebsocketWSGIServer(redis_connection=object()).process_request(ws_request)
+        self.assertEqual('abc', window_info.window_key)
+        extra_topic = settings.WS4REDIS_PREFIX + serialize_topic(None, 'extra')
+        self.assertEqual(['ws-window.abc', 'ws-broadcast', extra_topic], get_websocket_topics(ws_request, window_info))
+        self.assertEqual(('abc', None), parse_websocket_token(signer.sign('abc')))
+        from_request, WindowInfo.from_request = vars(WindowInfo)['from_request'], None
+        try:  # no window info is built without extra topics
+            set_websocket_topics(request)
+        finally:
+            WindowInfo.from_request = from_request
+        self.assertEqual(('abc', []), parse_websocket_token(request.websocket_token))
+        with override_settings(WS4REDIS_TOKEN_MAX_LENGTH=10):  # too long: stored in Redis
+            request.websocket_token = None
+            set_websocket_topics(request, 'extra')
+            self.assertIsNone(request.websocket_token)
+
+    def test_publish_batch(self):
+        class Server(WebsocketWSGIServer):
+            def dispatch_message(self, window_info, unserialized_message, reply=None):
+                dispatched.append(unserialized_message)
+        dispatched = []
+        server = Server(redis_connection=object())
+        server.publish_message(None, '{"signal": "a", "opts": {}}')
+        server.publish_message(None, '[{"signal": "b", "opts": {}}, {"func": "c", "opts": {}, "result_id": "f1"}]')
+        server.publish_message(None, '[invalid')
+        self.assertEqual(['a', 'b', 'c'], [x.get('signal', x.get('func')) for x in dispatched])
+
+    def test_inline_function(self):
+        def double(window_info, value=0):
+            return value * 2
+        function(path='test_inline_function', is_allowed_to=everyone, inline=True)(double)
+        server = WebsocketWSGIServer(redis_connection=object())
+        replies = []
+        try:
+            server.publish_message(None, '{"func": "test_inline_function", "opts": {"value": 21}, "result_id": "f1"}',
+                                   reply=replies.append)
+        finally:
+            del REGISTERED_FUNCTIONS['test_inline_function']
+        self.assertEqual([{'result_id': 'f1', 'result': 42, 'exception': None}], [json.loads(x) for x in replies])
+
+    def test_get_hub(self):
+        hubs = []
+
+        def create_hub(redis_connection, poller=None):
+            time.sleep(0.01)
+            hubs.append(redis_connection)
+            return redis_connection
+        server = WebsocketWSGIServer(redis_connection=object())
+        results = []
+        redis_pubsub_hub, wsgi_server.RedisPubSubHub = wsgi_server.RedisPubSubHub, create_hub
+        try:
+            threads = [threading.Thread(target=lambda: results.append(server.get_hub())) for __ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            wsgi_server.RedisPubSubHub = redis_pubsub_hub
+        self.assertEqual(1, len(hubs))
+        self.assertEqual(hubs * 5, results)
+
+    @override_settings(WS4REDIS_ACCEPT_RATE=0.001, WS4REDIS_ACCEPT_BURST=2)
+    def test_admit_connection(self):
+        server = WebsocketWSGIServer(redis_connection=object())
+        self.assertEqual([True, True, False], [server.admit_connection() for __ in range(3)])
+
+
+class TestMessageAssembler(TestCase):
+
+    def test_assemble(self):
+        assembler = MessageAssembler(max_size=6)
+        assembler.check(3, continuation=False)
+        assembler.append(b'abc')
+        assembler.check(3)
+        assembler.append(b'def')
+        self.assertRaises(FrameTooLargeException, assembler.check, 1)
+        self.assertEqual(b'abcdef', assembler.pop())
+        assembler.check(6, continuation=False)
+        self.assertRaises(FrameTooLargeException, assembler.check, 7, continuation=False)
+
+
+class TestStream(TestCase):
+
+    class SmallStream(Stream):
+        __slots__ = ()
+        buffer_size = 8
+
+    class FakeInput(object):
+        def __init__(self, sock):
+            self._sock = sock
+            self.raw = self
+
+        def fileno(self):
+            return self._sock.fileno()
+
+    def test_read(self):
+        client, server = socket.socketpair()
+        try:
+            stream = self.SmallStream(self.FakeInput(server))
+            data = bytes(bytearray(range(64)))
+            client.sendall(data)
+            client.close()
+            self.assertEqual(data[:2], stream.read(2))
+            self.assertTrue(stream.has_buffered_data())
+            self.assertEqual(data[2:9], stream.read(7))
+            self.assertEqual(data[9:40], stream.read(31))
+            self.assertEqual(data[40:], stream.read(100))
+            self.assertFalse(stream.has_buffered_data())
+            self.assertEqual(b'', stream.read(1))
+        finally:
+            server.close()
+
+
+class TestKeepaliveState(TestCase):
+
+    def test_missed_pongs(self):
+        state = KeepaliveState()
+        start = state.last_activity
+        self.assertFalse(state.ping_due(10., now=start + 5.))
+        self.assertTrue(state.ping_due(10., now=start + 10.))
+        state.count_missed_pong()
+        payload = state.new_ping()
+        self.assertEqual(0, state.missed_pongs)
+        state.pong(payload)
+        self.assertIsNotNone(state.rtt)
+        state.new_ping()
+        state.touch()  # any received frame proves that the client is alive
+        state.count_missed_pong()
+        self.assertEqual(0, state.missed_pongs)
+        state.last_activity = state.ping_time - 1.
+        state.count_missed_pong()
+        self.assertEqual(1, state.missed_pongs)
+        self.assertTrue(state.is_dead(1))
+        self.assertFalse(state.is_dead(0))
+
+
+class TestGunicornWebSocket(TestCase):
+
+    class FakeSocket(object):
+        def __init__(self, *reads):
+            self.reads = list(reads)
+            self.sent = []
+
+        def settimeout(self, timeout):
+            pass
+
+        def setblocking(self, flag):
+            pass
+
+        def recv(self, size):
+            value = self.reads.pop(0)
+            if isinstance(value, Exception):
+                raise value
+            return value
+
+        def sendall(self, data):
+            self.sent.append(data)
+
+    @staticmethod
+    def frame(opcode, payload, fin=True, mask=b'\x01\x02\x03\x04'):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', (0x80 if fin else 0) | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('>BBH', (0x80 if fin else 0) | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('>BBQ', (0x80 if fin else 0) | opcode, 0x80 | 127, length)
+        return header + mask + mask_payload(mask, payload)
+
+    def parse(self, websocket, data):
+        websocket._buf += data
+        return websocket._parse_messages()
+
+    def test_parse_messages(self):
+        sock = self.FakeSocket()
+        websocket = WebSocket(sock, {}, version='13')
+        # pipelined frames
+        self.assertEqual([b'a', b'bc'], self.parse(websocket, self.frame(0x1, b'a') + self.frame(0x1, b'bc')))
+        # fragmented message, with control frames between its fragments
+        data = self.frame(0x1, b'fr', fin=False) + self.frame(0x9, b'p') + self.frame(0x0, b'ag', fin=False) + \
+            self.frame(0xA, b'') + self.frame(0x0, b'ment')
+        self.assertEqual([b'fragment'], self.parse(websocket, data))
+        self.assertEqual([b'\x8a\x01p'], sock.sent)  # the ping is answered immediately
+        # frame split across reads, with a masked payload above 64 KiB
+        payload = bytes(bytearray(x % 251 for x in range(70000)))
+        data = self.frame(0x2, payload)
+        self.assertEqual([], self.parse(websocket, data[:5]))
+        self.assertEqual([], self.parse(websocket, data[5:40000]))
+        self.assertEqual([payload, b'end'], self.parse(websocket, data[40000:] + self.frame(0x1, b'end')))
+        self.assertEqual(0, len(websocket._buf))
+
+    def test_receive_lone_pong(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('easydjango.websocket')
+        logger.addHandler(handler)
+        disabled, logger.disabled = logger.disabled, False
+        try:
+            sock = self.FakeSocket(self.frame(0xA, b''), socket.error(errno.EAGAIN, 'Resource temporarily unavailable'))
+            websocket = WebSocket(sock, {}, version='13')
+            self.assertIsNone(websocket.receive())
+            self.assertFalse(websocket.closed)
+        finally:
+            logger.removeHandler(handler)
+            logger.disabled = disabled
+        self.assertEqual([], [x for x in records if x.levelno >= logging.ERROR])
+
+
+@skipIf(asyncio_runserver is None, 'asyncio is not available')
+class TestAsyncioServer(TestCase):
+
+    class FakeTransport(object):
+        def __init__(self):
+            self.closing = False
+
+        def is_closing(self):
+            return self.closing
+
+        def get_write_buffer_size(self):
+            return 0
+
+        def get_write_buffer_limits(self):
+            return 0, 65536
+
+        def abort(self):
+            self.closing = True
+
+    class FakeWriter(object):
+        def __init__(self):
+            self.transport = TestAsyncioServer.FakeTransport()
+            self.data = bytearray()
+            self.sock = socket.socket()
+
+        def get_extra_info(self, name):
+            return {'socket': self.sock, 'sockname': ('127.0.0.1', 8000), 'peername': ('127.0.0.1', 9000)}[name]
+
+        def write(self, data):
+            self.data += data
+
+        def writelines(self, buffers):
+            for data in buffers:
+                self.data += data
+
+        def close(self):
+            self.transport.closing = True
+            self.sock.close()
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = asyncio_runserver.AsyncioWebsocketServer(loop=self.loop, redis_connection=object())
+        self.writer = self.FakeWriter()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.close()
+        self.writer.close()
+
+    def reader(self, data):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader
+
+    def test_handshake(self):
+        reader = self.reader(b'GET /ws/?token=abc HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                             b'Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                             b'Sec-WebSocket-Version: 13\r\n\r\n')
+        environ = self.loop.run_until_complete(self.server.read_environ(reader, self.writer))
+        self.assertEqual('/ws/', environ['PATH_INFO'])
+        self.assertEqual('token=abc', environ['QUERY_STRING'])
+        self.server.assure_protocol_requirements(environ)
+        self.server.accept_websocket(environ, reader, self.writer)
+        self.assertTrue(self.writer.data.startswith(b'HTTP/1.1 101 Switching Protocols\r\n'))
+        self.assertIn(b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n', self.writer.data)
+
+    def test_run_in_executor(self):
+        calls = []
+        close_old_connections = asyncio_runserver.close_old_connections
+        asyncio_runserver.close_old_connections = lambda: calls.append('close')
+        try:
+            result = self.loop.run_until_complete(self.server.run_in_executor(lambda x: calls.append(x) or x, 42))
+        finally:
+            asyncio_runserver.close_old_connections = close_old_connections
+        self.assertEqual(42, result)
+        self.assertEqual(['close', 42, 'close'], calls)
+
+    def test_read_frames(self):
+        frame = TestGunicornWebSocket.frame
+        reader = self.reader(frame(0x1, b'Hel', fin=False) + frame(0x9, b'ping') + frame(0x0, b'lo') +
+                             frame(0x8, struct.pack('!H', 1000)))
+        websocket = asyncio_runserver.AsyncWebSocket(reader, self.writer)
+        self.assertEqual('Hello', self.loop.run_until_complete(websocket.receive()))
+        self.assertEqual(b'\x8a\x04ping', bytes(self.writer.data))  # pong sent between the two fragments
+        self.assertIsNone(self.loop.run_until_complete(websocket.receive()))
+        self.assertTrue(websocket.closed)
+        self.assertEqual(b'\x88\x02\x03\xe8', bytes(self.writer.data[6:]))  # close frame sent back
+
+    def test_redis_dispatch(self):
+        subscriber = self.server.subscriber
+        websocket = asyncio_runserver.AsyncWebSocket(self.reader(b''), self.writer)
+        websocket.outbound = self.server.create_outbound_queue()
+        subscriber.subscribe(websocket, ['ws-topic'])
+        subscriber.reader = self.reader(b'*3\r\n$7\r\nmessage\r\n$8\r\nws-topic\r\n$5\r\nhello\r\n')
+        reply = self.loop.run_until_complete(subscriber.read_reply())
+        self.assertEqual([b'message', b'ws-topic', b'hello'], reply)
+        subscriber.dispatch(reply[1].decode('utf-8'), reply[2])
+        subscriber.dispatch('ws-other', b'ignored')
+        self.assertEqual(b'\x81\x05hello', bytes(self.writer.data))
+        subscriber.unsubscribe(websocket, ['ws-topic'])
+        self.assertFalse(subscriber.registry.get('ws-topic'))
+
+    def test_unsupported_redis_options(self):
+        self.assertRaises(ImproperlyConfigured, asyncio_runserver.AsyncRedisSubscriber, {'host': 'x', 'ssl': True})
@@ -6,7 +6,9 @@ import os
 import sys
 
 import pkg_resources
+import threading
 import time
+from collections import OrderedDict
 from django.core.management import color_style
 from django.utils import six
 from django.utils.log import AdminEmailHandler as BaseAdminEmailHandler
@@ -248,3 +250,133 @@ else:
             name = _resolve_name(name[level:], package, level)
         __import__(name)
         return sys.modules[name]
+
+
+class TTLCache(object):
+    """Thread-safe in-memory cache, whose values expire after `ttl` seconds.
+
+    All values have the same lifetime, so the insertion order is also the expiry order: expired values are removed from
+    the head of an ordered dict when a value is set, then the oldest ones when `max_size` values are stored.
+
+    >>> cache = TTLCache(ttl=10.)
+    >>> cache.set('key', 42)
+    >>> cache.get('key')
+    42
+    >>> cache.get('other key', 0)
+    0
+    """
+    _missing = object()
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        value, expiry = self._values.get(key, (self._missing, 0))
+        if value is self._missing or expiry < time.time():
+            return default
+        return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            values = self._values
+            values.pop(key, None)  # a new expiry: the key is moved to the end
+            while values and (len(values) >= self.max_size or next(six.itervalues(values))[1] < now):
+                values.popitem(last=False)
+            values[key] = (value, now + self.ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket: `rate` tokens are added per second, up to `capacity` tokens.
+
+    >>> bucket = TokenBucket(rate=1., capacity=2)
+    >>> [bucket.consume() for __ in range(3)]
+    [True, True, False]
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(capacity or rate, 1)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Remove `tokens` tokens from the bucket.
+
+        :return: `False` if there are not enough available tokens (and nothing is removed)
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+
+class CallCoalescer(object):
+    """Run only once the identical calls made at the same time by several threads.
+
+    >>> coalescer = CallCoalescer()
+    >>> coalescer.call('key', lambda: 42)
+    42
+    """
+
+    class PendingCall(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.exception = None
+
+    _missing = object()
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, fn, cache=None):
+        """Call `fn()`, or wait for the result of the running call with the same `key`.
+
+        :param key: hashable identifier of the call
+        :param fn: callable without argument
+        :param cache: :class:`TTLCache` storing the results (exceptions are never cached)
+        """
+        if cache is not None:
+            result = cache.get(key, self._missing)
+            if result is not self._missing:
+                return result
+        with self._lock:
+            pending = self._calls.get(key)
+            is_running = pending is not None
+            if not is_running:
+                pending = self._calls[key] = self.PendingCall()
+        if is_running:
+            pending.event.wait()
+            if pending.exception is not None:
+                raise pending.exception
+            return pending.result
+        try:
+            pending.result = fn()
+            if cache is not None:
+                cache.set(key, pending.result)
+        except Exception as e:
+            pending.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            pending.event.set()
+        return pending.result
@@ -17,9 +17,10 @@ from easydjango.tasks import set_websocket_topics
 
 __author__ = 'Matthieu Gallet'
 
-validate_form(form_cls=UserCreationForm, path='easydjango_validate_user_creation', is_allowed_to=everyone)
+validate_form(form_cls=UserCreationForm, path='easydjango_validate_user_creation', is_allowed_to=everyone,
+              inline=True)
 validate_form(form_cls=PasswordResetForm,
-              path='easydjango_validate_password_reset', is_allowed_to=everyone)
+              path='easydjango_validate_password_reset', is_allowed_to=everyone, inline=True)
 
 
 class LoginView(TemplateView):
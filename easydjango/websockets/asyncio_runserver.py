@@ -0,0 +1,617 @@
+# -*- coding: utf-8 -*-
+"""Websocket server based on asyncio
+=================================
+
+All websockets of a process are handled by a single event loop: frames are read and written without blocking
+any thread, and all websockets share a single Redis connection for their subscriptions.
+Blocking calls (session and user loading, Celery calls) are run in a small thread pool.
+
+Requires Python 3.5+. Start it with the `runserver_asyncio` management command.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import asyncio
+import base64
+import functools
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from io import BytesIO
+from urllib.parse import unquote
+
+from django import http
+from django.conf import settings
+from django.core.exceptions import PermissionDenied, ImproperlyConfigured
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections, close_old_connections
+from django.utils.encoding import force_bytes
+# noinspection PyUnresolvedReferences
+from django.utils.six.moves import http_client
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
+
+from easydjango.websockets.buffers import MessageAssembler
+from easydjango.websockets.exceptions import WebSocketError, HandshakeError, UpgradeRequiredError, \
+    FrameTooLargeException, SlowConsumerError
+from easydjango.websockets.keepalive import KeepaliveState
+from easydjango.websockets.prepared import PreparedMessage
+from easydjango.websockets.pubsub import TopicRegistry
+from easydjango.websockets.utf8validator import Utf8Validator
+from easydjango.websockets.websocket import WebSocket, Header
+from easydjango.websockets.wsgi_server import WebsocketWSGIServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__author__ = 'Matthieu Gallet'
+
+logger = logging.getLogger('django.request')
+
+
+class AsyncStream(object):
+    """Provide the `write` and `fileno` attributes expected by :class:`WebSocket` on top of an asyncio stream.
+    Writes are never blocking: data are buffered by the transport."""
+
+    __slots__ = ('writer', 'fileno')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.fileno = writer.get_extra_info('socket').fileno()
+
+    def write(self, data):
+        if self.writer.transport.is_closing():
+            raise socket.error('Socket is closed')
+        self.writer.write(data)
+
+    def writelines(self, buffers):
+        if self.writer.transport.is_closing():
+            raise socket.error('Socket is closed')
+        self.writer.writelines(buffers)
+
+    def send_nowait(self, buffers):
+        """Write whole frames, unless the transport buffer is above its high-water mark"""
+        transport = self.writer.transport
+        if transport.is_closing():
+            raise socket.error('Socket is closed')
+        if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]:
+            return 0
+        self.writer.writelines(buffers)
+        return sum(len(x) for x in buffers)
+
+
+class AsyncWebSocket(WebSocket):
+    __slots__ = ('reader', 'writer', '_drain_task')
+
+    # noinspection PyMissingConstructor
+    def __init__(self, reader, writer, max_message_size=None, compression=None):
+        self._closed = False
+        self.reader = reader
+        self.writer = writer
+        self.stream = AsyncStream(writer)
+        self.utf8validator = Utf8Validator()
+        self.utf8validate_last = None
+        self.assembler = MessageAssembler(max_message_size)
+        self.keepalive = KeepaliveState()
+        self.compression = compression
+        self.outbound = None
+        self._drain_task = None
+
+    def write_outbound(self):
+        """Write the queued messages to the transport; the remaining ones are written when it is drained."""
+        done = super(AsyncWebSocket, self).write_outbound()
+        if not done and self._drain_task is None:
+            self._drain_task = asyncio.ensure_future(self.drain_outbound())
+        return done
+
+    async def drain_outbound(self):
+        try:
+            done = False
+            while not done and not self._closed:
+                await self.writer.drain()
+                done = super(AsyncWebSocket, self).write_outbound()
+        except (WebSocketError, ConnectionError):
+            pass
+        finally:
+            self._drain_task = None
+
+    async def read_frame(self):
+        """
+        Wait for a full frame, without blocking the event loop.
+
+        :return: The header and payload as a tuple.
+        """
+        read = self.reader.readexactly
+        header, has_mask = Header.decode_first_bytes(await read(2))
+        if header.length == 126:
+            header.length = struct.unpack('!H', await read(2))[0]
+        elif header.length == 127:
+            header.length = struct.unpack('!Q', await read(8))[0]
+        if has_mask:
+            header.mask = await read(4)
+        self.check_frame_flags(header)
+        self.check_frame_size(header)
+        if not header.length:
+            self.keepalive.touch()
+            return header, b''
+        payload = await read(header.length)
+        if header.mask:
+            payload = header.unmask_payload(payload)
+        self.keepalive.touch()
+        return header, payload
+
+    async def read_message(self):
+        """
+        Return the next text or binary message from the socket.
+        """
+        opcode = None
+        compressed = False
+        self.assembler.reset()
+        while True:
+            header, payload = await self.read_frame()
+            f_opcode = header.opcode
+            if f_opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+                if opcode:
+                    raise WebSocketError("The opcode in non-fin frame is "
+                                         "expected to be zero, got {0!r}".format(f_opcode))
+                self.utf8validator.reset()
+                self.utf8validate_last = (True, True, 0, 0)
+                opcode = f_opcode
+                compressed = bool(header.flags)
+            elif f_opcode == self.OPCODE_CONTINUATION:
+                if not opcode:
+                    raise WebSocketError("Unexpected frame with opcode=0")
+            elif f_opcode == self.OPCODE_PING:
+                self.handle_ping(header, payload)
+                continue
+            elif f_opcode == self.OPCODE_PONG:
+                self.handle_pong(header, payload)
+                continue
+            elif f_opcode == self.OPCODE_CLOSE:
+                self.handle_close(header, payload)
+                return
+            else:
+                raise WebSocketError("Unexpected opcode={0!r}".format(f_opcode))
+            if opcode == self.OPCODE_TEXT and payload and not compressed:
+                self.validate_utf8(payload)
+            self.assembler.append(payload)
+            if header.fin:
+                break
+        return self.decode_message(opcode, self.assembler.pop(), compressed)
+
+    async def receive(self):
+        """
+        Read and return a message from the stream. If `None` is returned, then
+        the socket is considered closed/errored.
+        """
+        if self._closed:
+            raise WebSocketError("Connection is already closed")
+        try:
+            message = await self.read_message()
+        except UnicodeError as e:
+            logger.info('websocket.receive: UnicodeError {}'.format(e))
+            self.close(1007)
+            return None
+        except FrameTooLargeException as e:
+            logger.info('websocket.receive: FrameTooLargeException {}'.format(e))
+            self.close(1009)
+            return None
+        except WebSocketError as e:
+            logger.info('websocket.receive: WebSocketError {}'.format(e))
+            self.close(1002)
+            return None
+        except (EOFError, ConnectionError) as e:
+            logger.debug('websocket.receive: connection lost {}'.format(e))
+            self.close(1006)
+            return None
+        return message
+
+    def close(self, code=1000, message=''):
+        writer = self.writer
+        super(AsyncWebSocket, self).close(code=code, message=message)
+        writer.close()
+
+    def abort(self, code=1008):
+        """Close the connection, discarding the data that are not sent yet."""
+        if self._closed:
+            return
+        if self.outbound is not None:
+            self.outbound.clear()
+        self._closed = True
+        self.stream = None
+        self.writer.transport.abort()
+
+
+class AsyncRedisSubscriber(object):
+    """Single Redis pub/sub connection, shared by all websockets of the event loop.
+
+    Only speaks the few commands required by pub/sub (AUTH, SUBSCRIBE, UNSUBSCRIBE), so it does not block
+    the event loop. Topics are subscribed when the first websocket needs them, and unsubscribed when the
+    last one leaves.
+    """
+    reconnect_delay = 1.0
+    # pub/sub channels are shared by all databases of a Redis server, so `db` is accepted but not used
+    supported_options = {'host', 'port', 'db', 'password', 'unix_socket_path'}
+
+    def __init__(self, connection_kwargs):
+        unsupported_options = sorted(x for (x, y) in connection_kwargs.items()
+                                     if x not in self.supported_options and y not in (None, False))
+        if unsupported_options:
+            raise ImproperlyConfigured('Unsupported WS4REDIS_CONNECTION options for the asyncio server: %s' %
+                                       ', '.join(unsupported_options))
+        self.connection_kwargs = connection_kwargs
+        self.reader = None
+        self.writer = None
+        self.registry = TopicRegistry()
+
+    def subscribe(self, websocket, topics):
+        new_topics = self.registry.add(websocket, topics)
+        if new_topics:
+            self.send_command('SUBSCRIBE', *new_topics)
+
+    def unsubscribe(self, websocket, topics):
+        old_topics = self.registry.remove(websocket, topics)
+        if old_topics:
+            self.send_command('UNSUBSCRIBE', *old_topics)
+
+    def dispatch(self, topic, message):
+        message = PreparedMessage(message)
+        for websocket in self.registry.get(topic):
+            try:
+                websocket.outbound.push(message)
+                websocket.write_outbound()
+            except SlowConsumerError as e:
+                logger.warning('Disconnecting slow websocket client: %s' % e)
+                websocket.abort()
+            except WebSocketError:
+                pass
+
+    @staticmethod
+    def encode_command(*args):
+        values = [force_bytes(x) for x in args]
+        chunks = [b'*' + force_bytes(len(values)) + b'\r\n']
+        for value in values:
+            chunks += [b'$' + force_bytes(len(value)) + b'\r\n', value, b'\r\n']
+        return b''.join(chunks)
+
+    def send_command(self, *args):
+        if self.writer is None:
+            # all topics are subscribed when the connection is (re)established
+            return
+        self.writer.write(self.encode_command(*args))
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise RedisConnectionError('Connection closed by server.')
+        prefix, value = line[:1], line[1:-2]
+        if prefix == b'+':
+            return value
+        elif prefix == b'-':
+            raise ResponseError(value.decode('utf-8'))
+        elif prefix == b':':
+            return int(value)
+        elif prefix == b'$':
+            length = int(value)
+            if length == -1:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2]
+        elif prefix == b'*':
+            length = int(value)
+            if length == -1:
+                return None
+            result = []
+            for __ in range(length):
+                result.append(await self.read_reply())
+            return result
+        raise RedisConnectionError('Protocol Error: %r' % line)
+
+    async def connect(self):
+        unix_socket_path = self.connection_kwargs.get('unix_socket_path')
+        if unix_socket_path:
+            host, port = unix_socket_path, ''
+            self.reader, writer = await asyncio.open_unix_connection(unix_socket_path)
+        else:
+            host = self.connection_kwargs.get('host') or 'localhost'
+            port = self.connection_kwargs.get('port') or 6379
+            self.reader, writer = await asyncio.open_connection(host, port)
+        password = self.connection_kwargs.get('password')
+        if password:
+            writer.write(self.encode_command('AUTH', password))
+            await self.read_reply()
+        self.writer = writer
+        topics = self.registry.topics()
+        if topics:
+            self.send_command('SUBSCRIBE', *topics)
+        logger.info('Connected to Redis %s:%s' % (host, port))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.connect()
+                while True:
+                    reply = await self.read_reply()
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b'message':
+                        self.dispatch(reply[1].decode('utf-8'), reply[2])
+            except (OSError, EOFError, RedisConnectionError, ResponseError) as e:
+                logger.warning('Redis subscriber error: %s' % e)
+            self.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+
+def _call_with_fresh_connections(function, args):
+    close_old_connections()
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+class AsyncioWebsocketServer(WebsocketWSGIServer):
+    WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+    WS_VERSIONS = ('13', '8', '7')
+    max_header_count = 100
+
+    def __init__(self, loop=None, redis_connection=None):
+        super(AsyncioWebsocketServer, self).__init__(redis_connection=redis_connection)
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=settings.WS4REDIS_THREAD_COUNT)
+        self.subscriber = AsyncRedisSubscriber(settings.WS4REDIS_CONNECTION)
+        self.websockets = set()
+        self.tasks = []
+
+    async def start(self, host=None, port=None, sock=None):
+        self.tasks = [self.loop.create_task(self.subscriber.run()), self.loop.create_task(self.send_heartbeats())]
+        for task in self.tasks:
+            task.add_done_callback(self.log_task_error)
+        return await asyncio.start_server(self.handle_connection, host=host, port=port, sock=sock)
+
+    async def stop(self):
+        """Cancel the background tasks started by :meth:`start` and close the Redis connection."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.subscriber.close()
+        self.executor.shutdown(wait=False)
+
+    def run_in_executor(self, function, *args):
+        """Call `function(*args)` in a thread of the executor, like a Django request: database connections that are
+        unusable or older than `CONN_MAX_AGE` are closed before and after the call, since nothing sends the
+        `request_started` and `request_finished` signals in these long-lived threads."""
+        return self.loop.run_in_executor(self.executor, _call_with_fresh_connections, function, args)
+
+    @staticmethod
+    def log_task_error(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Websocket server task failed: %s' % task.exception(), exc_info=task.exception())
+
+    async def read_environ(self, reader, writer):
+        """Read the HTTP request and build the corresponding WSGI environ.
+
+        :return: a `dict`, or `None` if the client closed the connection before sending its request
+        """
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, path, protocol = request_line.decode('latin-1').strip().split(' ', 2)
+        except ValueError:
+            raise HandshakeError('Invalid request line: %r' % request_line)
+        path_info, __, query_string = path.partition('?')
+        server_name, server_port = writer.get_extra_info('sockname')[:2]
+        peer = writer.get_extra_info('peername')
+        environ = {'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': unquote(path_info, 'latin-1'),
+                   'QUERY_STRING': query_string, 'SERVER_PROTOCOL': protocol,
+                   'SERVER_NAME': server_name, 'SERVER_PORT': str(server_port),
+                   'REMOTE_ADDR': peer[0] if peer else '',
+                   'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(),
+                   'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': True,
+                   'wsgi.run_once': False}
+        for __ in range(self.max_header_count):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, sep, value = line.decode('latin-1').partition(':')
+            if not sep:
+                raise HandshakeError('Invalid header: %r' % line)
+            key = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if key in environ:
+                value = '%s,%s' % (environ[key], value)
+            environ[key] = value
+        else:
+            raise HandshakeError('Too many headers')
+        return environ
+
+    def accept_websocket(self, environ, reader, writer):
+        websocket_version = environ.get('HTTP_SEC_WEBSOCKET_VERSION', '')
+        if not websocket_version:
+            raise UpgradeRequiredError
+        elif websocket_version not in self.WS_VERSIONS:
+            raise HandshakeError('Unsupported WebSocket Version: {0}'.format(websocket_version))
+        key = environ.get('HTTP_SEC_WEBSOCKET_KEY', '').strip()
+        if not key:
+            raise HandshakeError('Sec-WebSocket-Key header is missing/empty')
+        try:
+            key_len = len(base64.b64decode(key))
+        except ValueError:
+            raise HandshakeError('Invalid key: {0}'.format(key))
+        if key_len != 16:
+            raise HandshakeError('Invalid key: {0}'.format(key))
+        sec_ws_accept = base64.b64encode(sha1(key.encode('ascii') + self.WS_GUID).digest()).decode('ascii')
+        compression, extensions = self.negotiate_compression(environ)
+        if extensions:
+            extensions = 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\n'
+                      'Connection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: %s\r\n'
+                      '%s'
+                      'Sec-WebSocket-Version: %s\r\n\r\n' % (sec_ws_accept, extensions or '', websocket_version)
+                      ).encode('latin-1'))
+        return AsyncWebSocket(reader, writer, max_message_size=settings.WS4REDIS_MAX_MESSAGE_SIZE,
+                              compression=compression)
+
+    @staticmethod
+    def write_response(writer, response):
+        status_text = http_client.responses.get(response.status_code, 'UNKNOWN STATUS CODE')
+        content = response.content
+        writer.write(('HTTP/1.1 %d %s\r\n'
+                      'Content-Type: text/plain; charset=utf-8\r\n'
+                      'Content-Length: %d\r\n'
+                      'Connection: close\r\n\r\n' % (response.status_code, status_text, len(content)))
+                     .encode('latin-1') + content)
+
+    async def handle_connection(self, reader, writer):
+        websocket = None
+        response = None
+        try:
+            environ = await self.read_environ(reader, writer)
+            if environ is None:
+                writer.close()
+                return
+            if not environ['PATH_INFO'].startswith(settings.WEBSOCKET_URL):
+                raise http.Http404
+            self.assure_protocol_requirements(environ)
+            if not self.admit_connection():
+                websocket = self.accept_websocket(environ, reader, writer)
+                self.reject_websocket(websocket)
+                return
+            request = WSGIRequest(environ)
+            window_info = await self.run_in_executor(self.process_request, request)
+            channels, echo_message = await self.run_in_executor(self.process_subscriptions, request, window_info)
+            websocket = self.accept_websocket(environ, reader, writer)
+            await self.process_websocket(window_info, websocket, channels,
+                                         last_signal_id=request.GET.get('last_signal_id'))
+        except http.Http404:
+            response = http.HttpResponseNotFound(content='Not Found')
+        except UpgradeRequiredError:
+            logger.info('Websocket upgrade required')
+            response = http.HttpResponseBadRequest(status=426, content='Upgrade Required')
+        except HandshakeError as excpt:
+            logger.warning('HandshakeError: {}'.format(excpt))
+            response = http.HttpResponseBadRequest(content=excpt)
+        except PermissionDenied as excpt:
+            logger.warning('PermissionDenied: {}'.format(excpt))
+            response = http.HttpResponseForbidden(content=excpt)
+        except (EOFError, ConnectionError) as excpt:
+            logger.debug('Connection lost: {}'.format(excpt))
+        except Exception as excpt:
+            logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+            response = http.HttpResponseServerError(content=excpt)
+        finally:
+            if websocket is not None:
+                if not websocket.closed:
+                    websocket.close(code=1001, message='Websocket Closed')
+            elif response is not None and not writer.transport.is_closing():
+                self.write_response(writer, response)
+                writer.close()
+
+    async def process_websocket(self, window_info, websocket, channels, last_signal_id=None):
+        websocket.outbound = self.create_outbound_queue()
+        self.websockets.add(websocket)
+        self.subscriber.subscribe(websocket, channels)
+        logger.debug('Subscribed to channels: {0}'.format(', '.join(map(repr, channels))))
+        try:
+            if last_signal_id:
+                messages = await self.run_in_executor(self.get_missed_messages, channels, last_signal_id)
+                for message in messages:
+                    websocket.outbound.push(message)
+                websocket.write_outbound()
+            while not websocket.closed:
+                message = await websocket.receive()
+                if message:
+                    await self.run_in_executor(self.publish_message, window_info, message,
+                                               functools.partial(self.reply_threadsafe, websocket))
+        except SlowConsumerError as e:
+            logger.warning('Disconnecting slow websocket client: %s' % e)
+            websocket.abort()
+        finally:
+            self.subscriber.unsubscribe(websocket, channels)
+            self.websockets.discard(websocket)
+            websocket.outbound.clear()
+
+    def reply_threadsafe(self, websocket, payload):
+        """Send the result of an inline function, computed by a thread of the executor, to its websocket"""
+        self.loop.call_soon_threadsafe(self.reply, websocket, payload)
+
+    @staticmethod
+    def reply(websocket, payload):
+        if websocket.closed:
+            return
+        try:
+            websocket.outbound.push(PreparedMessage(payload))
+            websocket.write_outbound()
+        except SlowConsumerError as e:
+            logger.warning('Disconnecting slow websocket client: %s' % e)
+            websocket.abort()
+        except WebSocketError:
+            pass
+
+    async def send_heartbeats(self):
+        """Send a ping frame to all websockets without any activity since the last check and close the dead ones.
+
+        The text heartbeat message is only sent if pings are disabled (`settings.WS4REDIS_PING_INTERVAL = 0`).
+        """
+        while True:
+            interval = self.heartbeat_interval
+            if settings.WS4REDIS_PING_INTERVAL:
+                interval = min(interval, settings.WS4REDIS_PING_INTERVAL)
+            await asyncio.sleep(interval)
+            now = time.time()
+            for websocket in list(self.websockets):
+                if websocket.closed:
+                    continue
+                try:
+                    self.send_keepalive(websocket, timed_out=True, now=now)
+                except WebSocketError:
+                    pass
+
+
+def run(host, port, workers=1, backlog=1024):
+    """Listen on the given address and serve websockets from `workers` processes,
+    each of them running its own event loop."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    if resource is not None:
+        # each idle websocket only costs a file descriptor
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit < hard_limit:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+    # do not share database connections between processes
+    connections.close_all()
+    for __ in range(workers - 1):
+        if os.fork() == 0:
+            break
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = AsyncioWebsocketServer(loop=loop)
+    listener = loop.run_until_complete(server.start(sock=sock))
+    logger.info('Websocket server listening on %s:%s (pid %s)' % (host, port, os.getpid()))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(server.stop())
+        loop.close()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Replay the messages missed by reconnecting windows
+==================================================
+
+When `settings.WS4REDIS_BACKLOG_SIZE` is not 0, each signal published to a topic is also appended to a Redis stream
+(`<topic>:backlog`), trimmed to about `WS4REDIS_BACKLOG_SIZE` entries and expiring `WS4REDIS_BACKLOG_TTL` seconds after
+its last message.
+A reconnecting window sends the ID of the last signal it received, and the signals published since then to its topics
+are read from these streams (with a single pipelined `XRANGE` per topic) and sent before the new ones.
+Signals may be sent twice around the reconnection, but the JavaScript client ignores already received signal IDs.
+
+Signal IDs start with their publication time in milliseconds (see :func:`new_signal_id`), like the IDs of stream
+entries, so only the entries added since `WS4REDIS_BACKLOG_CLOCK_SKEW` seconds before this time are read.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import time
+import uuid
+
+from django.conf import settings
+
+__author__ = 'Matthieu Gallet'
+
+
+def backlog_key(topic):
+    """Name of the Redis stream storing the last messages of a topic"""
+    return '%s:backlog' % topic
+
+
+def new_signal_id():
+    """Return a new unique signal ID: `<publication time in milliseconds>-<random hexadecimal string>`"""
+    return '%d-%s' % (time.time() * 1000, uuid.uuid4().hex)
+
+
+def _range_start(signal_id):
+    """Return the first stream entry ID that may have been added after the signal `signal_id`.
+
+    Stream entry IDs are given by the clock of Redis and signal IDs by the one of the publisher, so a margin of
+    `settings.WS4REDIS_BACKLOG_CLOCK_SKEW` seconds is kept. The whole streams are read for other signal IDs.
+    """
+    timestamp, sep, random_part = signal_id.partition('-')
+    if not (timestamp.isdigit() and random_part and '-' not in random_part):
+        return '-'
+    return '%d' % max(int(timestamp) - int(settings.WS4REDIS_BACKLOG_CLOCK_SKEW * 1000), 0)
+
+
+def add_to_backlog(pipe, topic, message, signal_id):
+    """Append the `XADD` and `EXPIRE` commands required to store a message to a Redis pipeline.
+
+    :param pipe: a :class:`redis.client.StrictPipeline`
+    :param topic: the topic the message is published to
+    :param message: the message, encoded as bytes
+    :param signal_id: the unique ID of the signal
+    """
+    key = backlog_key(topic)
+    # entries of different streams are ordered by the millisecond of their ID, then by their publication time
+    pipe.execute_command('XADD', key, 'MAXLEN', '~', settings.WS4REDIS_BACKLOG_SIZE, '*',
+                         'signal_id', signal_id, 'time', '%.6f' % time.time(), 'message', message)
+    pipe.expire(key, settings.WS4REDIS_BACKLOG_TTL)
+
+
+def _sort_key(entry_id, fields):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('ascii')
+    timestamp, __, sequence = entry_id.partition('-')
+    return int(timestamp), float(fields.get(b'time') or 0), int(sequence or 0)
+
+
+def get_missed_messages(connection, topics, last_signal_id):
+    """Return the messages published to `topics` after the signal `last_signal_id`, in publication order.
+
+    Nothing is returned when `last_signal_id` is not in the backlogs anymore (it is too old or it has expired), or
+    when the clocks of its publisher and of Redis differ by more than `settings.WS4REDIS_BACKLOG_CLOCK_SKEW` seconds.
+
+    :param connection: a :class:`redis.StrictRedis` connection
+    :param topics: list of topics
+    :param last_signal_id: ID of the last signal received by the window
+    :return: list of messages (as bytes)
+    """
+    if isinstance(last_signal_id, bytes):
+        last_signal_id = last_signal_id.decode('utf-8')
+    start = _range_start(last_signal_id)
+    last_signal_id = last_signal_id.encode('utf-8')
+    pipe = connection.pipeline(transaction=False)
+    for topic in topics:
+        pipe.execute_command('XRANGE', backlog_key(topic), start, '+')
+    entries = []
+    for result in pipe.execute():
+        for entry_id, fields in result or []:
+            if not isinstance(fields, dict):
+                fields = dict(zip(fields[::2], fields[1::2]))
+            entries.append((_sort_key(entry_id, fields), fields.get(b'signal_id'), fields.get(b'message')))
+    # the same signal may be stored in several topics: its first copy is used as reference
+    last_keys = [key for (key, signal_id, message) in entries if signal_id == last_signal_id]
+    if not last_keys:
+        return []
+    start = min(last_keys)
+    entries.sort(key=lambda x: x[0])
+    sent_signal_ids = {last_signal_id}
+    messages = []
+    for key, signal_id, message in entries:
+        if key <= start or signal_id in sent_signal_ids or message is None:
+            continue
+        sent_signal_ids.add(signal_id)
+        messages.append(message)
+    return messages
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Process items by batches in a background thread
+===============================================
+
+:class:`BackgroundBatcher` is the common base of :class:`easydjango.websockets.publisher.BackgroundPublisher` (messages
+published to Redis) and of :class:`easydjango.websockets.dispatcher.BatchDispatcher` (signals sent to Celery): callers
+only append items to a queue and never wait, and a daemon thread processes everything that is pending at once.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+import threading
+import time
+from collections import deque
+
+__author__ = 'Matthieu Gallet'
+
+logger = logging.getLogger('easydjango.websockets')
+
+
+class BackgroundBatcher(object):
+    """Process queued items by batches from a daemon thread, started with the first item.
+
+    Subclasses implement :meth:`process_batch`. Errors are only logged, since the callers are already gone.
+
+    :param delay: time (in seconds) spent waiting for other items after the first one
+    """
+    thread_name = 'easydjango-batcher'
+
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.pending = 0
+        self._thread = None
+
+    def add(self, items):
+        """Queue items, processed with the next batch"""
+        with self.condition:
+            self.items.extend(items)
+            self.pending += len(items)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name=self.thread_name)
+                self._thread.daemon = True
+                self._thread.start()
+            self.condition.notify_all()
+
+    def flush(self, timeout=5.0):
+        """Wait until all queued items are processed.
+
+        :return: `False` if some items are still pending after `timeout` seconds
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def process_batch(self, items):
+        """Process a list of queued items"""
+        raise NotImplementedError
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.items:
+                    self.condition.wait()
+            if self.delay:
+                time.sleep(self.delay)
+            with self.condition:
+                items = list(self.items)
+                self.items.clear()
+            # noinspection PyBroadException
+            try:
+                self.process_batch(items)
+            except Exception as e:
+                logger.warning('Unable to process %d item(s) in %s: %s' % (len(items), self.thread_name, e))
+            with self.condition:
+                self.pending -= len(items)
+                self.condition.notify_all()
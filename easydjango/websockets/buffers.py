@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Buffers used to read and write websocket messages
+=================================================
+
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import errno
+import socket
+
+from easydjango.websockets.exceptions import FrameTooLargeException
+
+__author__ = 'Matthieu Gallet'
+
+
+class MessageAssembler(object):
+    """Assemble the fragments of a websocket message.
+
+    Fragments are kept in a list and joined only once, when the message is complete (a message with a single fragment
+    is not copied at all). The size of each fragment is checked before its payload is read, so a client cannot force
+    the allocation of more than `max_size` bytes.
+    """
+    __slots__ = ('max_size', 'fragments', 'size')
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.fragments = []
+        self.size = 0
+
+    def reset(self):
+        self.fragments = []
+        self.size = 0
+
+    def check(self, length, continuation=True):
+        """Raise :class:`FrameTooLargeException` if a fragment of `length` bytes would make the message too large.
+
+        :param length: length of the payload of the next frame (from its header)
+        :param continuation: `False` if this frame starts a new message
+        """
+        size = self.size + length if continuation else length
+        if self.max_size and size > self.max_size:
+            raise FrameTooLargeException('Message too large: %d bytes (max. %d bytes)' % (size, self.max_size))
+
+    def append(self, payload):
+        self.fragments.append(payload)
+        self.size += len(payload)
+
+    def pop(self):
+        """Return the complete message and reset the assembler.
+
+        :rtype: :class:`bytes`
+        """
+        fragments = self.fragments
+        self.reset()
+        if len(fragments) == 1:
+            return fragments[0]
+        return b''.join(fragments)
+
+
+def send_buffers(sock, buffers):
+    """Send all buffers on a blocking socket, with a single `sendmsg` system call when possible.
+
+    Buffers are not concatenated (Python 2 and sockets without `sendmsg` fall back to `sendall`).
+    """
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        sock.sendall(b''.join(memoryview(x).tobytes() for x in buffers))
+        return
+    buffers = [memoryview(x) for x in buffers if x]
+    while buffers:
+        sent = sendmsg(buffers)
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def send_nowait(sock, buffers):
+    """Send as much data as possible without blocking.
+
+    :param buffers: list of buffers (`memoryview`, `bytes`, …)
+    :return: the number of sent bytes (0 if the send buffer of the socket is full)
+    """
+    flags = getattr(socket, 'MSG_DONTWAIT', None)
+    if flags is None:  # Windows: only blocking writes are possible
+        sock.sendall(b''.join(memoryview(x).tobytes() for x in buffers))
+        return sum(len(x) for x in buffers)
+    try:
+        if hasattr(sock, 'sendmsg'):
+            return sock.sendmsg(buffers, (), flags)
+        return sock.send(b''.join(memoryview(x).tobytes() for x in buffers), flags)
+    except socket.error as e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""permessage-deflate extension (RFC 7692)
+=======================================
+
+The extension is negotiated during the handshake from the `Sec-WebSocket-Extensions` header sent by the client.
+Compressed messages are flagged by the RSV1 bit of their first frame.
+
+Messages smaller than `settings.WS4REDIS_COMPRESSION_THRESHOLD` bytes are sent uncompressed, since the deflate
+overhead is larger than the gain for such payloads.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import zlib
+
+from easydjango.websockets.exceptions import FrameTooLargeException, HandshakeError, WebSocketError
+
+__author__ = 'Matthieu Gallet'
+
+EXTENSION_NAME = 'permessage-deflate'
+# removed by the sender at the end of each compressed message and added again by the receiver
+_TAIL = b'\x00\x00\xff\xff'
+_MIN_WINDOW_BITS = 9
+_MAX_WINDOW_BITS = 15
+
+
+def parse_extensions(header):
+    """Parse a `Sec-WebSocket-Extensions` header.
+
+    >>> parse_extensions('permessage-deflate; client_max_window_bits, foo')
+    [('permessage-deflate', {'client_max_window_bits': None}), ('foo', {})]
+
+    :param header: value of the header (may be `None`)
+    :return: list of `(extension name, {parameter: value or None})`
+    """
+    result = []
+    for offer in (header or '').split(','):
+        items = [x.strip() for x in offer.split(';')]
+        if not items[0]:
+            continue
+        parameters = {}
+        for item in items[1:]:
+            key, sep, value = item.partition('=')
+            parameters[key.strip()] = value.strip().strip('"') if sep else None
+        result.append((items[0], parameters))
+    return result
+
+
+def _window_bits(value):
+    if value is None:
+        return _MAX_WINDOW_BITS
+    try:
+        value = int(value)
+    except ValueError:
+        raise HandshakeError('Invalid window bits: %r' % value)
+    if not _MIN_WINDOW_BITS <= value <= _MAX_WINDOW_BITS:
+        raise HandshakeError('Invalid window bits: %r' % value)
+    return value
+
+
+class PerMessageDeflate(object):
+    """Compress and decompress the messages of a single websocket.
+
+    :param server_context_takeover: keep the compression context between sent messages
+        (better ratio, but about 256 KiB of memory per websocket for the zlib compressor)
+    :param client_context_takeover: allow the client to keep its compression context between messages
+        (about 40 KiB of memory per websocket for the zlib decompressor)
+
+    Without context takeover, zlib objects are only built for the duration of a single message.
+    :param server_max_window_bits: size (as a power of 2) of the window used by the server
+    :param client_max_window_bits: size (as a power of 2) of the window used by the client
+    :param threshold: messages smaller than this size (in bytes) are not compressed
+    :param level: zlib compression level
+    :param max_size: maximum size of decompressed messages (`FrameTooLargeException` is raised above)
+    """
+
+    def __init__(self, server_context_takeover=True, client_context_takeover=True,
+                 server_max_window_bits=_MAX_WINDOW_BITS, client_max_window_bits=_MAX_WINDOW_BITS,
+                 threshold=0, level=zlib.Z_DEFAULT_COMPRESSION, max_size=None):
+        self.server_context_takeover = server_context_takeover
+        self.client_context_takeover = client_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+        self._compressor = None
+        self._decompressor = None
+
+    @classmethod
+    def negotiate(cls, header, server_context_takeover=True, client_context_takeover=True, **kwargs):
+        """Select the first acceptable permessage-deflate offer of the client.
+
+        :param header: value of the `Sec-WebSocket-Extensions` header sent by the client
+        :param server_context_takeover: `False` to force `server_no_context_takeover`
+        :param client_context_takeover: `False` to force `client_no_context_takeover` (allowed by RFC 7692 even if
+          the client did not offer it)
+        :param kwargs: other arguments of :class:`PerMessageDeflate`
+        :return: a `(PerMessageDeflate, response header value)` tuple, or `(None, None)`
+        """
+        for name, parameters in parse_extensions(header):
+            if name != EXTENSION_NAME:
+                continue
+            if set(parameters) - {'server_no_context_takeover', 'client_no_context_takeover',
+                                  'server_max_window_bits', 'client_max_window_bits'}:
+                continue  # unknown parameter: this offer must be declined
+            try:
+                server_bits = _window_bits(parameters.get('server_max_window_bits'))
+                client_bits = _MAX_WINDOW_BITS
+                if parameters.get('client_max_window_bits'):
+                    client_bits = _window_bits(parameters['client_max_window_bits'])
+            except HandshakeError:
+                continue
+            server_context_takeover = server_context_takeover and 'server_no_context_takeover' not in parameters
+            client_takeover = client_context_takeover and 'client_no_context_takeover' not in parameters
+            response = [EXTENSION_NAME]
+            if not server_context_takeover:
+                response.append('server_no_context_takeover')
+            if not client_takeover:
+                response.append('client_no_context_takeover')
+            if 'server_max_window_bits' in parameters:
+                response.append('server_max_window_bits=%d' % server_bits)
+            if parameters.get('client_max_window_bits'):
+                response.append('client_max_window_bits=%d' % client_bits)
+            extension = cls(server_context_takeover=server_context_takeover,
+                            client_context_takeover=client_takeover,
+                            server_max_window_bits=server_bits, client_max_window_bits=client_bits, **kwargs)
+            return extension, '; '.join(response)
+        return None, None
+
+    def should_compress(self, payload):
+        return len(payload) >= self.threshold
+
+    def compress(self, payload):
+        """Compress a whole message.
+
+        :rtype: :class:`bytes`
+        """
+        compressor = self._compressor
+        if compressor is None:
+            # zlib does not accept a window of 2^8 bytes for raw deflate streams
+            bits = max(self.server_max_window_bits, _MIN_WINDOW_BITS)
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -bits)
+            if self.server_context_takeover:
+                self._compressor = compressor
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(_TAIL):
+            data = data[:-4]
+        return data
+
+    def decompress(self, payload):
+        """Decompress a whole message.
+
+        :rtype: :class:`bytes`
+        """
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-self.client_max_window_bits)
+            if self.client_context_takeover:
+                self._decompressor = decompressor
+        max_length = self.max_size + 1 if self.max_size else 0
+        try:
+            data = decompressor.decompress(payload + _TAIL, max_length)
+        except zlib.error as e:
+            raise WebSocketError('Invalid compressed message: %s' % e)
+        if decompressor.unconsumed_tail or (self.max_size and len(data) > self.max_size):
+            raise FrameTooLargeException('Decompressed message larger than %d bytes' % self.max_size)
+        return data
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Group the Celery tasks sent by a websocket worker
+=================================================
+
+With `WS4REDIS_DISPATCH_DELAY`, signals sent by websocket clients are not sent to Celery one by one: a
+:class:`BatchDispatcher` thread waits for this delay after the first signal, groups everything received in the meantime
+by Celery queue and sends a single task per queue (and per `max_batch_size` signals).
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+from collections import OrderedDict
+
+from easydjango.websockets.batching import BackgroundBatcher
+
+__author__ = 'Matthieu Gallet'
+
+logger = logging.getLogger('easydjango.websockets')
+
+
+class BatchDispatcher(BackgroundBatcher):
+    """Send calls by batches from a background thread, without waiting for the broker.
+
+    :param send_batch: function called with `(queue, list of calls)`
+    :param delay: time (in seconds) spent waiting for other calls after the first one
+    """
+    max_batch_size = 100
+    thread_name = 'easydjango-dispatcher'
+
+    def __init__(self, send_batch, delay=0.):
+        super(BatchDispatcher, self).__init__(delay=delay)
+        self.send_batch = send_batch
+
+    def dispatch(self, queue, call):
+        """Send `call` to `queue` with the next batch"""
+        self.add([(queue, call)])
+
+    def process_batch(self, items):
+        batches = OrderedDict()
+        for queue, call in items:
+            batches.setdefault(queue, []).append(call)
+        for queue, queue_calls in batches.items():
+            for start in range(0, len(queue_calls), self.max_batch_size):
+                batch = queue_calls[start:start + self.max_batch_size]
+                # noinspection PyBroadException
+                try:
+                    self.send_batch(queue, batch)
+                except Exception as e:
+                    logger.warning('Unable to send %d call(s) to queue %r: %s' % (len(batch), queue, e))
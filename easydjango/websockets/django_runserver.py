@@ -5,6 +5,7 @@ import select
 from hashlib import sha1
 from wsgiref import util
 
+from django.conf import settings
 from django.core.management.commands import runserver
 from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler, ServerHandler
 from django.utils.encoding import force_str
@@ -53,10 +54,14 @@ class WebsocketRunServer(WebsocketWSGIServer):
             ('Sec-WebSocket-Accept', sec_ws_accept),
             ('Sec-WebSocket-Version', str(websocket_version)),
         ]
+        compression, extensions = self.negotiate_compression(environ)
+        if extensions:
+            headers.append(('Sec-WebSocket-Extensions', extensions))
         logger.debug('WebSocket request accepted, switching protocols')
         start_response(force_str('101 Switching Protocols'), headers)
         six.get_method_self(start_response).finish_content()
-        return WebSocket(environ['wsgi.input'])
+        return WebSocket(environ['wsgi.input'], max_message_size=settings.WS4REDIS_MAX_MESSAGE_SIZE,
+                         compression=compression)
 
     def select(self, rlist, wlist, xlist, timeout=None):
         return select.select(rlist, wlist, xlist, timeout)
@@ -26,6 +26,13 @@ class FrameTooLargeException(WebSocketError):
     """
 
 
+# noinspection PyClassHasNoInit
+class SlowConsumerError(WebSocketError):
+    """
+    Raised when a client does not read its messages fast enough and must be disconnected.
+    """
+
+
 class HandshakeError(BadHeaderError):
     """
     Raised if an error occurs during protocol handshake.
@@ -18,29 +18,46 @@ from __future__ import unicode_literals, print_function, absolute_import
 
 import base64
 import collections
+import errno
 import logging
 import select
 import socket
 import struct
 from hashlib import sha1
 
-import gevent.select
-from django.utils import six
+from django.conf import settings
 from django.utils.six import binary_type, text_type
+from easydjango.websockets.buffers import MessageAssembler, send_nowait
+from easydjango.websockets.exceptions import WebSocketError
+from easydjango.websockets.keepalive import KeepaliveState
+from easydjango.websockets.masking import mask_payload
 from easydjango.websockets.wsgi_server import WebsocketWSGIServer
 
 __author__ = 'Matthieu Gallet'
 
 logger = logging.getLogger('easydjango.websocket')
 
-if six.PY3:
-    # noinspection PyShadowingBuiltins
-    xrange = range
-
 # WS_KEY = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 #
 
 
+class Frame(object):
+    """A HyBi frame decoded by :meth:`WebSocket.decode_hybi`."""
+    __slots__ = ('fin', 'rsv1', 'opcode', 'mask', 'hlen', 'length', 'size', 'payload', 'close_code', 'close_reason')
+
+    def __init__(self):
+        self.fin = 0
+        self.rsv1 = 0  # set on the first frame of compressed messages (permessage-deflate)
+        self.opcode = 0
+        self.mask = None
+        self.hlen = 2  # header length, without the mask
+        self.length = 0  # payload length
+        self.size = 0  # total length of the frame
+        self.payload = None
+        self.close_code = None
+        self.close_reason = None
+
+
 class WebSocket(object):
     """A websocket object that handles the details of
     serialization/deserialization to the socket.
@@ -61,12 +78,17 @@ class WebSocket(object):
 
     """
 
-    def __init__(self, sock, environ, version=76):
+    recv_size = 65536
+
+    def __init__(self, sock, environ, version=76, max_message_size=None, compression=None):
         """
         :param sock: The eventlet socket
         :type sock: :class:`eventlet.greenio.GreenSocket`
         :param environ: The wsgi environment
         :param version: The WebSocket spec version to follow (default is 76)
+        :param max_message_size: Maximum size of a received message, in bytes
+        :param compression: negotiated permessage-deflate extension
+        :type compression: :class:`easydjango.websockets.compression.PerMessageDeflate`
         """
         self.socket = sock
         sock.settimeout(5.0)
@@ -80,12 +102,19 @@ class WebSocket(object):
             version = version.decode('utf-8')
         self.version = version
         self.closed = False
-        self._buf = b''
+        self._buf = bytearray()
+        self._offset = 0
+        self._assembler = MessageAssembler(max_message_size)
+        self._compressed = False
+        self.compression = compression
+        self.outbound = None
+        # hixie-76 clients cannot answer to pings, so they receive the text heartbeat instead
+        self.keepalive = KeepaliveState() if self.version in ['7', '8', '13'] else None
         self._msgs = collections.deque()
         # self._sendlock = semaphore.Semaphore()
 
     @staticmethod
-    def encode_hybi(buf, opcode, use_base64=False):
+    def encode_hybi(buf, opcode, use_base64=False, rsv1=False):
         """ Encode a HyBi style WebSocket frame.
         Optional opcode:
             0x0 - continuation
@@ -94,11 +123,14 @@ class WebSocket(object):
             0x8 - connection close
             0x9 - ping
             0xA - pong
+        `rsv1` must be set for compressed messages.
         """
         if use_base64:
             buf = base64.b64encode(buf)
 
         b1 = 0x80 | (opcode & 0x0f)  # FIN + opcode
+        if rsv1:
+            b1 |= 0x40
         payload_len = len(buf)
         if payload_len <= 125:
             header = struct.pack('>BB', b1, payload_len)
@@ -110,101 +142,59 @@ class WebSocket(object):
         return header + buf, len(header), 0
 
     @staticmethod
-    def decode_hybi(buf, use_base64=False):
-        """ Decode HyBi style WebSocket packets.
-        Returns:
-            {'fin'          : 0_or_1,
-             'opcode'       : number,
-             'mask'         : 32_bit_number,
-             'hlen'         : header_bytes_number,
-             'length'       : payload_bytes_number,
-             'payload'      : decoded_buffer,
-             'left'         : bytes_left_number,
-             'close_code'   : number,
-             'close_reason' : string}
-        """
+    def decode_hybi(buf, use_base64=False, offset=0):
+        """ Decode a HyBi style WebSocket packet, starting at `offset` in `buf`.
 
-        f = {'fin': 0,
-             'opcode': 0,
-             'mask': 0,
-             'hlen': 2,
-             'length': 0,
-             'payload': None,
-             'left': 0,
-             'close_code': None,
-             'close_reason': None}
-        assert isinstance(buf, binary_type)
-        blen = len(buf)
-        f['left'] = blen
-
-        if blen < f['hlen']:
+        :rtype: :class:`Frame` (its payload is `None` if the frame is incomplete)
+        """
+        f = Frame()
+        blen = len(buf) - offset
+        if blen < f.hlen:
             return f  # Incomplete frame header
 
-        b1, b2 = struct.unpack_from(">BB", buf)
-        f['opcode'] = b1 & 0x0f
-        f['fin'] = (b1 & 0x80) >> 7
+        b1, b2 = struct.unpack_from(">BB", buf, offset)
+        f.opcode = b1 & 0x0f
+        f.fin = (b1 & 0x80) >> 7
+        f.rsv1 = (b1 & 0x40) >> 6
         has_mask = (b2 & 0x80) >> 7
 
-        f['length'] = b2 & 0x7f
+        f.length = b2 & 0x7f
 
-        if f['length'] == 126:
-            f['hlen'] = 4
-            if blen < f['hlen']:
+        if f.length == 126:
+            f.hlen = 4
+            if blen < f.hlen:
+                f.length = 0
                 return f  # Incomplete frame header
-            (f['length'],) = struct.unpack_from('>xxH', buf)
-        elif f['length'] == 127:
-            f['hlen'] = 10
-            if blen < f['hlen']:
+            (f.length,) = struct.unpack_from('>H', buf, offset + 2)
+        elif f.length == 127:
+            f.hlen = 10
+            if blen < f.hlen:
+                f.length = 0
                 return f  # Incomplete frame header
-            (f['length'],) = struct.unpack_from('>xxQ', buf)
+            (f.length,) = struct.unpack_from('>Q', buf, offset + 2)
 
-        full_len = f['hlen'] + has_mask * 4 + f['length']
+        f.size = f.hlen + has_mask * 4 + f.length
 
-        if blen < full_len:  # Incomplete frame
-            return f  # Incomplete frame header
+        if blen < f.size:  # Incomplete frame
+            return f
 
-        # Number of bytes that are part of the next frame(s)
-        f['left'] = blen - full_len
-
-        # Process 1 frame
+        start = offset + f.hlen + has_mask * 4
+        end = offset + f.size
         if has_mask:
             # unmask payload
-            f['mask'] = buf[f['hlen']:f['hlen'] + 4]
-            b = c = b''
-            if f['length'] >= 4:
-                data = struct.unpack('<I', buf[f['hlen']:f['hlen'] + 4])[0]
-                of1 = f['hlen'] + 4
-                b = b''
-                for i in xrange(0, int(f['length'] / 4)):
-                    mask = struct.unpack('<I', buf[of1 + 4 * i:of1 + 4 * (i + 1)])[0]
-                    b += struct.pack('I', data ^ mask)
-
-            if f['length'] % 4:
-                l = f['length'] % 4
-                of1 = f['hlen']
-                of2 = full_len - l
-                c = b''
-                for i in range(0, l):
-                    mask = struct.unpack('B', buf[of1 + i:of1 + i + 1])[0]
-                    data = struct.unpack('B', buf[of2 + i:of2 + i + 1])[0]
-                    c += chr(data ^ mask).encode('utf-8')
-
-            f['payload'] = b + c
+            f.mask = bytes(buf[offset + f.hlen:start])
+            f.payload = mask_payload(f.mask, buf[start:end])
         else:
-            # noinspection PyTypeChecker
-            f['payload'] = buf[(f['hlen'] + has_mask * 4):full_len]
+            f.payload = bytes(buf[start:end])
 
-        if use_base64 and f['opcode'] in [1, 2]:
-            try:
-                f['payload'] = base64.b64decode(f['payload'])
-            except:
-                raise
+        if use_base64 and f.opcode in [1, 2]:
+            f.payload = base64.b64decode(f.payload)
 
-        if f['opcode'] == 0x08:
-            if f['length'] >= 2:
-                f['close_code'] = struct.unpack_from(">H", f['payload'])
-            if f['length'] > 3:
-                f['close_reason'] = f['payload'][2:]
+        if f.opcode == 0x08:
+            if f.length >= 2:
+                f.close_code = struct.unpack_from(">H", f.payload)[0]
+            if f.length > 3:
+                f.close_reason = f.payload[2:]
 
         return f
 
@@ -223,55 +213,73 @@ class WebSocket(object):
         return packed
 
     def _parse_messages(self):
-        """ Parses for messages in the buffer *buf*.  It is assumed that
-        the buffer contains the start character for a message, but that it
+        """ Parses for messages in the buffer, starting at the current offset.  It is assumed
+        that the buffer contains the start character for a message, but that it
         may contain only part of the rest of the message.
 
-        Returns an array of messages, and the buffer remainder that
-        didn't contain any full messages."""
+        Returns an array of complete messages (fragments are assembled); incomplete
+        data stay in the buffer."""
         msgs = []
         buf = self._buf
-        while buf:
+        offset = self._offset
+        end = len(buf)
+        while offset < end:
             if self.version in ['7', '8', '13']:
-                frame = self.decode_hybi(buf, use_base64=False)
-                # print("Received buf: %s, frame: %s" % (repr(buf), frame))
-
-                if frame['payload'] is None:
+                frame = self.decode_hybi(buf, use_base64=False, offset=offset)
+                if frame.opcode == 0x0:
+                    self._assembler.check(frame.length)
+                elif frame.opcode in (0x1, 0x2):
+                    self._assembler.check(frame.length, continuation=False)
+                if frame.payload is None:
                     break
+                if frame.rsv1 and (self.compression is None or frame.opcode not in (0x1, 0x2)):
+                    raise WebSocketError('Unexpected RSV1 bit')
+                offset += frame.size
+                self.keepalive.touch()
+                if frame.opcode == 0x8:  # connection close
+                    self.closed = True
+                    break
+                elif frame.opcode == 0x9:  # ping
+                    self.socket.sendall(self.encode_hybi(frame.payload, opcode=0xA)[0])
+                elif frame.opcode == 0xA:  # pong
+                    self.keepalive.pong(frame.payload)
                 else:
-                    if frame['opcode'] == 0x8:  # connection close
-                        self.closed = True
-                        break
-                    # elif frame['opcode'] == 0x1:
-                    else:
-                        msgs.append(frame['payload'])
-                        # msgs.append(frame['payload'].decode('utf-8', 'replace'));
-                        # buf = buf[-frame['left']:]
-                        if frame['left']:
-                            buf = buf[-frame['left']:]
-                        else:
-                            buf = b''
-
+                    if frame.opcode != 0x0:
+                        self._assembler.reset()
+                        self._compressed = bool(frame.rsv1)
+                    self._assembler.append(frame.payload)
+                    if frame.fin:
+                        msg = self._assembler.pop()
+                        if self._compressed:
+                            msg = self.compression.decompress(msg)
+                        msgs.append(msg)
             else:
-                frame_type = buf[0]
-                if isinstance(frame_type, str):
-                    frame_type = ord(frame_type)
+                frame_type = buf[offset]
                 if frame_type == 0:
                     # Normal message.
-                    # noinspection PyTypeChecker
-                    end_idx = buf.find(b"\xFF")
+                    end_idx = buf.find(b"\xFF", offset)
                     if end_idx == -1:  # pragma NO COVER
                         break
-                    msgs.append(buf[1:end_idx].decode('utf-8', 'replace'))
-                    buf = buf[end_idx + 1:]
+                    msgs.append(bytes(buf[offset + 1:end_idx]))
+                    offset = end_idx + 1
                 elif frame_type == 255:
                     # Closing handshake.
-                    assert ord(buf[1]) == 0, "Unexpected closing handshake: %r" % buf
+                    if end - offset < 2:
+                        break
+                    assert buf[offset + 1] == 0, "Unexpected closing handshake: %r" % buf[offset:]
                     self.closed = True
                     break
                 else:
-                    raise ValueError("Don't understand how to parse this type of message: %r" % buf)
-        self._buf = buf
+                    raise ValueError("Don't understand how to parse this type of message: %r" % buf[offset:])
+        # parsed data are only removed when they are more than the remaining ones, so each byte is moved
+        # at most once on average
+        if offset == end:
+            del buf[:]
+            offset = 0
+        elif offset > end // 2:
+            del buf[:offset]
+            offset = 0
+        self._offset = offset
         return msgs
 
     def send(self, message):
@@ -283,14 +291,21 @@ class WebSocket(object):
         if isinstance(message, text_type):
             message = message.encode('utf-8')
         if self.version in ['7', '8', '13']:
-            packed, lenhead, lentail = self.encode_hybi(message, opcode=0x01, use_base64=False)
+            compressed = self.compression is not None and self.compression.should_compress(message)
+            if compressed:
+                message = self.compression.compress(message)
+            packed, lenhead, lentail = self.encode_hybi(message, opcode=0x01, use_base64=False, rsv1=compressed)
         else:
             packed = self._pack_message(message)
+        if self.outbound is not None and self.outbound.current:
+            # a queued message is partially written: it must be finished before starting a new frame
+            packed = b''.join(x.tobytes() for x in self.outbound.current) + packed
+            self.outbound.current = []
         # if two greenthreads are trying to send at the same time
         # on the same socket, sendlock prevents interleaving and corruption
         # self._sendlock.acquire()
         try:
-            print("send %r" % packed)
+            logger.debug("send %r" % packed)
             self.socket.sendall(packed)
         except Exception as e:
             logger.exception(e)
@@ -299,6 +314,22 @@ class WebSocket(object):
             pass
             # self._sendlock.release()
 
+    def write_outbound(self):
+        """Write the messages queued in `self.outbound` without blocking.
+
+        :return: `True` if all messages have been written
+        """
+        if self.version not in ['7', '8', '13']:
+            for message in self.outbound.pop_messages():
+                self.send(message.payload)
+            return True
+        try:
+            return self.outbound.write(lambda buffers: send_nowait(self.socket, buffers), self.compression)
+        except Exception as e:
+            logger.exception(e)
+            self.closed = True
+            return True
+
     def receive(self):
         """Waits for and deserializes messages.
 
@@ -306,33 +337,43 @@ class WebSocket(object):
         has already closed the connection, returns None.  This is different
         from normal socket behavior because the empty string is a valid
         websocket message."""
-        print("receive data")
         while not self._msgs:
             # Websocket might be closed already.
             if self.closed:
                 return None
             # no parsed messages, must mean buf needs more data
             try:
-                delta = self.socket.recv(4096)
-            except ConnectionResetError:
+                delta = self.socket.recv(self.recv_size)
+            except socket.error as e:
+                # the socket is non-blocking: nothing more to read after a control frame or a partial frame
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                if e.args[0] != errno.ECONNRESET:
+                    logger.exception(e)
                 self.closed = True
                 return None
             except Exception as e:
                 logger.exception(e)
+                return None
             if delta == b'':
                 return None
             self._buf += delta
-            msgs = self._parse_messages()
+            try:
+                msgs = self._parse_messages()
+            except WebSocketError as e:
+                logger.info('websocket.receive: {!r}'.format(e))
+                self.close()
+                return None
             self._msgs.extend(msgs)
         return self._msgs.popleft().decode('utf-8')
 
-    def _send_closing_frame(self, ignore_send_errors=False):
+    def _send_closing_frame(self, ignore_send_errors=False, code=None, reason=''):
         """Sends the closing frame to the client, if required."""
-        print('_send_closing_frame')
-        if self.version in [b'7', b'8', b'13'] and not self.closed:
+        if self.version in ['7', '8', '13'] and not self.closed:
             msg = b''
-            # if code != None:
-            #    msg = struct.pack(">H%ds" % (len(reason)), code)
+            if code is not None:
+                reason = reason.encode('utf-8')
+                msg = struct.pack(">H%ds" % (len(reason)), code, reason)
 
             buf, h, t = self.encode_hybi(msg, opcode=0x08, use_base64=False)
             self.socket.sendall(buf)
@@ -348,17 +389,32 @@ class WebSocket(object):
                     raise
             self.closed = True
 
-    def close(self):
+    def close(self, code=None, message=''):
         """Forcibly close the websocket; generally it is preferable to
         return from the handler method."""
-        self._send_closing_frame()
-        print("close")
+        self._send_closing_frame(code=code, reason=message or '')
+        logger.debug("close")
         self.socket.shutdown(True)
         self.socket.close()
 
+    def abort(self, code=1008):
+        """Close the websocket without sending the closing frame, when the client does not read its messages."""
+        if self.outbound is not None:
+            self.outbound.clear()
+        self.closed = True
+        self.close()
+
+    def ping(self):
+        """Send a ping frame (only with HyBi versions)"""
+        self.socket.sendall(self.encode_hybi(self.keepalive.new_ping(), opcode=0x09)[0])
+
     def get_file_descriptor(self):
         return self.socket.fileno()
 
+    def has_buffered_data(self):
+        """Return `True` if messages have already been received but not read"""
+        return bool(self._msgs)
+
     # noinspection PyMethodMayBeStatic
     def flush(self):
         """
@@ -382,7 +438,7 @@ class GunicornWebsocketServer(WebsocketWSGIServer):
 
         version = environ.get('HTTP_SEC_WEBSOCKET_VERSION')
 
-        ws = WebSocket(sock, environ, version)
+        ws = WebSocket(sock, environ, version, max_message_size=settings.WS4REDIS_MAX_MESSAGE_SIZE)
 
         handshake_reply = ("HTTP/1.1 101 Switching Protocols\r\n"
                            "Upgrade: websocket\r\n"
@@ -406,16 +462,9 @@ class GunicornWebsocketServer(WebsocketWSGIServer):
             if ws_protocols:
                 handshake_reply += 'Sec-WebSocket-Protocol: %s\r\n' % ', '.join(ws_protocols)
 
-            exts = []
-            extensions = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
-            ws_extensions = []
-            if extensions:
-                for ext in extensions.split(','):
-                    ext = ext.strip()
-                    if ext in exts:
-                        ws_extensions.append(ext)
+            ws.compression, ws_extensions = self.negotiate_compression(environ)
             if ws_extensions:
-                handshake_reply += 'Sec-WebSocket-Extensions: %s\r\n' % ', '.join(ws_extensions)
+                handshake_reply += 'Sec-WebSocket-Extensions: %s\r\n' % ws_extensions
 
             accepted = base64.b64encode(sha1(key + self.WS_GUID).digest())
             handshake_reply += (
@@ -443,7 +492,7 @@ class GunicornWebsocketServer(WebsocketWSGIServer):
         return ws
 
     def select(self, rlist, wlist, xlist, timeout=None):
-        # return gevent.select.select(rlist, wlist, xlist, timeout)
+        # only used on Python 2; gevent workers monkey-patch the selectors module used by `create_poller`
         return select.select(rlist, wlist, xlist, timeout)
 
     def verify_client(self, ws):
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Detect dead websocket clients with ping/pong frames
+===================================================
+
+Each websocket keeps a :class:`KeepaliveState`. When nothing has been received from the client for
+`settings.WS4REDIS_PING_INTERVAL` seconds, the server sends a ping frame (browsers answer with a pong frame by
+themselves, without any JavaScript code). The client is considered dead after `settings.WS4REDIS_PING_MAX_MISSED`
+consecutive pings without any answer.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import struct
+import time
+
+__author__ = 'Matthieu Gallet'
+
+
+class KeepaliveState(object):
+    """Activity of a websocket client: idle time, round-trip time and missed pongs."""
+    __slots__ = ('last_activity', 'ping_payload', 'ping_time', 'missed_pongs', 'rtt', 'counter')
+
+    def __init__(self):
+        self.last_activity = time.time()
+        self.ping_payload = None
+        self.ping_time = None
+        self.missed_pongs = 0
+        self.rtt = None
+        self.counter = 0
+
+    def touch(self):
+        """Any frame received from the client proves that it is alive"""
+        self.last_activity = time.time()
+        self.missed_pongs = 0
+
+    def idle_time(self, now=None):
+        return (now or time.time()) - self.last_activity
+
+    def ping_due(self, interval, now=None):
+        """Return `True` if a ping must be sent: nothing was received during `interval` seconds,
+        and the previous ping (if any) was sent at least `interval` seconds ago."""
+        now = now or time.time()
+        if now - self.last_activity < interval:
+            return False
+        return self.ping_time is None or now - self.ping_time >= interval
+
+    def is_dead(self, max_missed):
+        return bool(max_missed) and self.missed_pongs >= max_missed
+
+    def count_missed_pong(self):
+        """Called when a new ping is due: the previous ping is missed if nothing has been received since."""
+        if self.ping_payload is not None and self.last_activity < self.ping_time:
+            self.missed_pongs += 1
+
+    def new_ping(self):
+        """Return the payload of the next ping frame"""
+        self.counter += 1
+        self.ping_payload = struct.pack('!I', self.counter & 0xffffffff)
+        self.ping_time = time.time()
+        return self.ping_payload
+
+    def pong(self, payload):
+        """Called when a pong frame is received"""
+        now = time.time()
+        self.last_activity = now
+        if payload == self.ping_payload:
+            self.rtt = now - self.ping_time
+            self.ping_payload = None
+            self.missed_pongs = 0
+
+    def __repr__(self):
+        return '<KeepaliveState idle=%.1fs rtt=%s missed=%d>' % (
+            self.idle_time(), '%.1fms' % (self.rtt * 1000.) if self.rtt is not None else '?', self.missed_pongs)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Mask and unmask websocket payloads
+==================================
+
+The payload is XORed with its 4-byte mask at once, instead of byte by byte:
+
+  * with NumPy (if available) for large payloads,
+  * otherwise by converting the payload and the repeated mask to big integers (`int.from_bytes` on Python 3).
+
+Used by all websocket backends.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import binascii
+
+import six
+
+try:
+    # noinspection PyPackageRequirements
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'Matthieu Gallet'
+
+# below this size, the overhead of NumPy is higher than the XOR itself
+NUMPY_MIN_LENGTH = 2048
+
+
+def _repeat_mask(mask, length):
+    return (bytes(mask) * (length // 4 + 1))[:length]
+
+
+if six.PY3:
+    def _xor(mask, payload, length):
+        result = int.from_bytes(payload, 'big') ^ int.from_bytes(_repeat_mask(mask, length), 'big')
+        return result.to_bytes(length, 'big')
+else:
+    def _xor(mask, payload, length):
+        result = int(binascii.hexlify(payload), 16) ^ int(binascii.hexlify(_repeat_mask(mask, length)), 16)
+        return binascii.unhexlify(b'%0*x' % (2 * length, result))
+
+
+def _numpy_xor(mask, payload, length):
+    words = length // 4
+    data = numpy.frombuffer(payload, dtype=numpy.uint8)
+    result = numpy.empty(length, dtype=numpy.uint8)
+    # 4 bytes at a time for the aligned part, then byte by byte
+    numpy.bitwise_xor(data[:4 * words].view(numpy.uint32), numpy.frombuffer(mask, dtype=numpy.uint32)[0],
+                      out=result[:4 * words].view(numpy.uint32))
+    mask_bytes = numpy.frombuffer(mask, dtype=numpy.uint8)
+    for i in range(4 * words, length):
+        result[i] = data[i] ^ mask_bytes[i % 4]
+    return result.tobytes()
+
+
+def mask_payload(mask, payload):
+    """Mask (or unmask, since it is the same operation) a websocket payload.
+
+    :param mask: the 4-byte mask of the frame
+    :param payload: bytes-like object
+    :return: the (un)masked payload
+    :rtype: :class:`bytes`
+    """
+    length = len(payload)
+    if not length:
+        return b''
+    if numpy is not None and length >= NUMPY_MIN_LENGTH:
+        return _numpy_xor(bytes(mask), bytes(payload), length)
+    return _xor(mask, bytes(payload), length)
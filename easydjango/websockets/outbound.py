@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Bounded queue of messages waiting to be sent to a websocket
+==========================================================
+
+Messages received from Redis are not written to the client with a blocking call: they are queued and written
+when the socket is writable, so a slow client cannot block its websocket loop. When a client does not read its
+messages fast enough, its queue is limited to `settings.WS4REDIS_OUTBOUND_MAX_BYTES` bytes and
+`settings.WS4REDIS_OUTBOUND_MAX_MESSAGES` messages, and `settings.WS4REDIS_OUTBOUND_POLICY` is applied:
+
+  * `'drop-oldest'`: the oldest messages are discarded,
+  * `'coalesce'`: older messages of the same signal are discarded first, then the oldest ones,
+  * `'disconnect'`: the client is disconnected.
+
+Process-wide counters are available in :data:`metrics`.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+from collections import deque
+
+from easydjango.websockets.exceptions import SlowConsumerError
+
+__author__ = 'Matthieu Gallet'
+
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class OutboundMetrics(object):
+    """Counters shared by all the outbound queues of the process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queued_bytes = 0
+        self.queued_messages = 0
+        self.dropped_messages = 0
+        self.evicted_clients = 0
+
+    def add(self, queued_bytes=0, queued_messages=0, dropped_messages=0, evicted_clients=0):
+        with self._lock:
+            self.queued_bytes += queued_bytes
+            self.queued_messages += queued_messages
+            self.dropped_messages += dropped_messages
+            self.evicted_clients += evicted_clients
+
+    def as_dict(self):
+        with self._lock:
+            return {'queued_bytes': self.queued_bytes, 'queued_messages': self.queued_messages,
+                    'dropped_messages': self.dropped_messages, 'evicted_clients': self.evicted_clients}
+
+
+metrics = OutboundMetrics()
+
+
+class OutboundQueue(object):
+    """Messages waiting to be sent to a single websocket.
+
+    Messages are kept as :class:`easydjango.websockets.prepared.PreparedMessage` until they are written, so they are
+    only compressed when they are actually sent (dropping an already compressed message would corrupt the
+    compression context of the client). A message is never dropped once its first byte has been written.
+
+    :param max_bytes: maximum size of the queued payloads (0 for no limit)
+    :param max_messages: maximum number of queued messages (0 for no limit)
+    :param policy: one of `DROP_OLDEST`, `COALESCE` or `DISCONNECT`
+    """
+
+    def __init__(self, max_bytes=0, max_messages=0, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError('Invalid outbound policy %r (must be one of %s)' % (policy, ', '.join(POLICIES)))
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+        self.messages = deque()
+        self.size = 0  # size of the payloads in `messages`
+        self.current = []  # remaining buffers of the message being written
+
+    def __len__(self):
+        return len(self.messages) + (1 if self.current else 0)
+
+    def __bool__(self):
+        return bool(self.messages or self.current)
+
+    __nonzero__ = __bool__
+
+    def push(self, message):
+        """Queue a message, applying the policy if the limits are exceeded.
+
+        :type message: :class:`easydjango.websockets.prepared.PreparedMessage`
+        :raise SlowConsumerError: if the client must be disconnected
+        """
+        self.messages.append(message)
+        self.size += len(message.payload)
+        metrics.add(queued_bytes=len(message.payload), queued_messages=1)
+        if not self.is_full():
+            return
+        if self.policy == DISCONNECT:
+            metrics.add(evicted_clients=1)
+            raise SlowConsumerError('Outbound queue full: %d messages, %d bytes' % (len(self.messages), self.size))
+        if self.policy == COALESCE and message.signal is not None:
+            self._remove([x for x in self.messages if x is not message and x.signal == message.signal])
+        self._drop_oldest()
+
+    def is_full(self):
+        return (self.max_bytes and self.size > self.max_bytes) or \
+            (self.max_messages and len(self.messages) > self.max_messages)
+
+    def _drop_oldest(self):
+        """Drop the oldest messages until the queue is no longer full (the newest one is always kept)."""
+        count, size = 0, 0
+        while self.is_full() and len(self.messages) > 1:
+            payload_size = len(self.messages.popleft().payload)
+            self.size -= payload_size
+            size += payload_size
+            count += 1
+        if count:
+            metrics.add(queued_bytes=-size, queued_messages=-count, dropped_messages=count)
+
+    def _remove(self, messages):
+        """Remove the given messages, rebuilding the whole queue (only used to coalesce signals)."""
+        if not messages:
+            return
+        removed = set(id(x) for x in messages)
+        self.messages = deque(x for x in self.messages if id(x) not in removed)
+        size = sum(len(x.payload) for x in messages)
+        self.size -= size
+        metrics.add(queued_bytes=-size, queued_messages=-len(messages), dropped_messages=len(messages))
+
+    def write(self, send, compression=None):
+        """Write as much data as possible.
+
+        :param send: non-blocking function that takes a list of buffers and returns the number of written bytes
+        :param compression: the permessage-deflate extension negotiated by the websocket
+        :return: `True` if all messages have been written
+        """
+        current = self.current
+        while True:
+            if not current:
+                if not self.messages:
+                    return True
+                message = self.messages.popleft()
+                self.size -= len(message.payload)
+                metrics.add(queued_bytes=-len(message.payload), queued_messages=-1)
+                current = [memoryview(x) for x in message.frame(compression) if x]
+                self.current = current
+            sent = send(current)
+            if not sent:
+                return False
+            while sent:
+                if sent >= len(current[0]):
+                    sent -= len(current.pop(0))
+                else:
+                    current[0] = current[0][sent:]
+                    sent = 0
+
+    def pop_messages(self):
+        """Remove and return all the messages that have not been written yet."""
+        while self.messages:
+            message = self.messages.popleft()
+            self.size -= len(message.payload)
+            metrics.add(queued_bytes=-len(message.payload), queued_messages=-1)
+            yield message
+
+    def clear(self):
+        """Discard all messages (when the websocket is closed)."""
+        if self.messages:
+            metrics.add(queued_bytes=-self.size, queued_messages=-len(self.messages))
+        self.messages.clear()
+        self.size = 0
+        self.current = []
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Wait for several sockets at once
+================================
+
+:class:`Poller` relies on `select.poll` for small sets of file descriptors and on :mod:`selectors` (epoll on Linux,
+kqueue on BSD) for larger ones: file descriptors stay registered between two calls, only the ready ones are reported,
+and file descriptors above 1024 are accepted (unlike `select.select`).
+:class:`SelectPoller` provides the same interface on top of a `select`-like function (for example
+`gevent.select.select`), and is used on Python 2.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import math
+import select
+
+try:
+    import selectors
+except ImportError:  # Python 2
+    selectors = None
+
+__author__ = 'Matthieu Gallet'
+
+
+class Poller(object):
+    """Persistent registrations, with a `select.select`-like interface.
+
+    The websocket loops of the threaded servers watch one or two file descriptors each, so a `select.poll` object
+    (which does not use a file descriptor itself) is used while at most `max_poll_fds` file descriptors are watched.
+    A `selectors` object (an epoll file descriptor on Linux) is only created for larger sets.
+    """
+    max_poll_fds = 8
+
+    def __init__(self):
+        self.selector = None
+        self.poll = None
+        self.events = {}
+
+    def select(self, rlist, wlist, xlist, timeout=None):
+        """Wait until a file descriptor of `rlist` is readable or a file descriptor of `wlist` is writable.
+
+        Registrations are only updated when the lists change. `xlist` is ignored.
+
+        :return: `(readable file descriptors, writable file descriptors, [])`
+        """
+        events = {}
+        for fd in rlist:
+            events[fd] = selectors.EVENT_READ
+        for fd in wlist:
+            events[fd] = events.get(fd, 0) | selectors.EVENT_WRITE
+        if events != self.events or (self.poll is None and self.selector is None):
+            self._update(events)
+        readable, writable = [], []
+        if self.poll is not None:
+            for fd, event in self.poll.poll(None if timeout is None else int(math.ceil(timeout * 1000))):
+                # errors and hang-ups are reported to both readers and writers, as `selectors` does
+                mask = self.events.get(fd, 0)
+                if mask & selectors.EVENT_READ and event & ~select.POLLOUT:
+                    readable.append(fd)
+                if mask & selectors.EVENT_WRITE and event & ~select.POLLIN:
+                    writable.append(fd)
+            return readable, writable, []
+        for key, mask in self.selector.select(timeout):
+            if mask & selectors.EVENT_READ:
+                readable.append(key.fd)
+            if mask & selectors.EVENT_WRITE:
+                writable.append(key.fd)
+        return readable, writable, []
+
+    def _update(self, events):
+        # looked up at each call, since gevent workers monkey-patch `select.poll`; not available on Windows
+        poll = getattr(select, 'poll', None)
+        if poll is not None and len(events) <= self.max_poll_fds:
+            if self.selector is not None:
+                self.close()
+            if self.poll is None:
+                self.poll = poll()
+            for fd in self.events:
+                if fd not in events:
+                    self.poll.unregister(fd)
+            for fd, mask in events.items():
+                if self.events.get(fd) != mask:
+                    # registering an already registered file descriptor modifies its mask
+                    self.poll.register(fd, (select.POLLIN if mask & selectors.EVENT_READ else 0) |
+                                       (select.POLLOUT if mask & selectors.EVENT_WRITE else 0))
+            self.events = events
+            return
+        if self.poll is not None:
+            self.close()
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+        selector = self.selector
+        for fd in self.events:
+            if fd not in events:
+                selector.unregister(fd)
+        for fd, mask in events.items():
+            previous_mask = self.events.get(fd)
+            if previous_mask is None:
+                selector.register(fd, mask)
+            elif previous_mask != mask:
+                selector.modify(fd, mask)
+        self.events = events
+
+    def clear(self):
+        """Unregister all file descriptors (required when a registered socket is closed and replaced)."""
+        if self.poll is not None:
+            self.poll = None
+        elif self.selector is not None:
+            for fd in self.events:
+                try:
+                    self.selector.unregister(fd)
+                except (KeyError, ValueError, OSError):
+                    pass
+        self.events = {}
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        self.poll = None
+        self.events = {}
+
+
+class SelectPoller(object):
+    """Same interface as :class:`Poller`, on top of a `select`-like function."""
+
+    def __init__(self, select_function):
+        self.select = select_function
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
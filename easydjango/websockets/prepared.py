@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Messages encoded once and sent to many websockets
+=================================================
+
+A message received from Redis is usually sent to many local websockets. A :class:`PreparedMessage` is built once
+per Redis message and shared by all its subscribers: the frame header (and the compressed payload, when websockets
+do not keep their compression context) is only computed once, and the header and the payload are written with a
+single `sendmsg` call, without being concatenated.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+
+from easydjango.websockets.serialization import decode_message
+from easydjango.websockets.websocket import Header, WebSocket
+
+__author__ = 'Matthieu Gallet'
+
+
+class PreparedMessage(object):
+    """A message that can be sent to many websockets, from several threads.
+
+    :param payload: text (encoded as UTF-8) or bytes
+    :param opcode: `WebSocket.OPCODE_TEXT` or `WebSocket.OPCODE_BINARY`
+    """
+    __slots__ = ('payload', 'opcode', 'header', '_compressed', '_lock', '_signal')
+
+    def __init__(self, payload, opcode=WebSocket.OPCODE_TEXT):
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        self.payload = payload
+        self.opcode = opcode
+        self.header = Header.encode_header(True, opcode, '', len(payload), 0)
+        self._compressed = {}
+        self._lock = threading.Lock()
+        self._signal = False
+
+    @property
+    def signal(self):
+        """Name of the signal sent by this message (`None` for other messages), only decoded when required"""
+        if self._signal is False:
+            signal = None
+            if self.opcode == WebSocket.OPCODE_TEXT and self.payload.startswith(b'{'):
+                try:
+                    signal = decode_message(self.payload).get('signal')
+                except ValueError:
+                    pass
+            self._signal = signal
+        return self._signal
+
+    def frame(self, compression=None):
+        """Return the `(header, payload)` of the frame to send to a websocket.
+
+        :param compression: the permessage-deflate extension negotiated by this websocket
+        :type compression: :class:`easydjango.websockets.compression.PerMessageDeflate`
+        """
+        if compression is None or not compression.should_compress(self.payload):
+            return self.header, self.payload
+        if compression.server_context_takeover:
+            # the output depends on the previous messages sent to this websocket: it cannot be shared
+            return self._compress(compression)
+        key = (compression.server_max_window_bits, compression.level)
+        result = self._compressed.get(key)
+        if result is None:
+            with self._lock:
+                result = self._compressed.get(key)
+                if result is None:
+                    result = self._compressed[key] = self._compress(compression)
+        return result
+
+    def _compress(self, compression):
+        payload = compression.compress(self.payload)
+        return Header.encode_header(True, self.opcode, '', len(payload), Header.RSV0_MASK), payload
+
+    def __repr__(self):
+        return '<PreparedMessage opcode=%d length=%d>' % (self.opcode, len(self.payload))
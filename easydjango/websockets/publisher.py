@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Publish messages to Redis topics
+================================
+
+All messages of a signal are sent in a single pipelined round trip. With `WS4REDIS_PUBLISH_ASYNC`, messages are
+handed to a :class:`BackgroundPublisher` thread that sends everything that is pending in a single pipeline, so the
+caller never waits for Redis.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from easydjango.websockets.backlog import add_to_backlog
+from easydjango.websockets.batching import BackgroundBatcher
+
+__author__ = 'Matthieu Gallet'
+
+logger = logging.getLogger('easydjango.websockets')
+
+
+def send_messages(connection, messages):
+    """Publish a list of `(topic, message)` pairs in a single round trip.
+
+    :param connection: a :class:`redis.StrictRedis` connection
+    :param messages: list of `(topic, message)`, where `message` is already encoded as bytes, or of
+      `(topic, message, signal_id)` for messages that must also be stored in the backlog of their topic
+      (see :mod:`easydjango.websockets.backlog`)
+    """
+    if not messages:
+        return
+    if len(messages) == 1 and len(messages[0]) == 2:
+        connection.publish(*messages[0])
+        return
+    pipe = connection.pipeline(transaction=False)
+    for item in messages:
+        topic, message = item[:2]
+        if len(item) > 2:
+            add_to_backlog(pipe, topic, message, item[2])
+        pipe.publish(topic, message)
+    pipe.execute()
+
+
+class BackgroundPublisher(BackgroundBatcher):
+    """Publish messages from a background thread, without waiting for Redis.
+
+    Messages queued while a pipeline is being sent are grouped into the next one.
+    """
+    max_batch_size = 1000
+    thread_name = 'easydjango-publisher'
+
+    def __init__(self, connection_getter):
+        super(BackgroundPublisher, self).__init__()
+        self.connection_getter = connection_getter
+
+    def publish(self, messages):
+        """Queue a list of `(topic, message)` pairs (see :func:`send_messages`)"""
+        self.add(messages)
+
+    def process_batch(self, items):
+        for start in range(0, len(items), self.max_batch_size):
+            batch = items[start:start + self.max_batch_size]
+            # noinspection PyBroadException
+            try:
+                send_messages(self.connection_getter(), batch)
+            except Exception as e:
+                logger.warning('Unable to publish %d message(s) to Redis: %s' % (len(batch), e))
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""Share a single Redis pub/sub connection between all websockets of a process
+==========================================================================
+
+Each websocket registers a :class:`LocalSubscriber` to the :class:`RedisPubSubHub` of its process, with the list of
+its topics. The hub keeps a reference count for each topic, so Redis only sends a given message once per process,
+whatever the number of websockets subscribed to its topic.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import errno
+import logging
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from easydjango.websockets.poller import Poller, SelectPoller, selectors
+from easydjango.websockets.prepared import PreparedMessage
+
+__author__ = 'Matthieu Gallet'
+
+logger = logging.getLogger('django.request')
+
+
+class TopicRegistry(object):
+    """Reference-counted subscriptions of local subscribers, keyed by topic.
+
+    Not thread-safe: each registry must be used from a single thread (or event loop).
+    """
+
+    def __init__(self):
+        self.subscribers_by_topic = {}
+
+    def add(self, subscriber, topics):
+        """Register `subscriber` for the given topics.
+
+        :return: the list of topics that had no subscriber yet (and must be subscribed to)
+        """
+        new_topics = []
+        for topic in topics:
+            subscribers = self.subscribers_by_topic.setdefault(topic, set())
+            if not subscribers:
+                new_topics.append(topic)
+            subscribers.add(subscriber)
+        return new_topics
+
+    def remove(self, subscriber, topics):
+        """Unregister `subscriber` from the given topics.
+
+        :return: the list of topics that have no subscriber anymore (and can be unsubscribed from)
+        """
+        old_topics = []
+        for topic in topics:
+            subscribers = self.subscribers_by_topic.get(topic)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers_by_topic[topic]
+                old_topics.append(topic)
+        return old_topics
+
+    def get(self, topic):
+        """Return the subscribers of the topic, as a tuple that can be safely iterated."""
+        return tuple(self.subscribers_by_topic.get(topic, ()))
+
+    def topics(self):
+        return list(self.subscribers_by_topic)
+
+
+def _socketpair():
+    read_sock, write_sock = socket.socketpair()
+    read_sock.setblocking(False)
+    write_sock.setblocking(False)
+    return read_sock, write_sock
+
+
+def _drain(sock):
+    try:
+        while sock.recv(4096):
+            pass
+    except socket.error as e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+
+def _wake(sock):
+    try:
+        sock.send(b'\0')
+    except socket.error as e:
+        # a full buffer means that the reader is already woken up
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+
+class LocalSubscriber(object):
+    """Messages received by the hub for a websocket.
+
+    Messages are queued and a byte is written to an internal socket, so the websocket loop can wait for both
+    its client and its messages with a single `select` call on `fileno()`.
+    """
+
+    def __init__(self):
+        self.messages = deque()
+        self._read_sock, self._write_sock = _socketpair()
+
+    def fileno(self):
+        return self._read_sock.fileno()
+
+    def deliver(self, topic, message):
+        """Called by the hub thread
+
+        :type message: :class:`easydjango.websockets.prepared.PreparedMessage`
+        """
+        self.messages.append(message)
+        _wake(self._write_sock)
+
+    def pop_messages(self):
+        """Called by the websocket thread when `fileno()` is readable"""
+        _drain(self._read_sock)
+        messages = self.messages
+        while messages:
+            yield messages.popleft()
+
+    def close(self):
+        self._read_sock.close()
+        self._write_sock.close()
+
+
+class RedisPubSubHub(object):
+    """Single Redis pub/sub connection for all the websockets of a process.
+
+    All Redis I/O is done by a single background thread; (un)subscriptions are sent to this thread that
+    updates the Redis subscriptions only when the first subscriber of a topic arrives or when the last one leaves.
+    """
+    poll_interval = 10.0
+    reconnect_delay = 1.0
+    command_timeout = 5.0
+
+    def __init__(self, redis_connection, poller=None):
+        self.redis_connection = redis_connection
+        self.poller = poller or (SelectPoller(select.select) if selectors is None else Poller())
+        self.registry = TopicRegistry()
+        self.pubsub = redis_connection.pubsub(ignore_subscribe_messages=True)
+        self.commands = deque()
+        self._read_sock, self._write_sock = _socketpair()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscriber, topics):
+        self._call(self._subscribe, subscriber, topics)
+
+    def unsubscribe(self, subscriber, topics):
+        self._call(self._unsubscribe, subscriber, topics)
+
+    def _call(self, function, *args):
+        done = threading.Event()
+        self.commands.append((function, args, done))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='easydjango-pubsub-hub')
+                self._thread.daemon = True
+                self._thread.start()
+        _wake(self._write_sock)
+        if not done.wait(self.command_timeout):
+            logger.warning('Redis pub/sub hub did not process %s in time' % function.__name__)
+
+    def _subscribe(self, subscriber, topics):
+        new_topics = self.registry.add(subscriber, topics)
+        if new_topics:
+            self.pubsub.subscribe(*new_topics)
+
+    def _unsubscribe(self, subscriber, topics):
+        old_topics = self.registry.remove(subscriber, topics)
+        if old_topics:
+            self.pubsub.unsubscribe(*old_topics)
+
+    def _redis_fd(self):
+        connection = self.pubsub.connection
+        # noinspection PyProtectedMember
+        sock = connection and connection._sock
+        return sock.fileno() if sock else None
+
+    def process_commands(self):
+        _drain(self._read_sock)
+        error = None
+        while self.commands:
+            function, args, done = self.commands.popleft()
+            try:
+                function(*args)
+            except (RedisConnectionError, RedisTimeoutError, socket.error) as e:
+                # the registry is up-to-date, so all topics will be subscribed again after the reconnection
+                error = e
+            finally:
+                done.set()
+        if error is not None:
+            raise error
+
+    def process_messages(self):
+        while True:
+            message = self.pubsub.get_message()
+            if message is None:
+                return
+            if message['type'] != 'message':
+                continue
+            topic = message['channel']
+            if isinstance(topic, bytes):
+                topic = topic.decode('utf-8')
+            # the websocket frame is encoded once for all subscribers
+            prepared = PreparedMessage(message['data'])
+            for subscriber in self.registry.get(topic):
+                subscriber.deliver(topic, prepared)
+
+    def reconnect(self):
+        time.sleep(self.reconnect_delay)
+        if self.pubsub.connection is not None:
+            self.pubsub.connection.disconnect()
+        # the file descriptor of the new connection may be the same as the closed one
+        self.poller.clear()
+        topics = self.registry.topics()
+        if topics:
+            # reconnect and subscribe again to all topics
+            self.pubsub.subscribe(*topics)
+
+    def run(self):
+        read_fd = self._read_sock.fileno()
+        while True:
+            try:
+                redis_fd = self._redis_fd()
+                listening_fds = [read_fd] if redis_fd is None else [read_fd, redis_fd]
+                ready = self.poller.select(listening_fds, [], [], self.poll_interval)[0]
+                if read_fd in ready:
+                    self.process_commands()
+                if redis_fd is not None and redis_fd in ready:
+                    self.process_messages()
+            except (RedisConnectionError, RedisTimeoutError, socket.error, select.error, ValueError) as e:
+                logger.warning('Redis pub/sub hub error: %s' % e)
+                try:
+                    self.reconnect()
+                except (RedisConnectionError, RedisTimeoutError, socket.error) as e:
+                    logger.warning('Unable to reconnect to Redis: %s' % e)
+            except Exception as e:
+                logger.exception(e)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Encode and decode websocket messages
+=====================================
+
+Messages are encoded by `WS4REDIS_SIGNAL_ENCODER` and decoded by `WS4REDIS_SIGNAL_DECODER`. Both settings are either
+:class:`json.JSONEncoder` and :class:`json.JSONDecoder` subclasses (`DjangoJSONEncoder` and `JSONDecoder` by default),
+or functions returning JSON (as text or bytes) and decoding JSON, like `orjson.dumps` and `orjson.loads` or
+`ujson.dumps` and `ujson.loads`. Binary formats (like msgpack) cannot be used, since the JavaScript client parses
+messages with `JSON.parse`.
+
+A signal sent to several topics is only encoded once, and the same bytes are published to all of them.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+import json
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+__author__ = 'Matthieu Gallet'
+
+
+def _get_encode(encoder):
+    if isinstance(encoder, type) and issubclass(encoder, json.JSONEncoder):
+        return lambda obj: json.dumps(obj, cls=encoder)
+    return encoder
+
+
+def _get_decode(decoder):
+    if isinstance(decoder, type) and issubclass(decoder, json.JSONDecoder):
+        return lambda data: json.loads(data.decode('utf-8') if isinstance(data, bytes) else data, cls=decoder)
+    return decoder
+
+
+_encode = _get_encode(import_string(settings.WS4REDIS_SIGNAL_ENCODER))
+_decode = _get_decode(import_string(settings.WS4REDIS_SIGNAL_DECODER))
+
+
+def encode_message(obj):
+    """Encode a message (a signal or the result of a function) with `WS4REDIS_SIGNAL_ENCODER`.
+
+    :return: the encoded message, as bytes
+    """
+    value = _encode(obj)
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value
+
+
+def decode_message(data):
+    """Decode a message (text or bytes) with `WS4REDIS_SIGNAL_DECODER`.
+
+    :raise ValueError: if the message is not valid
+    """
+    return _decode(data)
+
+
+def encode_signal(signal_name, signal_id, kwargs):
+    """Return the encoded message of a signal, as bytes."""
+    return encode_message({'signal': signal_name, 'opts': kwargs, 'signal_id': signal_id})
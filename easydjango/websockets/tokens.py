@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Tokens of the websockets
+=======================
+
+The token sent by a window when it opens its websocket identifies the window and its topics. It is either:
+
+  * `signer.sign(window_key)`: the topics of the window are stored in Redis (in the `WS4REDIS_PREFIX + window_key` list,
+    expiring after `WS4REDIS_EXPIRE` seconds),
+  * or, with `WS4REDIS_TOPICS_IN_TOKEN`, the compressed and timestamped :func:`django.core.signing.dumps` of
+    `[window_key, [serialized topics]]`: the server subscribes to these topics and to the default ones of the window
+    (`WINDOW`, `USER` and `BROADCAST`) without reading Redis, and the token never expires (unless
+    `WS4REDIS_TOKEN_MAX_AGE` is set). Topic sets that are too large to fit in a URL are still stored in Redis.
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+from django.conf import settings
+from django.core import signing
+
+__author__ = 'Matthieu Gallet'
+
+signer = signing.Signer()
+_SALT = 'easydjango.websockets.tokens'
+
+
+def embedded_topics_token(window_key, topics):
+    """Return a token embedding the given serialized topics (without `WS4REDIS_PREFIX`).
+
+    :return: the signed token, or `None` if it is longer than `settings.WS4REDIS_TOKEN_MAX_LENGTH` characters
+    """
+    token = signing.dumps([window_key, list(topics)], salt=_SALT, compress=True)
+    if len(token) > settings.WS4REDIS_TOKEN_MAX_LENGTH:
+        return None
+    return token
+
+
+def parse_websocket_token(signed_token):
+    """Return the window key and the topics given by a websocket token.
+
+    :return: `(window_key, topics)`, `topics` being `None` when they are stored in Redis
+    :raise signing.BadSignature: if the token is not valid (or has expired)
+    """
+    if signed_token.count(':') == 2:  # payload:timestamp:signature
+        values = signing.loads(signed_token, salt=_SALT, max_age=settings.WS4REDIS_TOKEN_MAX_AGE)
+        try:
+            window_key, topics = values
+        except (TypeError, ValueError):
+            raise signing.BadSignature('Invalid websocket token')
+        return window_key, topics
+    return signer.unsign(signed_token), None
@@ -1,13 +1,67 @@
 # -*- coding: utf-8 -*-
+"""Serialize topics
+================
+
+Web processes, Celery workers and websocket servers must serialize a given topic to the same string (without
+`WS4REDIS_PREFIX`), so `hash(obj)` (randomized on Python 3) is never used:
+
+  * `BROADCAST`: `-broadcast`, `WINDOW`: `-window.<window_key>`, `USER`: the topic of the user model instance,
+  * model instances: `-<app_label>.<model_name>.<pk>` (the prefix is only built once per model),
+  * text: `-s.<text>`, integers: `-i.<value>`,
+  * other objects: the function registered with :func:`register_topic_serializer` for their class (or one of its
+    bases), or `-<class name>.<text value>` for classes with a custom `__str__` or `__repr__`.
+
+:func:`serialize_topics` serializes many topics at once (for example a queryset of users).
+"""
 from __future__ import unicode_literals, print_function, absolute_import
 
 from django.contrib.auth import get_user_model
-from django.db.models import Model
+from django.db.models import Model, QuerySet
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.lru_cache import lru_cache
 
 from easydjango.tasks import BROADCAST, USER, WINDOW
 
 __author__ = 'Matthieu Gallet'
 
+_TOPIC_SERIALIZERS = {}
+
+
+def register_topic_serializer(cls):
+    """Decorator registering a function `serializer(window_info, obj)` for the instances of `cls` (and its subclasses).
+
+    The returned string must start by a `-` and only depend on `obj` (and `window_info`).
+
+    .. code-block:: python
+
+        @register_topic_serializer(Room)
+        def serialize_room(window_info, room):
+            return '-room.%s' % room.name
+    """
+    def wrapper(fn):
+        _TOPIC_SERIALIZERS[cls] = fn
+        get_topic_serializer.cache_clear()
+        return fn
+    return wrapper
+
+
+@lru_cache(maxsize=None)
+def get_topic_serializer(cls):
+    """Return the serializer registered for `cls` or for its nearest base class."""
+    for base in cls.__mro__:
+        if base in _TOPIC_SERIALIZERS:
+            return _TOPIC_SERIALIZERS[base]
+    return None
+
+
+@lru_cache(maxsize=None)
+def model_topic_prefix(model):
+    """Return the topic prefix of the instances of a model (`-<app_label>.<model_name>.`)"""
+    # noinspection PyProtectedMember
+    meta = model._meta
+    return '-%s.%s.' % (meta.app_label, meta.model_name)
+
 
 def serialize_topic(window_info, obj):
     if obj is BROADCAST:
@@ -16,14 +70,49 @@ def serialize_topic(window_info, obj):
         if window_info is None:
             return None
         return '-window.%s' % window_info.window_key
-    elif isinstance(obj, Model):
-        # noinspection PyProtectedMember
-        meta = obj._meta
-        return '-%s.%s.%s' % (meta.app_label, meta.model_name, obj.pk)
     elif obj is USER:
         if window_info is None:
             return None
-        # noinspection PyProtectedMember
-        meta = get_user_model()._meta
-        return '-%s.%s.%s' % (meta.app_label, meta.model_name, window_info.user_pk)
-    return '-%s.%s' % (obj.__class__.__name__, hash(obj))
+        return '%s%s' % (model_topic_prefix(get_user_model()), window_info.user_pk)
+    return get_topic_serializer(obj.__class__)(window_info, obj)
+
+
+def serialize_topics(window_info, objs):
+    """Serialize many topics at once, removing duplicates.
+
+    The primary keys of a queryset are fetched with a single query, without building the model instances.
+    """
+    if isinstance(objs, QuerySet):
+        prefix = model_topic_prefix(objs.model)
+        result = ['%s%s' % (prefix, pk) for pk in objs.values_list('pk', flat=True)]
+    else:
+        result = [serialize_topic(window_info, obj) for obj in objs]
+    serialized_topics = set()
+    return [x for x in result if x is not None and not (x in serialized_topics or serialized_topics.add(x))]
+
+
+@register_topic_serializer(Model)
+def _serialize_model(window_info, obj):
+    return '%s%s' % (model_topic_prefix(obj.__class__), obj.pk)
+
+
+@register_topic_serializer(six.text_type)
+def _serialize_text(window_info, obj):
+    return '-s.%s' % obj
+
+
+@register_topic_serializer(six.binary_type)
+def _serialize_bytes(window_info, obj):
+    return '-s.%s' % obj.decode('utf-8')
+
+
+for _integer_type in six.integer_types:
+    register_topic_serializer(_integer_type)(lambda window_info, obj: '-i.%d' % obj)
+
+
+@register_topic_serializer(object)
+def _serialize_object(window_info, obj):
+    cls = obj.__class__
+    if cls.__str__ is object.__str__ and cls.__repr__ is object.__repr__ and not hasattr(cls, '__unicode__'):
+        raise ValueError('Unable to serialize %r as a topic: use register_topic_serializer(%s)' % (obj, cls.__name__))
+    return '-%s.%s' % (cls.__name__, force_text(obj))
@@ -4,6 +4,7 @@ import logging
 import uwsgi
 import gevent.select
 from easydjango.websockets.exceptions import WebSocketError
+from easydjango.websockets.poller import SelectPoller
 from easydjango.websockets.wsgi_server import WebsocketWSGIServer
 
 logger = logging.getLogger('django.request')
@@ -12,6 +13,7 @@ logger = logging.getLogger('django.request')
 class uWSGIWebsocket(object):
     def __init__(self):
         self._closed = False
+        self.outbound = None
 
     def get_file_descriptor(self):
         """Return the file descriptor for the given websocket"""
@@ -25,6 +27,11 @@ class uWSGIWebsocket(object):
     def closed(self):
         return self._closed
 
+    # noinspection PyMethodMayBeStatic
+    def has_buffered_data(self):
+        """uwsgi does not expose its internal buffer"""
+        return False
+
     def receive(self):
         if self._closed:
             raise WebSocketError("Connection is already closed")
@@ -47,9 +54,18 @@ class uWSGIWebsocket(object):
             self.close()
             raise WebSocketError(e)
 
+    def write_outbound(self):
+        """uWSGI does not provide non-blocking writes: queued messages are sent immediately"""
+        for message in self.outbound.pop_messages():
+            self.send(message.payload)
+        return True
+
     def close(self, code=1000, message=''):
         self._closed = True
 
+    def abort(self, code=1008):
+        self.close(code)
+
 
 class uWSGIWebsocketServer(WebsocketWSGIServer):
     def upgrade_websocket(self, environ, start_response):
@@ -58,3 +74,7 @@ class uWSGIWebsocketServer(WebsocketWSGIServer):
 
     def select(self, rlist, wlist, xlist, timeout=None):
         return gevent.select.select(rlist, wlist, xlist, timeout)
+
+    def create_poller(self):
+        # the uWSGI gevent loop must not be blocked by an epoll call
+        return SelectPoller(self.select)
@@ -1,22 +1,23 @@
 # -*- coding: utf-8 -*-
 # This code was generously pilfered from https://bitbucket.org/Jeffrey/gevent-websocket
 # written by Jeffrey Gelens (http://noppo.pro/) and licensed under the Apache License, Version 2.0
+import logging
 import six
 import struct
 from socket import error as socket_error
-from django.core.handlers.wsgi import logger
+from easydjango.websockets.buffers import MessageAssembler, send_buffers, send_nowait
 from easydjango.websockets.utf8validator import Utf8Validator
 from easydjango.websockets.exceptions import WebSocketError, FrameTooLargeException
+from easydjango.websockets.keepalive import KeepaliveState
+from easydjango.websockets.masking import mask_payload
 
-
-if six.PY3:
-    # noinspection PyShadowingBuiltins
-    xrange = range
+logger = logging.getLogger('django.request')
 
 
 # noinspection PyMethodMayBeStatic
 class WebSocket(object):
-    __slots__ = ('_closed', 'stream', 'utf8validator', 'utf8validate_last')
+    __slots__ = ('_closed', 'stream', 'utf8validator', 'utf8validate_last', 'assembler', 'keepalive', 'compression',
+                 'outbound')
 
     OPCODE_CONTINUATION = 0x00
     OPCODE_TEXT = 0x01
@@ -25,11 +26,15 @@ class WebSocket(object):
     OPCODE_PING = 0x09
     OPCODE_PONG = 0x0a
 
-    def __init__(self, wsgi_input):
+    def __init__(self, wsgi_input, max_message_size=None, compression=None):
         self._closed = False
         self.stream = Stream(wsgi_input)
         self.utf8validator = Utf8Validator()
         self.utf8validate_last = None
+        self.assembler = MessageAssembler(max_message_size)
+        self.keepalive = KeepaliveState()
+        self.compression = compression
+        self.outbound = None
 
     def __del__(self):
         # noinspection PyBroadException
@@ -83,6 +88,10 @@ class WebSocket(object):
         """Return the file descriptor for the given websocket"""
         return self.stream.fileno
 
+    def has_buffered_data(self):
+        """Return `True` if frames have already been received but not read"""
+        return self.stream is not None and self.stream.has_buffered_data()
+
     @property
     def closed(self):
         return self._closed
@@ -103,7 +112,7 @@ class WebSocket(object):
         rv = payload[:2]
         if six.PY2:
             rv = str(rv)
-        code = struct.unpack('!H', rv[0])
+        code = struct.unpack('!H', rv)[0]
         payload = payload[2:]
         if payload:
             validator = Utf8Validator()
@@ -119,8 +128,15 @@ class WebSocket(object):
     def handle_ping(self, header, payload):
         self.send_frame(payload, self.OPCODE_PONG)
 
+    # noinspection PyUnusedLocal
     def handle_pong(self, header, payload):
-        pass
+        self.keepalive.pong(payload)
+
+    def ping(self):
+        """
+        Send a ping frame; the client is expected to answer with a pong frame.
+        """
+        self.send_frame(self.keepalive.new_ping(), self.OPCODE_PING)
 
     def read_frame(self):
         """
@@ -132,10 +148,11 @@ class WebSocket(object):
         :return: The header and payload as a tuple.
         """
         header = Header.decode_header(self.stream)
-        if header.flags:
-            raise WebSocketError
+        self.check_frame_flags(header)
+        self.check_frame_size(header)
         if not header.length:
-            return header, ''
+            self.keepalive.touch()
+            return header, b''
         try:
             payload = self.stream.read(header.length)
         except socket_error:
@@ -147,8 +164,29 @@ class WebSocket(object):
             raise WebSocketError('Unexpected EOF reading frame payload')
         if header.mask:
             payload = header.unmask_payload(payload)
+        self.keepalive.touch()
         return header, payload
 
+    def check_frame_flags(self, header):
+        """
+        Only the first frame of a message can have the RSV1 bit, and only if permessage-deflate is used.
+        """
+        if not header.flags:
+            return
+        if header.flags == Header.RSV0_MASK and self.compression is not None and \
+                header.opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            return
+        raise WebSocketError('Unexpected reserved bits: {0!r}'.format(header))
+
+    def check_frame_size(self, header):
+        """
+        Raise `FrameTooLargeException` before reading a data frame that would make its message too large.
+        """
+        if header.opcode == self.OPCODE_CONTINUATION:
+            self.assembler.check(header.length)
+        elif header.opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            self.assembler.check(header.length, continuation=False)
+
     def validate_utf8(self, payload):
         # Make sure the frames are decodable independently
         self.utf8validate_last = self.utf8validator.validate(payload)
@@ -166,7 +204,8 @@ class WebSocket(object):
         if an exception is called. Use `receive` instead.
         """
         opcode = None
-        message = ""
+        compressed = False
+        self.assembler.reset()
         while True:
             header, payload = self.read_frame()
             f_opcode = header.opcode
@@ -179,35 +218,49 @@ class WebSocket(object):
                 self.utf8validator.reset()
                 self.utf8validate_last = (True, True, 0, 0)
                 opcode = f_opcode
+                compressed = bool(header.flags)
             elif f_opcode == self.OPCODE_CONTINUATION:
                 if not opcode:
                     raise WebSocketError("Unexpected frame with opcode=0")
-            elif f_opcode == self.OPCODE_PING:
-                self.handle_ping(header, payload)
-                continue
-            elif f_opcode == self.OPCODE_PONG:
-                self.handle_pong(header, payload)
+            elif f_opcode in (self.OPCODE_PING, self.OPCODE_PONG):
+                if f_opcode == self.OPCODE_PING:
+                    self.handle_ping(header, payload)
+                else:
+                    self.handle_pong(header, payload)
+                if opcode is None and not self.has_buffered_data():
+                    # do not block the caller until the next message
+                    return None
                 continue
             elif f_opcode == self.OPCODE_CLOSE:
                 self.handle_close(header, payload)
                 return
             else:
                 raise WebSocketError("Unexpected opcode={0!r}".format(f_opcode))
-            if opcode == self.OPCODE_TEXT:
+            if opcode == self.OPCODE_TEXT and payload and not compressed:
+                # each fragment is validated once, a code point may be split across fragments
                 self.validate_utf8(payload)
-                if six.PY3:
-                    payload = payload.decode()
-            message += payload
+            self.assembler.append(payload)
             if header.fin:
                 break
-        if opcode == self.OPCODE_TEXT:
-            if six.PY2:
+        return self.decode_message(opcode, self.assembler.pop(), compressed)
+
+    def decode_message(self, opcode, message, compressed=False):
+        """
+        Decompress the assembled message if required and return it as text or bytearray.
+        """
+        if compressed:
+            message = self.compression.decompress(message)
+            if opcode == self.OPCODE_TEXT:
+                self.utf8validator.reset()
                 self.validate_utf8(message)
-            else:
-                self.validate_utf8(message.encode())
+        if opcode == self.OPCODE_TEXT:
+            if not self.utf8validate_last[1]:
+                raise UnicodeError('Text message does not end on a code point')
+            if six.PY3:
+                # the validator (a CodecUtf8Validator) has already decoded the message
+                return self.utf8validator.text()
             return message
-        else:
-            return bytearray(message)
+        return bytearray(message)
 
     def receive(self):
         """
@@ -221,6 +274,9 @@ class WebSocket(object):
         except UnicodeError as e:
             logger.info('websocket.receive: UnicodeError {}'.format(e))
             self.close(1007)
+        except FrameTooLargeException as e:
+            logger.info('websocket.receive: FrameTooLargeException {}'.format(e))
+            self.close(1009)
         except WebSocketError as e:
             logger.info('websocket.receive: WebSocketError {}'.format(e))
             self.close(1002)
@@ -244,9 +300,33 @@ class WebSocket(object):
             message = self._encode_bytes(message)
         elif opcode == self.OPCODE_BINARY:
             message = six.binary_type(message)
-        header = Header.encode_header(True, opcode, '', len(message), 0)
+        flags = 0
+        if self.compression is not None and opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY) and \
+                self.compression.should_compress(message):
+            message = self.compression.compress(message)
+            flags = Header.RSV0_MASK  # RSV1 bit of RFC 6455
+        header = Header.encode_header(True, opcode, '', len(message), flags)
+        buffers = [header, message]
+        if self.outbound is not None and self.outbound.current:
+            # a queued message is partially written: it must be finished before starting a new frame
+            buffers = self.outbound.current + buffers
+            self.outbound.current = []
+        try:
+            self.stream.writelines(buffers)
+        except socket_error:
+            raise WebSocketError("Socket is dead")
+
+    def write_outbound(self):
+        """
+        Write the messages queued in `self.outbound` (:class:`easydjango.websockets.outbound.OutboundQueue`)
+        without blocking.
+
+        :return: `True` if all messages have been written
+        """
+        if self._closed:
+            raise WebSocketError("Connection is already closed")
         try:
-            self.stream.write(header + message)
+            return self.outbound.write(self.stream.send_nowait, self.compression)
         except socket_error:
             raise WebSocketError("Socket is dead")
 
@@ -282,24 +362,107 @@ class WebSocket(object):
             self._closed = True
             self.stream = None
 
+    def abort(self, code=1008):
+        """
+        Close the websocket without waiting for the client, when it does not read its messages.
+        The closing frame is only sent if it can be written immediately.
+        """
+        if self._closed:
+            return
+        partial = False
+        if self.outbound is not None:
+            partial = bool(self.outbound.current)
+            self.outbound.clear()
+        if not partial:
+            try:
+                self.stream.send_nowait([Header.encode_header(True, self.OPCODE_CLOSE, '', 2, 0),
+                                         struct.pack('!H', code)])
+            except socket_error:
+                pass
+        logger.debug("Aborted WebSocket")
+        self._closed = True
+        self.stream = None
+
 
 class Stream(object):
     """
     Wraps the handler's socket/rfile attributes and makes it in to a file like
     object that can be read from/written to by the lower level websocket api.
+
+    Data are received by large chunks into a preallocated buffer, so several small frames
+    sent at once by the client are parsed after a single system call.
     """
 
-    __slots__ = ('read', 'write', 'fileno')
+    __slots__ = ('sock', 'recv_into', 'write', 'fileno', 'buffer', 'view', 'start', 'end')
+
+    buffer_size = 65536
 
     # noinspection PyProtectedMember
     def __init__(self, wsgi_input):
         if six.PY2:
-            self.read = wsgi_input._sock.recv
-            self.write = wsgi_input._sock.sendall
+            sock = wsgi_input._sock
         else:
-            self.read = wsgi_input.raw._sock.recv
-            self.write = wsgi_input.raw._sock.sendall
+            sock = wsgi_input.raw._sock
+        self.sock = sock
+        self.recv_into = sock.recv_into
+        self.write = sock.sendall
         self.fileno = wsgi_input.fileno()
+        self.buffer = bytearray(self.buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def writelines(self, buffers):
+        """Write the header and the payload of a frame without concatenating them."""
+        send_buffers(self.sock, buffers)
+
+    def send_nowait(self, buffers):
+        """Write as much data as possible without blocking and return the number of written bytes."""
+        return send_nowait(self.sock, buffers)
+
+    def has_buffered_data(self):
+        """Return `True` if some received data have not been read yet (`select` cannot detect them)."""
+        return self.end > self.start
+
+    def read(self, size):
+        """
+        Read exactly `size` bytes (unless the connection is closed).
+        """
+        available = self.end - self.start
+        if available < size:
+            if size > len(self.buffer):
+                return self._read_large(size)
+            if self.start + size > len(self.buffer):
+                # not enough space at the end of the buffer: move the remaining data at its beginning
+                self.view[:available] = self.view[self.start:self.end]
+                self.start, self.end = 0, available
+            while self.end - self.start < size:
+                received = self.recv_into(self.view[self.end:])
+                if not received:
+                    break
+                self.end += received
+            size = min(size, self.end - self.start)
+        data = self.view[self.start:self.start + size].tobytes()
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return data
+
+    def _read_large(self, size):
+        """Read a payload larger than the buffer directly into its own bytearray"""
+        available = self.end - self.start
+        result = bytearray(size)
+        result_view = memoryview(result)
+        result_view[:available] = self.view[self.start:self.end]
+        self.start = self.end = 0
+        while available < size:
+            received = self.recv_into(result_view[available:])
+            if not received:
+                break
+            available += received
+        if available < size:
+            return bytes(result[:available])
+        return bytes(result)
 
 
 class Header(object):
@@ -324,13 +487,7 @@ class Header(object):
         self.length = length
 
     def mask_payload(self, payload):
-        payload = bytearray(payload)
-        mask = bytearray(self.mask)
-        for i in xrange(self.length):
-            payload[i] ^= mask[i % 4]
-        if six.PY3:
-            return bytes(payload)
-        return str(payload)
+        return mask_payload(self.mask, payload[:self.length])
 
     # it's the same operation
     unmask_payload = mask_payload
@@ -341,18 +498,14 @@ class Header(object):
                                    self.flags, id(self))
 
     @classmethod
-    def decode_header(cls, stream):
+    def decode_first_bytes(cls, data):
         """
-        Decode a WebSocket header.
+        Decode the two first bytes of a WebSocket header.
 
-        :param stream: A file like object that can be 'read' from.
-        :returns: A `Header` instance.
+        :param data: the two first bytes of the frame.
+        :returns: A `(Header, has_mask)` tuple. If `header.length` is 126 or 127, the real length is given
+          by the 2 or 8 following bytes.
         """
-        read = stream.read
-
-        data = read(2)
-        if len(data) != 2:
-            raise WebSocketError("Unexpected EOF while decoding header (1)")
         first_byte, second_byte = struct.unpack('!BB', data)
         header = cls(
             fin=first_byte & cls.FIN_MASK == cls.FIN_MASK,
@@ -366,6 +519,22 @@ class Header(object):
             # Control frames MUST have a payload length of 125 bytes or less
             if header.length > 125:
                 raise FrameTooLargeException('Control frame cannot be larger than 125 bytes: {0!r}'.format(data))
+        return header, has_mask
+
+    @classmethod
+    def decode_header(cls, stream):
+        """
+        Decode a WebSocket header.
+
+        :param stream: A file like object that can be 'read' from.
+        :returns: A `Header` instance.
+        """
+        read = stream.read
+
+        data = read(2)
+        if len(data) != 2:
+            raise WebSocketError("Unexpected EOF while decoding header (1)")
+        header, has_mask = cls.decode_first_bytes(data)
         if header.length == 126:
             # 16 bit length
             data = read(2)
@@ -7,9 +7,10 @@ Structure of the redis database, with `prefix = settings.WS4REDIS_PREFIX`:
 
 
 """
-import json
 import logging
+import os
 import sys
+import threading
 
 import django
 if django.VERSION[:2] >= (1, 7):
@@ -17,23 +18,32 @@ if django.VERSION[:2] >= (1, 7):
 from django.conf import settings
 import django.utils.six as six
 from django.core import signing
-from django.utils.lru_cache import lru_cache
 from django.utils.module_loading import import_string
 # noinspection PyUnresolvedReferences
 from django.utils.six.moves import http_client
 from easydjango.decorators import REGISTERED_FUNCTIONS
-from redis import StrictRedis
 
 from easydjango.request import WindowInfo
+from easydjango.utils import TokenBucket
+from easydjango.websockets.backlog import get_missed_messages
+from easydjango.websockets.compression import PerMessageDeflate
+from easydjango.websockets.outbound import OutboundQueue
+from easydjango.websockets.poller import Poller, SelectPoller, selectors
+from easydjango.websockets.prepared import PreparedMessage
+from easydjango.websockets.pubsub import RedisPubSubHub, LocalSubscriber
+from easydjango.websockets.serialization import decode_message
+# noinspection PyUnresolvedReferences
+from easydjango.websockets.tokens import signer, parse_websocket_token
 # noinspection PyProtectedMember
-from easydjango.tasks import _call_signal, SERVER, _server_function_call, import_signals_and_functions
+from easydjango.tasks import _call_signal, SERVER, _dispatch_function_call, _inline_function_call, \
+    import_signals_and_functions, _get_redis_connection, _get_default_topics
 
 from django.contrib.auth import get_user
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.exceptions import PermissionDenied
 from django import http
 from django.utils.encoding import force_str, force_text
-from easydjango.websockets.exceptions import WebSocketError, HandshakeError, UpgradeRequiredError
+from easydjango.websockets.exceptions import WebSocketError, HandshakeError, UpgradeRequiredError, SlowConsumerError
 
 try:
     # django >= 1.8 && python >= 2.7
@@ -46,35 +56,153 @@ except ImportError:
 
 
 logger = logging.getLogger('django.request')
-signer = signing.Signer()
 topic_serializer = import_string(settings.WS4REDIS_TOPIC_SERIALIZER)
-signal_decoder = import_string(settings.WS4REDIS_SIGNAL_DECODER)
+_session_engines = {}
+
 
+def get_session_engine():
+    """Return the module of `settings.SESSION_ENGINE`, only imported once."""
+    name = settings.SESSION_ENGINE
+    engine = _session_engines.get(name)
+    if engine is None:
+        engine = _session_engines[name] = import_module(name)
+    return engine
 
-# noinspection PyCallingNonCallable
-@lru_cache()
-def _get_redis_connection():
-    return StrictRedis(**settings.WS4REDIS_CONNECTION)
 
+def get_redis_session_db():
+    """Return the Redis database of the sessions when they are stored by `redis_sessions` on the Redis server of the
+    websockets (so they can be fetched with the same connection), or `None`."""
+    if settings.SESSION_ENGINE != 'redis_sessions.session':
+        return None
+    session_settings = import_module('redis_sessions.settings')
+    if any(getattr(session_settings, x, None) for x in ('SESSION_REDIS_URL', 'SESSION_REDIS_POOL',
+                                                        'SESSION_REDIS_SENTINEL_LIST',
+                                                        'SESSION_REDIS_UNIX_DOMAIN_SOCKET_PATH')):
+        return None
+    connection = settings.WS4REDIS_CONNECTION
+    session_server = (session_settings.SESSION_REDIS_HOST, int(session_settings.SESSION_REDIS_PORT),
+                      session_settings.SESSION_REDIS_PASSWORD or None)
+    if session_server != (connection.get('host', 'localhost'), int(connection.get('port', 6379)),
+                          connection.get('password') or None):
+        return None
+    return int(session_settings.SESSION_REDIS_DB)
 
-def get_websocket_topics(request):
-    signed_token = request.GET.get('token', '')
+
+def get_websocket_topics(request, window_info=None):
     try:
-        token = signer.unsign(signed_token)
+        window_key, topics = parse_websocket_token(request.GET.get('token', ''))
     except signing.BadSignature:
         return []
-    redis_key = '%s%s' % (settings.WS4REDIS_PREFIX, token)
-    connection = _get_redis_connection()
-    topics = connection.lrange(redis_key, 0, -1)
-    return [x.decode('utf-8') for x in topics]
+    if topics is None:
+        topics = getattr(request, 'redis_topics', None)  # already fetched by `process_request`
+        if topics is None:
+            redis_key = '%s%s' % (settings.WS4REDIS_PREFIX, window_key)
+            topics = _get_redis_connection().lrange(redis_key, 0, -1)
+        return [x.decode('utf-8') for x in topics]
+    return [settings.WS4REDIS_PREFIX + x for x in _get_default_topics(window_info) + topics]
 
 
 class WebsocketWSGIServer(object):
+
     def __init__(self, redis_connection=None):
         """
         redis_connection can be overriden by a mock object.
         """
+        # maximum time spent waiting for a socket before checking the keepalive of the websocket
+        self.heartbeat_interval = settings.WS4REDIS_HEARTBEAT_INTERVAL
         self._redis_connection = redis_connection or _get_redis_connection()
+        self._hub = None
+        self._hub_pid = None
+        self._hub_lock = threading.Lock()
+        self.accept_bucket = None
+        if settings.WS4REDIS_ACCEPT_RATE:
+            self.accept_bucket = TokenBucket(settings.WS4REDIS_ACCEPT_RATE, settings.WS4REDIS_ACCEPT_BURST)
+
+    def get_hub(self):
+        """Return the :class:`RedisPubSubHub` of the current process (a new one is required after a fork)."""
+        pid = os.getpid()
+        hub = self._hub
+        if hub is None or self._hub_pid != pid:
+            # websockets opened at the same time by several threads must share the same Redis connection
+            with self._hub_lock:
+                hub = self._hub
+                if hub is None or self._hub_pid != pid:
+                    hub = RedisPubSubHub(self._redis_connection, poller=self.create_poller())
+                    self._hub = hub
+                    self._hub_pid = pid
+        return hub
+
+    def send_keepalive(self, websocket, timed_out=False, now=None):
+        """Send a ping frame if nothing has been received from the client for `settings.WS4REDIS_PING_INTERVAL`
+        seconds, or close the websocket after `settings.WS4REDIS_PING_MAX_MISSED` unanswered pings.
+
+        Websockets that cannot send ping frames (or when `WS4REDIS_PING_INTERVAL` is 0) receive the text heartbeat
+        message instead, echoed by the JavaScript client.
+
+        :param timed_out: `True` if nothing happened on the websocket during the last `heartbeat_interval` seconds
+        """
+        keepalive = getattr(websocket, 'keepalive', None)
+        ping_interval = settings.WS4REDIS_PING_INTERVAL
+        if keepalive is not None and ping_interval:
+            if not keepalive.ping_due(ping_interval, now=now):
+                return
+            keepalive.count_missed_pong()
+            if keepalive.is_dead(settings.WS4REDIS_PING_MAX_MISSED):
+                logger.info('Closing unresponsive websocket %r' % keepalive)
+                websocket.close()
+            else:
+                websocket.ping()
+        elif settings.WS4REDIS_HEARTBEAT:
+            if keepalive is None:
+                idle = timed_out
+            else:
+                idle = keepalive.idle_time(now=now) >= self.heartbeat_interval
+            if idle:
+                websocket.send(settings.WS4REDIS_HEARTBEAT)
+
+    def admit_connection(self):
+        """Return `False` if a new websocket must be rejected, when more than `settings.WS4REDIS_ACCEPT_RATE`
+        websockets per second are opened. Called before any session or database access."""
+        return self.accept_bucket is None or self.accept_bucket.consume()
+
+    # noinspection PyMethodMayBeStatic
+    def reject_websocket(self, websocket):
+        """Close a websocket that has not been admitted, asking the client to retry later"""
+        logger.info('Too many new websockets, connection rejected')
+        websocket.close(code=1013, message='retry-after=%d' % settings.WS4REDIS_ACCEPT_RETRY_AFTER)
+
+    # noinspection PyMethodMayBeStatic
+    def create_outbound_queue(self):
+        """Queue of the messages waiting to be sent to a new websocket"""
+        return OutboundQueue(max_bytes=settings.WS4REDIS_OUTBOUND_MAX_BYTES,
+                             max_messages=settings.WS4REDIS_OUTBOUND_MAX_MESSAGES,
+                             policy=settings.WS4REDIS_OUTBOUND_POLICY)
+
+    # noinspection PyMethodMayBeStatic
+    def negotiate_compression(self, environ):
+        """Accept the permessage-deflate extension if the client offers it and `settings.WS4REDIS_COMPRESSION`.
+
+        :return: a `(PerMessageDeflate, Sec-WebSocket-Extensions response header)` tuple, or `(None, None)`
+        """
+        if not settings.WS4REDIS_COMPRESSION:
+            return None, None
+        return PerMessageDeflate.negotiate(environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS'),
+                                           server_context_takeover=settings.WS4REDIS_COMPRESSION_CONTEXT_TAKEOVER,
+                                           client_context_takeover=settings.WS4REDIS_COMPRESSION_CONTEXT_TAKEOVER,
+                                           threshold=settings.WS4REDIS_COMPRESSION_THRESHOLD,
+                                           max_size=settings.WS4REDIS_MAX_MESSAGE_SIZE)
+
+    def get_missed_messages(self, channels, last_signal_id):
+        """Return the signals published to `channels` since the signal `last_signal_id`, received by the window
+        before its reconnection (only if `settings.WS4REDIS_BACKLOG_SIZE` is not 0).
+
+        :rtype: :class:`list` of :class:`easydjango.websockets.prepared.PreparedMessage`
+        """
+        if not (last_signal_id and channels and settings.WS4REDIS_BACKLOG_SIZE):
+            return []
+        messages = get_missed_messages(self._redis_connection, channels, last_signal_id)
+        logger.debug('%d missed message(s) since signal %r' % (len(messages), last_signal_id))
+        return [PreparedMessage(x) for x in messages]
 
     def upgrade_websocket(self, environ, start_reponse):
         raise NotImplementedError
@@ -82,6 +210,13 @@ class WebsocketWSGIServer(object):
     def select(self, rlist, wlist, xlist, timeout=None):
         raise NotImplementedError
 
+    def create_poller(self):
+        """Return a new :class:`easydjango.websockets.poller.Poller` (or :class:`SelectPoller` on top of
+        `self.select` when :mod:`selectors` is not available)"""
+        if selectors is None:
+            return SelectPoller(self.select)
+        return Poller()
+
     # noinspection PyMethodMayBeStatic
     def assure_protocol_requirements(self, environ):
         if environ.get('REQUEST_METHOD') != 'GET':
@@ -95,35 +230,75 @@ class WebsocketWSGIServer(object):
 
     # noinspection PyMethodMayBeStatic
     def process_request(self, request):
+        """Load the session, the user and the window key of a new websocket.
+
+        The session (when it is stored by `redis_sessions` on the Redis server of the websockets) and the topics of the
+        window (when they are not given by its token) are fetched in a single pipelined round trip; topics are kept
+        in `request.redis_topics` for :meth:`process_subscriptions`.
+        """
         request.session = None
         request.user = None
+        request.redis_topics = None
+        try:
+            window_key, topics = parse_websocket_token(request.GET.get('token', ''))
+        except signing.BadSignature:
+            window_key, topics = None, []
         session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, None)
+        session_db = get_redis_session_db() if session_key is not None else None
+        if session_db is not None or topics is None:
+            pipe = self._redis_connection.pipeline(transaction=False)
+            if session_db is not None:
+                request.session = get_session_engine().SessionStore(session_key)
+                pipe.execute_command('SELECT', session_db)
+                pipe.get(request.session.get_real_stored_key(session_key))
+                pipe.execute_command('SELECT', int(settings.WS4REDIS_CONNECTION.get('db', 0)))
+            if topics is None:
+                pipe.lrange('%s%s' % (settings.WS4REDIS_PREFIX, window_key), 0, -1)
+            results = pipe.execute()
+            if topics is None:
+                request.redis_topics = results[-1]
+            if session_db is not None:
+                # noinspection PyProtectedMember
+                request.session._session_cache = request.session.decode(force_text(results[1])) if results[1] else {}
         if session_key is not None:
-            engine = import_module(settings.SESSION_ENGINE)
-            request.session = engine.SessionStore(session_key)
+            if request.session is None:
+                request.session = get_session_engine().SessionStore(session_key)
             request.user = get_user(request)
         window_info = WindowInfo.from_request(request)
-        signed_token = request.GET.get('token', '')
-        try:
-            window_info.window_key = signer.unsign(signed_token)
-        except signing.BadSignature:
-            pass
+        if window_key is not None:
+            window_info.window_key = window_key
         return window_info
 
     # noinspection PyMethodMayBeStatic
-    def process_subscriptions(self, request):
-        channels = get_websocket_topics(request)
+    def process_subscriptions(self, request, window_info=None):
+        channels = get_websocket_topics(request, window_info=window_info)
         echo_message = bool(request.GET.get('echo', ''))
         return channels, echo_message
 
-    @staticmethod
-    def publish_message(window_info, message):
+    def publish_message(self, window_info, message, reply=None):
+        """Process a message received from a websocket: a signal or a function call, or a list of them when the
+        client batches its messages.
+
+        :param reply: function that directly sends a message to this websocket (used by inline functions)
+        """
         if not message:
             return
         if message == settings.WS4REDIS_HEARTBEAT:
             return
         try:
-            unserialized_message = json.loads(message)
+            unserialized_message = decode_message(message)
+        except (TypeError, ValueError):
+            logger.error('Invalid Websocket JSON message %r' % message)
+            return
+        if isinstance(unserialized_message, list):
+            for unserialized_item in unserialized_message:
+                self.dispatch_message(window_info, unserialized_item, reply=reply)
+        else:
+            self.dispatch_message(window_info, unserialized_message, reply=reply)
+
+    # noinspection PyMethodMayBeStatic
+    def dispatch_message(self, window_info, unserialized_message, reply=None):
+        try:
             kwargs = unserialized_message['opts']
             if 'signal' in unserialized_message:
                 signal_name = unserialized_message['signal']
@@ -136,17 +311,26 @@ class WebsocketWSGIServer(object):
                 function_name = unserialized_message['func']
                 result_id = unserialized_message['result_id']
                 import_signals_and_functions()
-                if function_name in REGISTERED_FUNCTIONS:
-                    fn = REGISTERED_FUNCTIONS[function_name]
-                    _server_function_call.apply_async([function_name, window_info.to_dict(), result_id, kwargs],
-                                                      queue=fn.queue or settings.CELERY_DEFAULT_QUEUE)
-                else:
+                fn = REGISTERED_FUNCTIONS.get(function_name)
+                if fn is None:
                     logger.warning('Unknown function "%s" called by client "%s"' %
                                    (function_name, window_info.window_key))
+                elif fn.inline and reply is not None:
+                    if fn.is_allowed_to(window_info):
+                        reply(_inline_function_call(window_info, function_name, result_id, kwargs))
+                    else:
+                        logger.warning('Function "%s" is not allowed to client "%s"' %
+                                       (function_name, window_info.window_key))
+                elif fn.coalesce and not fn.is_allowed_to(window_info):
+                    # coalesced calls share their result: callers cannot rely on the check made by the first one
+                    logger.warning('Function "%s" is not allowed to client "%s"' %
+                                   (function_name, window_info.window_key))
+                else:
+                    _dispatch_function_call(window_info, fn, result_id, kwargs)
         except TypeError:
             pass
         except ValueError:
-            logger.error('Invalid Websocket JSON message %r' % message)
+            logger.error('Invalid Websocket message %r' % unserialized_message)
             pass
         except KeyError:
             pass
@@ -160,12 +344,17 @@ class WebsocketWSGIServer(object):
         websocket = None
         try:
             self.assure_protocol_requirements(environ)
+            if not self.admit_connection():
+                websocket = self.upgrade_websocket(environ, start_response)
+                self.reject_websocket(websocket)
+                return response
             request = WSGIRequest(environ)
             # noinspection PyTypeChecker
             window_info = self.process_request(request)
             websocket = self.upgrade_websocket(environ, start_response)
-            channels, echo_message = self.process_subscriptions(request)
-            self.process_websocket(window_info, websocket, channels)
+            channels, echo_message = self.process_subscriptions(request, window_info=window_info)
+            self.process_websocket(window_info, websocket, channels,
+                                   last_signal_id=request.GET.get('last_signal_id'))
         except WebSocketError as excpt:
             logger.warning('WebSocketError: {}'.format(excpt), exc_info=sys.exc_info())
             response = http.HttpResponse(status=1001, content='Websocket Closed')
@@ -186,7 +375,8 @@ class WebsocketWSGIServer(object):
         finally:
             # pubsub.release()
             if websocket:
-                websocket.close(code=1001, message='Websocket Closed')
+                if not websocket.closed:
+                    websocket.close(code=1001, message='Websocket Closed')
             else:
                 logger.warning('Starting late response on websocket')
                 status_text = http_client.responses.get(response.status_code, 'UNKNOWN STATUS CODE')
@@ -199,38 +389,65 @@ class WebsocketWSGIServer(object):
                 logger.info('Finish non-websocket response with status code: {}'.format(response.status_code))
         return response
 
-    def process_websocket(self, window_info, websocket, channels):
+    def process_websocket(self, window_info, websocket, channels, last_signal_id=None):
         websocket_fd = websocket.get_file_descriptor()
         listening_fds = [websocket_fd]
-        redis_fd, pubsub = None, None
+        hub, subscriber, subscriber_fd = None, None, None
+        # messages are written when the socket is writable, so a slow client does not block this loop
+        websocket.outbound = outbound = self.create_outbound_queue()
+        poller = self.create_poller()
+
+        def reply(payload):
+            # results of inline functions are computed by this thread and written with the next messages
+            outbound.push(PreparedMessage(payload))
+
         if channels:
-            pubsub = self._redis_connection.pubsub()
-            pubsub.subscribe(*channels)
+            hub = self.get_hub()
+            subscriber = LocalSubscriber()
+            hub.subscribe(subscriber, channels)
             logger.debug('Subscribed to channels: {0}'.format(', '.join(map(repr, channels))))
-            # noinspection PyProtectedMember
-            redis_fd = pubsub.connection._sock.fileno()
-            if redis_fd:
-                listening_fds.append(redis_fd)
-        # subscriber.send_persited_messages(websocket)
-        while websocket and not websocket.closed:
-            selected_fds = self.select(listening_fds, [], [], 10.0)
-            ready = selected_fds[0]
-            if not ready:
-                # flush empty socket
-                websocket.flush()
-            for fd in ready:
-                if fd == websocket_fd:
-                    message = websocket.receive()
-                    self.publish_message(window_info, message)
-                elif fd == redis_fd:
-                    kind, topic, message = pubsub.parse_response()
-                    kind = kind.decode('utf-8')
-                    if kind == 'message':
-                        websocket.send(message)
-                else:
-                    logger.error('Invalid file descriptor: {0}'.format(fd))
-            # Check again that the websocket is closed before sending the heartbeat,
-            # because the websocket can closed previously in the loop.
-            if settings.WS4REDIS_HEARTBEAT and not websocket.closed and not ready:
-                websocket.send(settings.WS4REDIS_HEARTBEAT)
+            subscriber_fd = subscriber.fileno()
+            listening_fds.append(subscriber_fd)
+        timeout = self.heartbeat_interval
+        if settings.WS4REDIS_PING_INTERVAL:
+            timeout = min(timeout, settings.WS4REDIS_PING_INTERVAL)
+        try:
+            # subscribed before reading the backlog, so no message is lost between both
+            for message in self.get_missed_messages(channels, last_signal_id):
+                outbound.push(message)
+            while websocket and not websocket.closed:
+                writing_fds = [websocket_fd] if outbound else []
+                selected_fds = poller.select(listening_fds, writing_fds, [], timeout)
+                ready = selected_fds[0]
+                if not ready and not selected_fds[1]:
+                    # flush empty socket
+                    websocket.flush()
+                for fd in ready:
+                    if fd == websocket_fd:
+                        message = websocket.receive()
+                        self.publish_message(window_info, message, reply=reply)
+                        # frames already read from the socket are not seen by select
+                        while not websocket.closed and websocket.has_buffered_data():
+                            message = websocket.receive()
+                            self.publish_message(window_info, message, reply=reply)
+                    elif fd == subscriber_fd:
+                        for message in subscriber.pop_messages():
+                            outbound.push(message)
+                    else:
+                        logger.error('Invalid file descriptor: {0}'.format(fd))
+                if outbound and not websocket.closed:
+                    websocket.write_outbound()
+                # Check again that the websocket is closed before sending the heartbeat,
+                # because the websocket can closed previously in the loop.
+                if not websocket.closed:
+                    self.send_keepalive(websocket, timed_out=not ready and not selected_fds[1])
+        except SlowConsumerError as e:
+            logger.warning('Disconnecting slow websocket client: %s' % e)
+            websocket.abort()
+        finally:
+            outbound.clear()
+            poller.close()
+            if subscriber is not None:
+                hub.unsubscribe(subscriber, channels)
+                subscriber.close()
         logger.error('websocket closed')